@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import time
+
+from delivery import DeliverySystem, LOSS_CHANCE, READ_CHANCE
+from scheduler import SimulatedClock
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = 1000
+
+
+class DeliveryReport(object):
+    """
+    Report of a series of deliveries: how many were made, received and read, and how long they took.
+    """
+
+    def __init__(self, deliveries=0, received=0, read=0, elapsed=0.0):
+        """
+        :param deliveries: Number of deliveries made.
+        :type deliveries: int
+        :param received: Number of deliveries received.
+        :type received: int
+        :param read: Number of deliveries read.
+        :type read: int
+        :param elapsed: Time in seconds that the deliveries took.
+        :type elapsed: float
+        """
+        self.deliveries = deliveries
+        self.received = received
+        self.read = read
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self):
+        """
+        Getter method for the delivery throughput.
+        :return: Number of deliveries per second.
+        :rtype: float
+        """
+        return self.deliveries / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        """
+        Representation method.
+        :return: Summary of the report.
+        :rtype: str
+        """
+        return (f'{self.deliveries} deliveries ({self.received} received, {self.read} read) in {self.elapsed:.3f} s: '
+                f'{self.throughput:.0f} deliveries/s')
+
+
+class LatencyTransport(object):
+    """
+    Fake transport that waits for a fixed latency before delegating the delivery to another transport.
+    """
+
+    def __init__(self, latency, transport):
+        """
+        :param latency: Time in seconds that every delivery takes.
+        :type latency: float
+        :param transport: Transport that decides the outcome of every delivery.
+        :type transport: function
+        """
+        self.latency = latency
+        self.transport = transport
+
+    async def __call__(self, user, message):
+        """
+        Delivers this message to this user after waiting for the latency.
+        :param user: The user to whom the message is delivered.
+        :type user: User
+        :param message: The message to deliver.
+        :type message: Message
+        :return: Whether the message was received and whether it was read.
+        :rtype: tuple
+        """
+        await asyncio.sleep(self.latency)
+        return await self.transport(user, message)
+
+
+class AsyncDeliverySystem(DeliverySystem):
+    """
+    Delivery system that delivers messages on an event loop through a pluggable asynchronous transport, with a bounded
+    number of deliveries in flight at the same time.
+    """
+    transport = None
+    _concurrency = CONCURRENCY
+    last_report = None
+
+    def __init__(self, loss_chance=LOSS_CHANCE, read_chance=READ_CHANCE, seed=None, transport=None,
+                 concurrency=CONCURRENCY, state=None, clock=None, retry_policy=None, deduplicator=None,
+                 retention_policy=None):
+        """
+        :param loss_chance: Chance (0-1) that a sent message will not be received.
+        :type loss_chance: float
+        :param read_chance: Chance (0-1) that a received message will be read.
+        :type read_chance: float
+        :param seed: Seed for the random streams of the system.
+        :type seed: int
+        :param transport: Coroutine function that delivers a message to a user and returns whether it was received and
+        whether it was read. By default, delivery is simulated with the loss and read chances.
+        :type transport: function
+        :param concurrency: Maximum number of deliveries in flight at the same time.
+        :type concurrency: int
+        :param state: Store where users, messages and their delivery state are kept. A new in-memory store is used if
+        not specified.
+        :type state: BaseDeliveryState
+        :param clock: Function that returns the current time in seconds, which scheduled deliveries are due by. A
+        simulated clock is used if not specified.
+        :type clock: function
+        :param retry_policy: Policy to retry lost deliveries with. Retries are scheduled and sent through the transport
+        by "arun_scheduled" or "adrain_scheduled". Lost deliveries are not retried if not specified.
+        :type retry_policy: RetryPolicy
+        :param deduplicator: Layer that drops repeated deliveries of a message to a user before they reach the inboxes.
+        Repeated deliveries are only detected by the inboxes if not specified.
+        :type deduplicator: BaseDeduplicator
+        :param retention_policy: Policy for the messages kept in inboxes, applied by "enforce_retention". Inboxes keep
+        every message if not specified.
+        :type retention_policy: RetentionPolicy
+        """
+        super().__init__(loss_chance=loss_chance, read_chance=read_chance, seed=seed, state=state, clock=clock,
+                         retry_policy=retry_policy, deduplicator=deduplicator, retention_policy=retention_policy)
+        self.transport = transport or self.simulate_delivery
+        self.concurrency = concurrency
+
+    @property
+    def concurrency(self):
+        """
+        Getter method for the maximum number of deliveries in flight at the same time.
+        :return: Maximum number of deliveries in flight.
+        :rtype: int
+        """
+        return self._concurrency
+
+    @concurrency.setter
+    def concurrency(self, concurrency):
+        """
+        Setter method for the maximum number of deliveries in flight that validates it before assignation.
+        :param concurrency: Maximum number of deliveries in flight at the same time.
+        :type concurrency: int
+        """
+        if not isinstance(concurrency, int) or isinstance(concurrency, bool):
+            raise TypeError('Concurrency must be an integer.')
+        if concurrency < 1:
+            raise ValueError('Concurrency must be a positive integer.')
+        self._concurrency = concurrency
+
+    async def simulate_delivery(self, user, message):
+        """
+        Default transport, which simulates the delivery of a message with the same random rolls as "send_message".
+        :param user: The user to whom the message is delivered.
+        :type user: User
+        :param message: The message to deliver.
+        :type message: Message
+        :return: Whether the message was received and whether it was read.
+        :rtype: tuple
+        """
+        loss_roll, read_roll = self._rng.random(), self._rng.random()
+        received = loss_roll > self._loss_chance
+        return received, received and read_roll < self._read_chance
+
+    async def _adeliver(self, user, message, attempt=1):
+        """
+        Delivers this message to this user through the transport and applies the outcome. A lost delivery is scheduled
+        to be retried if the retry policy allows it, and a repeated one is dropped if the system has a deduplicator.
+        :param user: The user to whom the message is delivered.
+        :type user: User
+        :param message: The message to deliver.
+        :type message: Message
+        :param attempt: Number of the delivery attempt, greater than 1 for retries.
+        :type attempt: int
+        :return: Whether the message was received and whether it was read. Repeated deliveries that are dropped are
+        neither.
+        :rtype: tuple
+        """
+        message.send(user=user)
+        self._stamp(message=message)
+        if attempt > 1:
+            self._retried[message.code] += 1
+        received, read = await self.transport(user, message)
+        if not received:
+            self._retry(message=message, user_codes=(user.code,), attempt=attempt)
+            return received, read
+        if self._deduplicator is not None and not self._deduplicator.add(
+                user_code=user.code, message_code=message.code, now=self._clock()):
+            return False, False
+        user.receive_message(message=message)
+        if read:
+            user.read_message(message=message)
+        return received, read
+
+    async def _adeliver_many(self, message, users, report, attempt=1):
+        """
+        Delivers this message to these users through the transport, with no more than "concurrency" deliveries in
+        flight at the same time, and adds their outcome to a report. If a delivery fails, the deliveries still in flight
+        are cancelled and the error is raised once they are done, keeping the outcome of the deliveries made so far.
+        :param message: The message to deliver.
+        :type message: Message
+        :param users: The users to whom the message is delivered.
+        :type users: iterable
+        :param report: Report the outcome of the deliveries is added to.
+        :type report: DeliveryReport
+        :param attempt: Number of the delivery attempt, greater than 1 for retries.
+        :type attempt: int
+        """
+        users = iter(users)
+
+        async def worker():
+            for user in users:
+                received, read = await self._adeliver(user=user, message=message, attempt=attempt)
+                report.deliveries += 1
+                report.received += received
+                report.read += read
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        done, pending = await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            task.result()
+
+    async def asend_message(self, user, message=None, body=None):
+        """
+        Sends this message to this user through the transport, creating it first if the message is not specified.
+        :param user: The user to whom the message will be sent.
+        :type user: User
+        :param message: The message to send. If not specified, a new one will be created.
+        :type message: Message
+        :param body: The body of the message if a new one is created. IF not specified, a random text will be set.
+        :type body: str
+        :return: The message that was sent.
+        :rtype: Message
+        """
+        if not self.is_registered_user(user=user):
+            raise ValueError(f'User {user} is not registered.')
+        message = message or self.create_message(body=body)
+        self._check_message(message=message)
+        self._refresh_tracer()
+        await self._adeliver(user=user, message=message)
+        self._state.flush()
+        return message
+
+    async def abroadcast_message(self, message=None, body=None):
+        """
+        Sends this message to every registered user through the transport, creating it first if the message is not
+        specified. No more than "concurrency" deliveries are in flight at the same time. A report of the broadcast is
+        kept in "last_report". If a delivery fails, the deliveries still in flight are cancelled and the error is
+        raised once they are done, keeping the outcome of the deliveries made so far.
+        :param message: The message to send. If not specified, a new one will be created.
+        :type message: Message
+        :param body: The body of the message if a new one is created. IF not specified, a random text will be set.
+        :type body: str
+        :return: The message that was sent.
+        :rtype: Message
+        """
+        message = message or self.create_message(body=body)
+        self._check_message(message=message)
+        self._refresh_tracer()
+        report = DeliveryReport()
+        start = time.perf_counter()
+        try:
+            await self._adeliver_many(message=message, users=self.users, report=report)
+        finally:
+            report.elapsed = time.perf_counter() - start
+            self._state.flush()
+        self.last_report = report
+        logger.info(f'Broadcasted message {message.code}: {report}.')
+        return message
+
+    def run_scheduled(self, until=None, batch=True):
+        """
+        Scheduled deliveries of an asynchronous system are made through its transport, so they can only be sent by
+        "arun_scheduled" or "adrain_scheduled", and calling this method, "tick" or "drain_scheduled" raises an error.
+        :param until: Ignored.
+        :type until: float
+        :param batch: Ignored.
+        :type batch: bool
+        """
+        raise TypeError('Scheduled deliveries of an asynchronous system are sent with arun_scheduled.')
+
+    async def arun_scheduled(self, until=None):
+        """
+        Sends the scheduled deliveries that are due through the transport, in order of time, with no more than
+        "concurrency" deliveries of every message in flight at the same time. Users that are no longer registered are
+        skipped.
+        :param until: Time up to which deliveries are due, in seconds of the system clock. Defaults to the current time.
+        :type until: float
+        :return: Number of deliveries sent.
+        :rtype: int
+        """
+        until = self._clock() if until is None else until
+        self._refresh_tracer()
+        report = DeliveryReport()
+        try:
+            for _, message_code, attempt, user_codes in self._scheduler.pop_due(until=until):
+                message = self._state.get_message(code=message_code)
+                users = [user for user in map(self._state.get_user, user_codes) if user is not None]
+                await self._adeliver_many(message=message, users=users, report=report, attempt=attempt)
+        finally:
+            self._state.flush()
+        return report.deliveries
+
+    async def adrain_scheduled(self):
+        """
+        Sends every scheduled delivery through the transport, including the retries scheduled along the way, moving the
+        simulated clock of the system forward to the time every batch is due.
+        :return: Number of deliveries sent.
+        :rtype: int
+        """
+        if not isinstance(self._clock, SimulatedClock):
+            raise TypeError('Only simulated clocks can be moved forward.')
+        delivered = 0
+        while self._scheduler.next_due() is not None:
+            self._clock.advance(max(0.0, self._scheduler.next_due() - self._clock()))
+            delivered += await self.arun_scheduled()
+        return delivered
@@ -0,0 +1,535 @@
+import asyncio
+import logging
+import argparse
+import random
+import timeit
+import tracemalloc
+
+import log
+from delivery import DeliverySystem
+from asynchronous import AsyncDeliverySystem, LatencyTransport
+from state import DeliveryState, STATUSES
+from user import User
+from scheduler import Scheduler
+from throttling import ThrottledDeliverySystem
+from retries import RetryPolicy
+from dedup import BloomDeduplicator, ExactDeduplicator
+from retention import RetentionPolicy
+
+NUM_USERS = 1000
+NUM_MESSAGES = 100
+MESSAGE_COUNTS = (10, 100, 1000, 10000, 50000)
+REPEAT = 5
+WORKER_COUNTS = (1, 2, 4, 8)
+LATENCY = 0.05
+CONCURRENCY = 100000
+SEGMENT_SHARE = 0.01
+SCHEDULED_PER_USER = 10
+SCHEDULE_HORIZON = 3600
+THROTTLE_RATE = 10000
+LOSS_CHANCES = (0.01, 0.05, 0.1, 0.3, 0.5)
+DEDUP_MESSAGES = 10
+ERROR_RATES = (0.01, 0.001, 0.0001)
+RETENTION_MESSAGES = 100
+RETENTION_INBOX = 10
+RETENTION_INTERVAL = 10
+
+
+def benchmark_broadcast(num_users=NUM_USERS, message_counts=MESSAGE_COUNTS, repeat=REPEAT):
+    """
+    Measures the time it takes to broadcast a message to every registered user as the number of messages already
+    created in the delivery system grows.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param message_counts: Numbers of existing messages to measure the broadcast with.
+    :type message_counts: tuple
+    :param repeat: Number of broadcasts measured for every message count. The best time is reported.
+    :type repeat: int
+    :return: Pairs of message count and best broadcast time in seconds.
+    :rtype: list
+    """
+    results = []
+    ds = DeliverySystem()
+    ds.register_users(n=num_users)
+    for message_count in message_counts:
+        for _ in range(message_count - ds._message_count):
+            ds.create_message()
+        best = min(timeit.repeat(ds.broadcast_message, number=1, repeat=repeat))
+        results.append((message_count, best))
+    return results
+
+
+def benchmark_batch(num_users=NUM_USERS, repeat=REPEAT):
+    """
+    Compares the time it takes to broadcast a message to every registered user one by one and in batch mode.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param repeat: Number of broadcasts measured for every mode. The best time is reported.
+    :type repeat: int
+    :return: Best broadcast time in seconds for the per-user and the batch modes.
+    :rtype: tuple
+    """
+    ds = DeliverySystem()
+    ds.register_users(n=num_users)
+    per_user = min(timeit.repeat(lambda: ds.broadcast_message(batch=False), number=1, repeat=repeat))
+    batch = min(timeit.repeat(lambda: ds.broadcast_message(batch=True), number=1, repeat=repeat))
+    return per_user, batch
+
+
+def benchmark_workers(num_users=NUM_USERS, worker_counts=WORKER_COUNTS):
+    """
+    Measures the time it takes to broadcast a message to every registered user in sharded mode with a growing number
+    of worker processes. Workers only draw the rolls of their shards and pack them into bitsets, while the message is
+    still stored in the inbox of every receiver by the main process, which takes most of the time of a broadcast. By
+    Amdahl's law the speedup is therefore bounded by the inverse of that serial share, well below the worker count.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param worker_counts: Numbers of worker processes to measure the broadcast with.
+    :type worker_counts: tuple
+    :return: Pairs of worker count and broadcast time in seconds.
+    :rtype: list
+    """
+    ds = DeliverySystem()
+    ds.register_users(n=num_users)
+    return [
+        (workers, timeit.timeit(lambda: ds.broadcast_message(workers=workers), number=1))
+        for workers in worker_counts
+    ]
+
+
+def benchmark_async(num_users=NUM_USERS, latency=LATENCY, concurrency=CONCURRENCY):
+    """
+    Measures the throughput of an asynchronous broadcast through a fake transport that takes a fixed latency for every
+    delivery.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param latency: Time in seconds that every delivery takes.
+    :type latency: float
+    :param concurrency: Maximum number of deliveries in flight at the same time.
+    :type concurrency: int
+    :return: Report of the broadcast.
+    :rtype: DeliveryReport
+    """
+    ds = AsyncDeliverySystem(concurrency=concurrency)
+    ds.transport = LatencyTransport(latency=latency, transport=ds.simulate_delivery)
+    ds.register_users(n=num_users)
+    asyncio.run(ds.abroadcast_message())
+    return ds.last_report
+
+
+def benchmark_register(num_users=NUM_USERS):
+    """
+    Compares the time it takes to register users one by one and all of them at once.
+    :param num_users: Number of users to register.
+    :type num_users: int
+    :return: Time in seconds to register the users one by one and in bulk.
+    :rtype: tuple
+    """
+    def register_one_by_one():
+        ds = DeliverySystem()
+        for _ in range(num_users):
+            ds.register_user()
+
+    per_user = timeit.timeit(register_one_by_one, number=1)
+    bulk = timeit.timeit(lambda: DeliverySystem().register_users(n=num_users), number=1)
+    return per_user, bulk
+
+
+def benchmark_models(num_users=NUM_USERS):
+    """
+    Compares the time it takes to create users through the public constructor, which validates every attribute, and
+    through the trusted path used by the delivery system, and measures the memory taken by every registered user.
+    :param num_users: Number of users to create.
+    :type num_users: int
+    :return: Time in seconds to create the users with validation and without it, and bytes per registered user.
+    :rtype: tuple
+    """
+    state = DeliveryState()
+    validated = timeit.timeit(
+        lambda: [User(name='John Doe', code=code, state=state) for code in range(num_users)], number=1
+    )
+    state = DeliveryState()
+    trusted = timeit.timeit(
+        lambda: [User._from_trusted(name='John Doe', code=code, state=state) for code in range(num_users)], number=1
+    )
+    names = ['John Doe'] * num_users
+    allocated = _measure_memory(lambda: DeliverySystem().register_users(n=num_users, names=names))
+    return validated, trusted, allocated / num_users
+
+
+def benchmark_segment(num_users=NUM_USERS, share=SEGMENT_SHARE, repeat=REPEAT):
+    """
+    Compares the time it takes to broadcast a message to every registered user and to send it to a segment with a
+    small share of them, both in batch mode.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param share: Share (0-1) of the registered users in the segment.
+    :type share: float
+    :param repeat: Number of sends measured for every audience. The best time is reported.
+    :type repeat: int
+    :return: Best time in seconds to broadcast the message and to send it to the segment.
+    :rtype: tuple
+    """
+    ds = DeliverySystem()
+    ds.register_users(n=num_users)
+    segment = ds.define_segment(name='segment', start=num_users // 2, stop=num_users // 2 + int(num_users * share))
+    broadcast = min(timeit.repeat(lambda: ds.broadcast_message(batch=True), number=1, repeat=repeat))
+    targeted = min(timeit.repeat(lambda: ds.send_to_segment(segment=segment, batch=True), number=1, repeat=repeat))
+    return broadcast, targeted
+
+
+def benchmark_views(num_users=NUM_USERS, repeat=REPEAT):
+    """
+    Measures the time it takes to read the sorted list of users to whom a message has been sent, the first time and when
+    it is read again without any change in between.
+    :param num_users: Number of users the message is sent to.
+    :type num_users: int
+    :param repeat: Number of reads measured. The best time is reported.
+    :type repeat: int
+    :return: Time in seconds of the first read and best time of the following reads.
+    :rtype: tuple
+    """
+    ds = DeliverySystem()
+    ds.register_users(n=num_users)
+    message = ds.broadcast_message(batch=True)
+    first = timeit.timeit(lambda: message.users_sent, number=1)
+    cached = min(timeit.repeat(lambda: message.users_sent, number=1, repeat=repeat))
+    return first, cached
+
+
+def benchmark_schedule(num_users=NUM_USERS, per_user=SCHEDULED_PER_USER, horizon=SCHEDULE_HORIZON,
+                       num_messages=NUM_MESSAGES):
+    """
+    Measures the time and memory it takes to schedule deliveries of random messages to every user at random times,
+    and the throughput of ticking the simulated clock one second at a time until all of them are sent.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param per_user: Number of deliveries scheduled per registered user.
+    :type per_user: int
+    :param horizon: Number of seconds the deliveries are scheduled over.
+    :type horizon: int
+    :param num_messages: Number of messages scheduled.
+    :type num_messages: int
+    :return: Number of scheduled deliveries, time in seconds to schedule them, bytes per pending delivery, and time in
+    seconds to tick through the horizon.
+    :rtype: tuple
+    """
+    ds = DeliverySystem(seed=1)
+    users = ds.register_users(n=num_users)
+    messages = ds.create_messages(n=num_messages)
+    rng = random.Random(1)
+    num_deliveries = num_users * per_user
+    deliveries = [(message, rng.uniform(0, horizon), user)
+                  for user in users for message in rng.sample(messages, per_user)]
+    rng.shuffle(deliveries)
+
+    def schedule():
+        for message, at, user in deliveries:
+            ds.schedule_message(message=message, at=at, user=user)
+
+    def build_scheduler():
+        scheduler = Scheduler()
+        for message, at, user in deliveries:
+            scheduler.schedule(at=at, message_code=message.code, user_codes=(user.code,))
+        return scheduler
+
+    scheduled = timeit.timeit(schedule, number=1)
+    allocated = _measure_memory(build_scheduler)
+    ticks = timeit.timeit(lambda: [ds.tick(seconds=1) for _ in range(horizon)], number=1)
+    return num_deliveries, scheduled, allocated / num_deliveries, ticks
+
+
+def benchmark_throttle(num_users=NUM_USERS, rate=THROTTLE_RATE):
+    """
+    Measures how long a broadcast to every registered user takes at a limited delivery rate on the simulated clock,
+    and the time it takes to simulate it.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param rate: Maximum number of deliveries per second.
+    :type rate: float
+    :return: Report of the throttled broadcast and time in seconds to simulate it.
+    :rtype: tuple
+    """
+    ds = ThrottledDeliverySystem(rate=rate)
+    ds.register_users(n=num_users)
+    start = timeit.default_timer()
+    ds.broadcast_message(batch=True)
+    report = ds.drain()
+    return report, timeit.default_timer() - start
+
+
+def benchmark_retry(num_users=NUM_USERS, loss_chances=LOSS_CHANCES):
+    """
+    Measures the redelivery load that retrying lost deliveries with the default retry policy creates for a broadcast
+    to every registered user, for several loss chances.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param loss_chances: Loss chances to measure the retries with.
+    :type loss_chances: tuple
+    :return: Loss chance, number of retries, number of deliveries still lost after the last attempt, simulated time
+    in seconds until every retry was sent, and time in seconds to simulate the broadcast and its retries.
+    :rtype: list
+    """
+    results = []
+    for loss_chance in loss_chances:
+        ds = DeliverySystem(loss_chance=loss_chance, seed=1, retry_policy=RetryPolicy())
+        ds.register_users(n=num_users)
+        start = timeit.default_timer()
+        ds.broadcast_message(batch=True)
+        ds.drain_scheduled()
+        elapsed = timeit.default_timer() - start
+        record = next(ds.iter_statistics())
+        results.append((loss_chance, record.attempts - record.sent, record.sent - record.received, ds.clock(), elapsed))
+    return results
+
+
+def benchmark_dedup(num_users=NUM_USERS, num_messages=DEDUP_MESSAGES, error_rates=ERROR_RATES):
+    """
+    Measures the cost and the actual false positive rate of checking deliveries for repetition, with an exact
+    deduplicator and with rolling Bloom filters sized for a broadcast to every registered user. Every delivery is new,
+    so every one reported as repeated is a false positive.
+    :param num_users: Number of users every message is delivered to.
+    :type num_users: int
+    :param num_messages: Number of messages delivered to every user.
+    :type num_messages: int
+    :param error_rates: Error rates to size the Bloom filters with.
+    :type error_rates: tuple
+    :return: Configured error rate (None for the exact deduplicator), measured false positive rate, memory in bytes
+    and time in seconds per delivery checked.
+    :rtype: list
+    """
+    deduplicators = [(None, ExactDeduplicator())]
+    deduplicators.extend((error_rate, BloomDeduplicator(capacity=num_users, error_rate=error_rate))
+                         for error_rate in error_rates)
+    results = []
+    for error_rate, deduplicator in deduplicators:
+        start = timeit.default_timer()
+        for message_code in range(num_messages):
+            deduplicator.add_many(user_codes=range(num_users), message_code=message_code)
+        elapsed = timeit.default_timer() - start
+        results.append((error_rate, deduplicator.duplicates / deduplicator.checked, deduplicator.nbytes,
+                        elapsed / deduplicator.checked))
+    return results
+
+
+def benchmark_retention(num_users=NUM_USERS, num_messages=RETENTION_MESSAGES, max_messages=RETENTION_INBOX,
+                        interval=RETENTION_INTERVAL):
+    """
+    Compares the memory held by a delivery system after broadcasting many messages to every registered user, with
+    inboxes that keep every message and with inboxes limited to a number of messages, where the retention policy is
+    enforced every few broadcasts. The time every enforcement takes is measured in a run without memory tracing.
+    :param num_users: Number of users registered in the delivery system.
+    :type num_users: int
+    :param num_messages: Number of messages to broadcast.
+    :type num_messages: int
+    :param max_messages: Maximum number of messages of every inbox.
+    :type max_messages: int
+    :param interval: Number of broadcasts between enforcements of the retention policy.
+    :type interval: int
+    :return: Allocated memory in bytes without and with retention, and time in seconds per enforcement.
+    :rtype: tuple
+    """
+    enforcements = []
+
+    def simulate(policy, timed=False):
+        ds = DeliverySystem(seed=1, retention_policy=policy)
+        ds.register_users(n=num_users)
+        for index in range(1, num_messages + 1):
+            ds.broadcast_message(batch=True)
+            if index % interval == 0:
+                start = timeit.default_timer()
+                ds.enforce_retention()
+                if timed:
+                    enforcements.append(timeit.default_timer() - start)
+        return ds
+
+    policy = RetentionPolicy(max_messages=max_messages)
+    unlimited = _measure_memory(lambda: simulate(policy=None))
+    limited = _measure_memory(lambda: simulate(policy=policy))
+    simulate(policy=policy, timed=True)
+    return unlimited, limited, sum(enforcements) / len(enforcements)
+
+
+def _measure_memory(build):
+    """
+    Measures the memory allocated by a function while it runs, keeping its result alive until it has been measured.
+    :param build: Function that builds the structure to measure.
+    :type build: function
+    :return: Allocated memory in bytes.
+    :rtype: int
+    """
+    tracemalloc.start()
+    result = build()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return allocated
+
+
+def benchmark_memory(num_users=NUM_USERS, num_messages=NUM_MESSAGES):
+    """
+    Compares the memory used to store the delivery state of every user and message, with every message sent, received
+    and read by every user, in the former layout of Python sets of objects and in the columnar delivery state store.
+    :param num_users: Number of users.
+    :type num_users: int
+    :param num_messages: Number of messages.
+    :type num_messages: int
+    :return: Allocated memory in bytes for the set layout and the columnar layout.
+    :rtype: tuple
+    """
+    users = [object() for _ in range(num_users)]
+    messages = [object() for _ in range(num_messages)]
+
+    def build_sets():
+        columns = [[set(users) for _ in STATUSES] for _ in messages]
+        inboxes = [set(messages) for _ in users]
+        return columns, inboxes
+
+    def build_columns():
+        state = DeliveryState()
+        for message_code in range(1, num_messages + 1):
+            for status in STATUSES:
+                state.mark(status=status, message_code=message_code, user_codes=range(1, num_users + 1))
+            for user_code in range(1, num_users + 1):
+                state.add_to_inbox(user_code=user_code, message_code=message_code)
+        return state
+
+    return _measure_memory(build_sets), _measure_memory(build_columns)
+
+
+def report_broadcast(num_users):
+    logging.info(f'Broadcasting to {num_users} users with a growing number of existing messages...')
+    for message_count, seconds in benchmark_broadcast(num_users=num_users):
+        logging.info(f'{message_count:>8} messages: {seconds * 1000:.2f} ms per broadcast.')
+
+
+def report_batch(num_users):
+    logging.info(f'Broadcasting to {num_users} users one by one and in batch mode...')
+    per_user, batch = benchmark_batch(num_users=num_users)
+    logging.info(f'Per-user broadcast: {per_user:.3f} s. Batch broadcast: {batch:.3f} s ({per_user / batch:.1f}x).')
+
+
+def report_memory(num_users):
+    logging.info(f'Storing the delivery state of {num_users} users and {NUM_MESSAGES} messages...')
+    sets, columns = benchmark_memory(num_users=num_users)
+    logging.info(f'Set layout: {sets / 2 ** 20:.2f} MiB. Columnar layout: {columns / 2 ** 20:.2f} MiB '
+                 f'({sets / columns:.1f}x).')
+
+
+def report_workers(num_users):
+    logging.info(f'Broadcasting to {num_users} users in sharded mode with a growing number of workers...')
+    for workers, seconds in benchmark_workers(num_users=num_users):
+        logging.info(f'{workers:>4} workers: {seconds:.3f} s per broadcast.')
+
+
+def report_async(num_users):
+    logging.info(f'Broadcasting asynchronously to {num_users} users with up to {CONCURRENCY} deliveries in flight, '
+                 f'{LATENCY * 1000:.0f} ms each...')
+    logging.info(f'{benchmark_async(num_users=num_users)}.')
+
+
+def report_register(num_users):
+    logging.info(f'Registering {num_users} users one by one and in bulk...')
+    per_user, bulk = benchmark_register(num_users=num_users)
+    logging.info(f'Per-user registration: {per_user:.3f} s. Bulk registration: {bulk:.3f} s ({per_user / bulk:.1f}x).')
+
+
+def report_models(num_users):
+    logging.info(f'Creating {num_users} users with and without validation...')
+    validated, trusted, per_user = benchmark_models(num_users=num_users)
+    logging.info(f'Validated: {validated / num_users * 1e6:.2f} us per user. '
+                 f'Trusted: {trusted / num_users * 1e6:.2f} us per user ({validated / trusted:.1f}x). '
+                 f'Memory: {per_user:.0f} bytes per registered user.')
+
+
+def report_segment(num_users):
+    logging.info(f'Sending to {num_users} users and to a segment with {SEGMENT_SHARE:.0%} of them...')
+    broadcast, segment = benchmark_segment(num_users=num_users)
+    logging.info(f'Broadcast: {broadcast:.3f} s. Segment: {segment:.3f} s ({broadcast / segment:.1f}x).')
+
+
+def report_views(num_users):
+    logging.info(f'Reading the users a message has been sent to, out of {num_users} users...')
+    first, cached = benchmark_views(num_users=num_users)
+    logging.info(f'First read: {first * 1000:.3f} ms. Cached reads: {cached * 1000:.3f} ms.')
+
+
+def report_schedule(num_users):
+    logging.info(f'Scheduling {SCHEDULED_PER_USER} deliveries per user to {num_users} users over '
+                 f'{SCHEDULE_HORIZON} seconds...')
+    num_deliveries, scheduled, per_delivery, ticks = benchmark_schedule(num_users=num_users)
+    logging.info(f'Scheduling: {scheduled / num_deliveries * 1e6:.2f} us per delivery, '
+                 f'{per_delivery:.0f} bytes per pending delivery. Ticks: {SCHEDULE_HORIZON / ticks:.0f} ticks/s, '
+                 f'{num_deliveries / ticks:.0f} deliveries/s.')
+
+
+def report_throttle(num_users):
+    logging.info(f'Broadcasting to {num_users} users at {THROTTLE_RATE} deliveries/s...')
+    report, simulated = benchmark_throttle(num_users=num_users)
+    logging.info(f'Broadcast time: {report.elapsed:.1f} s ({report.throughput:.0f} deliveries/s, max queue depth '
+                 f'{report.max_queue_depth}). Simulated in {simulated:.3f} s.')
+
+
+def report_retry(num_users):
+    logging.info(f'Broadcasting to {num_users} users and retrying lost deliveries...')
+    for loss_chance, retries, lost, settled, elapsed in benchmark_retry(num_users=num_users):
+        logging.info(f'Loss chance {loss_chance:.0%}: {retries} retries ({retries / num_users:.2%} extra load), '
+                     f'{lost} deliveries lost for good, settled after {settled:.0f} s. Simulated in {elapsed:.3f} s.')
+
+
+def report_dedup(num_users):
+    logging.info(f'Checking {DEDUP_MESSAGES} deliveries per user to {num_users} users for repetition...')
+    for error_rate, measured, nbytes, per_check in benchmark_dedup(num_users=num_users):
+        name = 'Exact' if error_rate is None else f'Bloom filter ({error_rate:.2%} error rate)'
+        logging.info(f'{name}: {measured:.4%} false positives, {nbytes / 2 ** 20:.2f} MiB, '
+                     f'{per_check * 1e6:.2f} us per delivery.')
+
+
+def report_retention(num_users):
+    logging.info(f'Broadcasting {RETENTION_MESSAGES} messages to {num_users} users, keeping every message and keeping '
+                 f'the last {RETENTION_INBOX} of every inbox...')
+    unlimited, limited, per_enforcement = benchmark_retention(num_users=num_users)
+    logging.info(f'Every message: {unlimited / 2 ** 20:.2f} MiB. Last {RETENTION_INBOX} messages: '
+                 f'{limited / 2 ** 20:.2f} MiB ({unlimited / limited:.1f}x). Enforcing the policy every '
+                 f'{RETENTION_INTERVAL} broadcasts takes {per_enforcement:.3f} s.')
+
+
+BENCHMARKS = {
+    'broadcast': report_broadcast,
+    'batch': report_batch,
+    'workers': report_workers,
+    'async': report_async,
+    'memory': report_memory,
+    'views': report_views,
+    'register': report_register,
+    'models': report_models,
+    'segment': report_segment,
+    'schedule': report_schedule,
+    'throttle': report_throttle,
+    'retry': report_retry,
+    'dedup': report_dedup,
+    'retention': report_retention,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Notification Simulator Benchmarks',
+        description='Performance benchmarks for the notification simulator.'
+    )
+
+    parser.add_argument('-b', '--benchmark', action='append', choices=BENCHMARKS.keys(),
+                        help='Benchmark to run. Can be repeated. Defaults to all of them.')
+    parser.add_argument('-u', '--numusers', type=int, default=NUM_USERS,
+                        help=f'Number of users to register. Defaults to {NUM_USERS}.')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=log.LOG_FORMAT, datefmt=log.DATETIME_FORMAT)
+
+    for name in args.benchmark or BENCHMARKS.keys():
+        BENCHMARKS[name](num_users=args.numusers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,632 @@
+import sqlite3
+from array import array
+from itertools import islice
+from weakref import WeakValueDictionary
+
+from user import User
+from message import Message
+from state import BaseDeliveryState, STATUSES, READ
+from text import LazyText
+
+DATABASE = ':memory:'
+BATCH_SIZE = 500
+INFINITE_CODE = 2 ** 63 - 1
+STATUS_IDS = {status: index for index, status in enumerate(STATUSES)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    code INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    code INTEGER PRIMARY KEY,
+    body TEXT,
+    words BLOB
+);
+CREATE TABLE IF NOT EXISTS receipts (
+    message_code INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    user_code INTEGER NOT NULL,
+    PRIMARY KEY (message_code, status, user_code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS receipt_counts (
+    message_code INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (message_code, status)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS inboxes (
+    user_code INTEGER NOT NULL,
+    message_code INTEGER NOT NULL,
+    read INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_code, message_code)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS unread_inboxes ON inboxes (user_code, message_code) WHERE read = 0;
+CREATE INDEX IF NOT EXISTS message_inboxes ON inboxes (message_code);
+CREATE TABLE IF NOT EXISTS inbox_evictions (
+    user_code INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS first_deliveries (
+    message_code INTEGER PRIMARY KEY,
+    time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS released_messages (
+    message_code INTEGER PRIMARY KEY
+);
+"""
+
+STATISTICS_QUERY = """
+SELECT messages.code, messages.body, messages.words,
+    COALESCE(SUM(CASE WHEN receipt_counts.status = 0 THEN receipt_counts.count END), 0),
+    COALESCE(SUM(CASE WHEN receipt_counts.status = 1 THEN receipt_counts.count END), 0),
+    COALESCE(SUM(CASE WHEN receipt_counts.status = 2 THEN receipt_counts.count END), 0)
+FROM messages LEFT JOIN receipt_counts ON receipt_counts.message_code = messages.code
+GROUP BY messages.code
+ORDER BY messages.code
+"""
+
+
+def _batches(values, size):
+    """
+    Splits values into lists of up to this size.
+    :param values: Values to split.
+    :type values: iterable
+    :param size: Maximum size of every list.
+    :type size: int
+    :return: Lists of values.
+    :rtype: generator
+    """
+    values = iter(values)
+    batch = list(islice(values, size))
+    while batch:
+        yield batch
+        batch = list(islice(values, size))
+
+
+class SQLiteState(BaseDeliveryState):
+    """
+    Store that keeps users, messages, delivery receipts and inboxes in a SQLite database, so that populations larger
+    than memory can be simulated and statistics can be computed with SQL aggregates. Receipts and inboxes are tables
+    clustered by their primary keys, which index every lookup the delivery system makes, and the number of receipts of
+    every message and status is kept up to date in a table of its own. The database runs in WAL mode and inserts are
+    batched with "executemany", while changes are committed when the delivery system flushes the store after every
+    operation. Evicted inbox rows are deleted and released messages lose their receipts, while their counts are kept.
+    The time every message was first delivered is stored too, and cached in memory since it is checked on every
+    delivery. User and message objects are built from their rows on demand and shared while they are in use.
+    """
+    _connection = None
+    _users = None
+    _messages = None
+    _first_sent = None
+
+    def __init__(self, path=DATABASE, tracer=None):
+        """
+        :param path: Path of the database file. A new database is created if it does not exist, and a database in
+        memory is used by default.
+        :type path: str
+        :param tracer: Function called with every delivery event of the users and messages of the store.
+        :type tracer: function
+        """
+        self.tracer = tracer
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.executescript(SCHEMA)
+        self._users = WeakValueDictionary()
+        self._messages = WeakValueDictionary()
+        self._first_sent = dict(self._connection.execute(
+            'SELECT message_code, time FROM first_deliveries ORDER BY time, message_code'
+        ))
+
+    def _changes(self, statement, rows):
+        """
+        Executes a statement for many rows at once.
+        :param statement: SQL statement.
+        :type statement: str
+        :param rows: Parameters of the statement for every row.
+        :type rows: iterable
+        :return: Number of rows changed.
+        :rtype: int
+        """
+        before = self._connection.total_changes
+        self._connection.executemany(statement, rows)
+        return self._connection.total_changes - before
+
+    def _scalar(self, query, *parameters):
+        """
+        Runs a query that returns a single value.
+        :param query: SQL query.
+        :type query: str
+        :param parameters: Parameters of the query.
+        :type parameters: object
+        :return: The value, or None if the query returns no rows.
+        :rtype: object
+        """
+        row = self._connection.execute(query, parameters).fetchone()
+        return row[0] if row is not None else None
+
+    def _load_user(self, code, name):
+        """
+        Retrieves the user of a row, building it unless it is already in use.
+        :param code: Code of the user.
+        :type code: int
+        :param name: Name of the user.
+        :type name: str
+        :return: The user.
+        :rtype: User
+        """
+        user = self._users.get(code)
+        if user is None:
+            user = self._users[code] = User._from_trusted(name=name, code=code, state=self, register=False)
+        return user
+
+    def _load_message(self, code, body, words):
+        """
+        Retrieves the message of a row, building it unless it is already in use.
+        :param code: Code of the message.
+        :type code: int
+        :param body: Body of the message, unless it is a lazily built text.
+        :type body: str
+        :param words: Word indexes of the body of the message, if it is a lazily built text.
+        :type words: bytes
+        :return: The message.
+        :rtype: Message
+        """
+        message = self._messages.get(code)
+        if message is None:
+            body = LazyText(words) if words is not None else body
+            message = self._messages[code] = Message._from_trusted(body=body, code=code, state=self, register=False)
+        return message
+
+    @staticmethod
+    def _message_row(message):
+        """
+        Builds the row of a message, storing its body either as text or as the word indexes of a lazily built text.
+        :param message: Message to store.
+        :type message: Message
+        :return: Code, text body and word indexes of the message.
+        :rtype: tuple
+        """
+        body = message._body
+        return (message.code, None, body) if isinstance(body, LazyText) else (message.code, body, None)
+
+    def add_user(self, user):
+        """
+        Adds a user to the store, unless there is already a user with the same code.
+        :param user: User to add.
+        :type user: User
+        """
+        if self._users.get(user.code) is user:
+            return
+        if self._changes('INSERT OR IGNORE INTO users (code, name) VALUES (?, ?)', ((user.code, user.name),)):
+            self._users[user.code] = user
+
+    def add_users(self, users):
+        """
+        Adds several users to the store at once. Their codes must not be in the store yet.
+        :param users: Users to add.
+        :type users: list
+        """
+        self._changes('INSERT INTO users (code, name) VALUES (?, ?)', ((user.code, user.name) for user in users))
+        self._users.update((user.code, user) for user in users)
+
+    def get_user(self, code):
+        """
+        Retrieves a user of the store by its code.
+        :param code: Code of the user.
+        :type code: int
+        :return: The user with this code, or None if there is no such user.
+        :rtype: User
+        """
+        user = self._users.get(code)
+        if user is not None:
+            return user
+        row = self._connection.execute('SELECT code, name FROM users WHERE code = ?', (code,)).fetchone()
+        return self._load_user(*row) if row is not None else None
+
+    def users(self):
+        """
+        Retrieves every user of the store.
+        :return: Users of the store, ordered by their code.
+        :rtype: list
+        """
+        rows = self._connection.execute('SELECT code, name FROM users ORDER BY code')
+        return [self._load_user(code, name) for code, name in rows]
+
+    def add_message(self, message):
+        """
+        Adds a message to the store, unless there is already a message with the same code.
+        :param message: Message to add.
+        :type message: Message
+        """
+        if self._messages.get(message.code) is message:
+            return
+        if self._changes('INSERT OR IGNORE INTO messages (code, body, words) VALUES (?, ?, ?)',
+                         (self._message_row(message),)):
+            self._messages[message.code] = message
+
+    def add_messages(self, messages):
+        """
+        Adds several messages to the store at once. Their codes must not be in the store yet.
+        :param messages: Messages to add.
+        :type messages: list
+        """
+        self._changes('INSERT INTO messages (code, body, words) VALUES (?, ?, ?)', map(self._message_row, messages))
+        self._messages.update((message.code, message) for message in messages)
+
+    def get_message(self, code):
+        """
+        Retrieves a message of the store by its code.
+        :param code: Code of the message.
+        :type code: int
+        :return: The message with this code, or None if there is no such message.
+        :rtype: Message
+        """
+        message = self._messages.get(code)
+        if message is not None:
+            return message
+        row = self._connection.execute('SELECT code, body, words FROM messages WHERE code = ?', (code,)).fetchone()
+        return self._load_message(*row) if row is not None else None
+
+    def messages(self):
+        """
+        Retrieves every message of the store.
+        :return: Messages of the store, ordered by their code.
+        :rtype: list
+        """
+        return list(self.iter_messages())
+
+    def iter_messages(self):
+        """
+        Iterates over every message of the store without building a list, streaming their rows from the database.
+        :return: Messages of the store, ordered by their code.
+        :rtype: iterator
+        """
+        rows = self._connection.execute('SELECT code, body, words FROM messages ORDER BY code')
+        return (self._load_message(*row) for row in rows)
+
+    def last_codes(self):
+        """
+        Retrieves the highest codes in the store, so that a delivery system can go on assigning codes after them.
+        :return: Highest user code and highest message code, or zero if there are none.
+        :rtype: tuple
+        """
+        return (self._scalar('SELECT COALESCE(MAX(code), 0) FROM users'),
+                self._scalar('SELECT COALESCE(MAX(code), 0) FROM messages'))
+
+    def mark(self, status, message_code, user_codes):
+        """
+        Sets this delivery status of a message for several users. The inbox rows of the users are flagged as read
+        along with read statuses.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_codes: Codes of the users.
+        :type user_codes: iterable | Bitmap
+        """
+        status_id = STATUS_IDS[status]
+        if status == READ:
+            user_codes = list(user_codes)
+            self._changes('UPDATE inboxes SET read = 1 WHERE user_code = ? AND message_code = ? AND read = 0',
+                          ((user_code, message_code) for user_code in user_codes))
+        added = self._changes(
+            'INSERT OR IGNORE INTO receipts (message_code, status, user_code) VALUES (?, ?, ?)',
+            ((message_code, status_id, user_code) for user_code in user_codes)
+        )
+        if added:
+            self._connection.execute(
+                'INSERT INTO receipt_counts (message_code, status, count) VALUES (?, ?, ?) '
+                'ON CONFLICT (message_code, status) DO UPDATE SET count = count + excluded.count',
+                (message_code, status_id, added)
+            )
+
+    def count(self, status, message_code):
+        """
+        Retrieves the number of users for whom a message has this delivery status.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users.
+        :rtype: int
+        """
+        return self._scalar(
+            'SELECT count FROM receipt_counts WHERE message_code = ? AND status = ?', message_code, STATUS_IDS[status]
+        ) or 0
+
+    def has_all(self, status, message_code, user_codes):
+        """
+        Checks this delivery status of a message for several users.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_codes: Codes of the users.
+        :type user_codes: Bitmap
+        :return: Whether the message has this status for all of the users.
+        :rtype: bool
+        """
+        for batch in _batches(user_codes, BATCH_SIZE):
+            found = self._scalar(
+                f'SELECT COUNT(*) FROM receipts WHERE message_code = ? AND status = ? '
+                f'AND user_code IN ({", ".join("?" * len(batch))})',
+                message_code, STATUS_IDS[status], *batch
+            )
+            if found < len(batch):
+                return False
+        return True
+
+    def has(self, status, message_code, user_code):
+        """
+        Checks this delivery status of a message for a user.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Whether the message has this status for the user.
+        :rtype: bool
+        """
+        return self._scalar(
+            'SELECT 1 FROM receipts WHERE message_code = ? AND status = ? AND user_code = ?',
+            message_code, STATUS_IDS[status], user_code
+        ) is not None
+
+    def user_codes(self, status, message_code):
+        """
+        Retrieves the codes of the users for whom a message has this delivery status.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: User codes, in ascending order.
+        :rtype: iterator
+        """
+        rows = self._connection.execute(
+            'SELECT user_code FROM receipts WHERE message_code = ? AND status = ? ORDER BY user_code',
+            (message_code, STATUS_IDS[status])
+        )
+        return (user_code for user_code, in rows)
+
+    def add_to_inbox(self, user_code, message_code):
+        """
+        Stores a message code in the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: False if the message was already in the inbox, True otherwise.
+        :rtype: bool
+        """
+        return self.add_to_inboxes(user_codes=(user_code,), message_code=message_code) == 1
+
+    def add_to_inboxes(self, user_codes, message_code):
+        """
+        Stores a message code in the inbox of several users.
+        :param user_codes: Codes of the users.
+        :type user_codes: iterable
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users that did not have the message in their inbox yet.
+        :rtype: int
+        """
+        return self._changes(
+            'INSERT OR IGNORE INTO inboxes (user_code, message_code, read) VALUES (?1, ?2, EXISTS ('
+            'SELECT 1 FROM receipts WHERE message_code = ?2 AND status = ?3 AND user_code = ?1))',
+            ((user_code, message_code, STATUS_IDS[READ]) for user_code in user_codes)
+        )
+
+    def in_inbox(self, user_code, message_code):
+        """
+        Checks if a message code is stored in the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Whether the message is in the inbox.
+        :rtype: bool
+        """
+        return self._scalar(
+            'SELECT 1 FROM inboxes WHERE user_code = ? AND message_code = ?', user_code, message_code
+        ) is not None
+
+    def inbox(self, user_code):
+        """
+        Retrieves the message codes stored in the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Message codes, in ascending order.
+        :rtype: array.array
+        """
+        rows = self._connection.execute(
+            'SELECT message_code FROM inboxes WHERE user_code = ? ORDER BY message_code', (user_code,)
+        )
+        return array('q', (message_code for message_code, in rows))
+
+    def unread_inbox(self, user_code):
+        """
+        Retrieves the codes of the messages in the inbox of a user that the user has not read yet.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Message codes, in ascending order.
+        :rtype: array.array
+        """
+        rows = self._connection.execute(
+            'SELECT message_code FROM inboxes WHERE user_code = ? AND read = 0 ORDER BY message_code', (user_code,)
+        )
+        return array('q', (message_code for message_code, in rows))
+
+    def unread_count(self, user_code):
+        """
+        Retrieves the number of messages in the inbox of a user that the user has not read yet.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Number of unread messages.
+        :rtype: int
+        """
+        return self._scalar('SELECT COUNT(*) FROM inboxes WHERE user_code = ? AND read = 0', user_code)
+
+    def iter_inbox(self, user_code, before_code=None, unread=False):
+        """
+        Iterates over the message codes stored in the inbox of a user from newest to oldest. The first one is found with
+        a binary search, since inboxes are sorted, and the rest are retrieved lazily.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param before_code: If set, only message codes lower than this one are retrieved.
+        :type before_code: int
+        :param unread: Whether to only retrieve the messages that the user has not read yet.
+        :type unread: bool
+        :return: Message codes, in descending order.
+        :rtype: generator
+        """
+        rows = self._connection.execute(
+            f'SELECT message_code FROM inboxes WHERE user_code = ? AND message_code < ?'
+            f'{" AND read = 0" if unread else ""} ORDER BY message_code DESC',
+            (user_code, before_code if before_code is not None else INFINITE_CODE)
+        )
+        return (message_code for message_code, in rows)
+
+    def evict(self, evictions):
+        """
+        Removes messages from the inboxes of several users at once, together with their unread status. The delivery
+        status of the messages is kept.
+        :param evictions: Codes of the messages to remove from the inbox of every user, by user code.
+        :type evictions: dict
+        :return: Number of messages removed from the inboxes.
+        :rtype: int
+        """
+        evicted = 0
+        for user_code, message_codes in evictions.items():
+            removed = self._changes('DELETE FROM inboxes WHERE user_code = ? AND message_code = ?',
+                                    ((user_code, message_code) for message_code in message_codes))
+            if not removed:
+                continue
+            self._connection.execute(
+                'INSERT INTO inbox_evictions (user_code, count) VALUES (?, ?) '
+                'ON CONFLICT (user_code) DO UPDATE SET count = count + excluded.count',
+                (user_code, removed)
+            )
+            evicted += removed
+            user = self._users.get(user_code)
+            if user is not None:
+                user._views = None
+        return evicted
+
+    def evict_messages(self, message_codes):
+        """
+        Removes messages from the inboxes of every user that has them.
+        :param message_codes: Codes of the messages.
+        :type message_codes: iterable
+        :return: Number of messages removed from the inboxes.
+        :rtype: int
+        """
+        evictions = {}
+        for batch in _batches(message_codes, BATCH_SIZE):
+            rows = self._connection.execute(
+                f'SELECT user_code, message_code FROM inboxes WHERE message_code IN ({", ".join("?" * len(batch))})',
+                batch
+            )
+            for user_code, message_code in rows:
+                evictions.setdefault(user_code, []).append(message_code)
+        return self.evict(evictions=evictions)
+
+    def evicted(self, user_code):
+        """
+        Retrieves the number of messages ever removed from the inbox of a user, so that inbox views can tell an inbox
+        that lost some messages and received others apart from an unchanged one.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Number of messages removed.
+        :rtype: int
+        """
+        return self._scalar('SELECT count FROM inbox_evictions WHERE user_code = ?', user_code) or 0
+
+    def inbox_count(self, message_code):
+        """
+        Retrieves the number of inboxes a message is stored in.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users with the message in their inbox.
+        :rtype: int
+        """
+        return self._scalar('SELECT COUNT(*) FROM inboxes WHERE message_code = ?', message_code)
+
+    def release(self, message_codes):
+        """
+        Releases the delivery state of several messages for every user, keeping the number of users with each status,
+        so that statistics do not change, and drops their cached views and the time they were first delivered.
+        Messages should not be in any inbox anymore.
+        :param message_codes: Codes of the messages.
+        :type message_codes: iterable
+        """
+        rows = [(message_code,) for message_code in message_codes]
+        self._changes('DELETE FROM receipts WHERE message_code = ?', rows)
+        self._changes('DELETE FROM inboxes WHERE message_code = ?', rows)
+        self._changes('DELETE FROM first_deliveries WHERE message_code = ?', rows)
+        self._changes('INSERT OR IGNORE INTO released_messages (message_code) VALUES (?)', rows)
+        for message_code, in rows:
+            self._first_sent.pop(message_code, None)
+            message = self._messages.get(message_code)
+            if message is not None:
+                message._views = None
+
+    def is_released(self, message_code):
+        """
+        Checks if a message has been released.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Whether the message was released.
+        :rtype: bool
+        """
+        return self._scalar('SELECT 1 FROM released_messages WHERE message_code = ?', message_code) is not None
+
+    def stamp(self, message_code, now):
+        """
+        Records the time a message is first delivered, which its age is measured from, unless it is already recorded.
+        Only the cache is checked on later deliveries, so the time is stored once per message.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param now: Current time in seconds.
+        :type now: float
+        """
+        if message_code not in self._first_sent:
+            self._first_sent[message_code] = now
+            self._connection.execute(
+                'INSERT OR IGNORE INTO first_deliveries (message_code, time) VALUES (?, ?)', (message_code, now)
+            )
+
+    def first_sent(self):
+        """
+        Retrieves the time every message that was not released was first delivered, from the cache of the stored
+        times.
+        :return: Times in seconds by message code, in the order they were recorded.
+        :rtype: dict
+        """
+        return self._first_sent
+
+    def iter_statistics(self):
+        """
+        Iterates over the delivery statistics of every message of the store, streamed from a single aggregate query over
+        the receipt counts.
+        :return: Code, body and number of users the message has been sent to, received by and read by, for every
+        message ordered by code.
+        :rtype: iterator
+        """
+        for code, body, words, sent, received, read in self._connection.execute(STATISTICS_QUERY):
+            yield code, str(LazyText(words)) if words is not None else body, sent, received, read
+
+    def flush(self):
+        """
+        Makes the changes made to the store so far durable by committing them.
+        """
+        self._connection.commit()
+
+    def close(self):
+        """
+        Commits the pending changes of the store and closes its database connection.
+        """
+        self._connection.commit()
+        self._connection.close()
@@ -1,10 +1,65 @@
-def sort_by_code(reverse=False):
+from collections.abc import Sequence
+from functools import wraps
+
+
+class SortedView(Sequence):
+    """
+    Read-only sequence of items already sorted by their code, which can be cached and shared between callers.
+    """
+    __slots__ = ('_items',)
+
+    def __init__(self, items):
+        """
+        :param items: Items of the view, already sorted.
+        :type items: iterable
+        """
+        self._items = tuple(items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SortedView(self._items[index])
+        return self._items[index]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __eq__(self, other):
+        if isinstance(other, SortedView):
+            return self._items == other._items
+        if isinstance(other, (list, tuple)):
+            return list(self._items) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self._items))
+
+
+def sort_by_code(reverse=False, version=None):
     """
     Decorates a function and sorts its returned iterable by the value of the "code" attribute of its items.
     The sorting is done in the order marked by the "reverse" parameter.
+    If a "version" function is set, the decorated function must be a method without arguments and the sorted result is
+    cached in the "_views" attribute of its instance until the value returned by "version" for that instance changes.
     """
     def wrap(func):
+        @wraps(func)
         def wrapped(*args, **kwargs):
-            return sorted(func(*args, **kwargs), key=lambda x: x.code, reverse=reverse)
+            if version is None:
+                return SortedView(sorted(func(*args, **kwargs), key=lambda x: x.code, reverse=reverse))
+            instance, = args
+            if instance._views is None:
+                instance._views = {}
+            stamp = version(instance)
+            cached = instance._views.get(func.__name__)
+            if cached is None or cached[0] != stamp:
+                view = SortedView(sorted(func(instance), key=lambda x: x.code, reverse=reverse))
+                cached = instance._views[func.__name__] = (stamp, view)
+            return cached[1]
         return wrapped
     return wrap
@@ -0,0 +1,308 @@
+import sys
+from collections import OrderedDict
+from math import ceil, log
+
+CAPACITY = 1000000
+ERROR_RATE = 0.001
+MASK = (1 << 64) - 1
+GOLDEN = 0x9E3779B97F4A7C15
+
+
+def _mix(value):
+    """
+    Scrambles a 64-bit integer with the finalizer of SplitMix64, so that keys built from consecutive codes are spread
+    evenly over the bits of a Bloom filter.
+    :param value: Integer to scramble.
+    :type value: int
+    :return: Scrambled 64-bit integer.
+    :rtype: int
+    """
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK
+    return value ^ (value >> 31)
+
+
+def _key(user_code, message_code):
+    """
+    Builds the key of a delivery for a Bloom filter, scrambling both codes on their own before combining them, so that
+    codes of any size are spread over every bit of the key.
+    :param user_code: Code of the user.
+    :type user_code: int
+    :param message_code: Code of the message.
+    :type message_code: int
+    :return: Key of the delivery.
+    :rtype: int
+    """
+    return _mix(user_code) ^ _mix(message_code ^ GOLDEN)
+
+
+class BloomFilter(object):
+    """
+    Set of integer keys that takes a fixed number of bits, sized for a number of keys and a false positive rate. Keys
+    are never missed, but keys that were never added may be reported as present with the configured probability.
+    Every key sets a number of bits chosen by double hashing of the key.
+    """
+    __slots__ = ('_bits', '_size', '_hashes', '_count')
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        """
+        :param capacity: Number of keys the filter is sized for.
+        :type capacity: int
+        :param error_rate: Chance (0-1) of a false positive once the filter holds as many keys as its capacity.
+        :type error_rate: float
+        """
+        if not isinstance(capacity, int):
+            raise TypeError('Bloom filter capacity must be an integer.')
+        if not isinstance(error_rate, float):
+            raise TypeError('Bloom filter error rate must be a float.')
+        if capacity < 1:
+            raise ValueError('Bloom filter capacity must be a positive integer.')
+        if not 0 < error_rate < 1:
+            raise ValueError('Bloom filter error rate must be between 0 and 1.')
+        self._size = ceil(-capacity * log(error_rate) / log(2) ** 2)
+        self._hashes = max(1, round(self._size / capacity * log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, key):
+        """
+        Computes the bits of a key.
+        :param key: Key to hash.
+        :type key: int
+        :return: Positions of the bits of the key.
+        :rtype: list
+        """
+        first = _mix(key)
+        second = _mix(key ^ GOLDEN) | 1
+        size = self._size
+        return [(first + index * second) % size for index in range(self._hashes)]
+
+    def _test(self, positions):
+        """
+        Checks whether all these bits are set.
+        :param positions: Positions of the bits.
+        :type positions: list
+        :return: True if all the bits are set, False otherwise.
+        :rtype: bool
+        """
+        bits = self._bits
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _set(self, positions):
+        """
+        Sets these bits, counting a new key if any of them was not set.
+        :param positions: Positions of the bits.
+        :type positions: list
+        :return: False if all the bits were already set, True otherwise.
+        :rtype: bool
+        """
+        bits = self._bits
+        added = False
+        for position in positions:
+            index, mask = position >> 3, 1 << (position & 7)
+            if not bits[index] & mask:
+                bits[index] |= mask
+                added = True
+        self._count += added
+        return added
+
+    def add(self, key):
+        """
+        Adds a key to the filter.
+        :param key: Key to add.
+        :type key: int
+        :return: False if the key was already reported as present, True otherwise.
+        :rtype: bool
+        """
+        return self._set(self._positions(key))
+
+    def __contains__(self, key):
+        return self._test(self._positions(key))
+
+    def __len__(self):
+        """
+        Retrieves the number of keys added to the filter.
+        :return: Number of keys that were not reported as present when they were added.
+        :rtype: int
+        """
+        return self._count
+
+    @property
+    def error_rate(self):
+        """
+        Getter method for the expected false positive rate of the filter with the keys it currently holds.
+        :return: Chance (0-1) that a key that was never added is reported as present.
+        :rtype: float
+        """
+        filled = sum(bin(byte).count('1') for byte in self._bits) / self._size
+        return filled ** self._hashes
+
+    @property
+    def nbytes(self):
+        """
+        Getter method for the memory taken by the bits of the filter.
+        :return: Size of the bits in bytes.
+        :rtype: int
+        """
+        return len(self._bits)
+
+
+class BaseDeduplicator(object):
+    """
+    Interface of the layers that detect repeated deliveries of a message to a user, so that deliveries are idempotent
+    even if transports deliver them at least once. Deduplicators count the deliveries they check and the repeated ones.
+    """
+    checked = 0
+    duplicates = 0
+
+    def _add(self, user_code, message_code, now):
+        """
+        Records a delivery.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param now: Current time in seconds.
+        :type now: float
+        :return: False if the delivery had already been recorded, True otherwise.
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def add(self, user_code, message_code, now=0.0):
+        """
+        Records a delivery, checking whether it is repeated.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param now: Current time in seconds.
+        :type now: float
+        :return: False if the delivery is repeated, True otherwise.
+        :rtype: bool
+        """
+        added = self._add(user_code=user_code, message_code=message_code, now=now)
+        self.checked += 1
+        self.duplicates += not added
+        return added
+
+    def add_many(self, user_codes, message_code, now=0.0):
+        """
+        Records the deliveries of a message to several users, checking which ones are repeated.
+        :param user_codes: Codes of the users.
+        :type user_codes: iterable
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param now: Current time in seconds.
+        :type now: float
+        :return: Codes of the users the delivery is not repeated for, in the same order.
+        :rtype: list
+        """
+        return [user_code for user_code in user_codes
+                if self.add(user_code=user_code, message_code=message_code, now=now)]
+
+    @property
+    def nbytes(self):
+        """
+        Getter method for the memory taken by the recorded deliveries.
+        :return: Approximate size in bytes.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+
+class ExactDeduplicator(BaseDeduplicator):
+    """
+    Deduplicator that keeps the codes of every delivery, so it never reports a delivery as repeated by mistake. Memory
+    grows with the number of deliveries unless a time window is set, in which case deliveries older than the window are
+    evicted and can no longer be detected as repeated.
+    """
+
+    def __init__(self, window=None):
+        """
+        :param window: Time in seconds deliveries are kept for. They are kept forever if not specified.
+        :type window: float
+        """
+        if window is not None and not isinstance(window, (int, float)):
+            raise TypeError('Deduplication window must be a number.')
+        if window is not None and window <= 0:
+            raise ValueError('Deduplication window must be a positive number.')
+        self.window = window
+        self._seen = OrderedDict()
+
+    def _evict(self, now):
+        """
+        Evicts the deliveries older than the window. Deliveries are kept in the order they were recorded, so the oldest
+        ones are popped from the front until one is within the window.
+        :param now: Current time in seconds.
+        :type now: float
+        """
+        seen = self._seen
+        limit = now - self.window
+        while seen and next(iter(seen.values())) <= limit:
+            seen.popitem(last=False)
+
+    def _add(self, user_code, message_code, now):
+        if self.window is not None:
+            self._evict(now=now)
+        key = (user_code, message_code)
+        if key in self._seen:
+            return False
+        self._seen[key] = now
+        return True
+
+    def __len__(self):
+        return len(self._seen)
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self._seen) + sum(sys.getsizeof(key) for key in self._seen)
+
+
+class BloomDeduplicator(BaseDeduplicator):
+    """
+    Deduplicator with a fixed memory footprint, no matter how many deliveries it checks: a rolling Bloom filter made of
+    two generations. New deliveries are added to the current generation and looked up in both, and when the current
+    generation is full it replaces the previous one, which is forgotten. Deliveries are detected as repeated for at
+    least "capacity" deliveries after them, and a new delivery is wrongly reported as repeated with a chance no greater
+    than the error rate.
+    """
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        """
+        :param capacity: Number of deliveries of every generation.
+        :type capacity: int
+        :param error_rate: Maximum chance (0-1) of reporting a new delivery as repeated.
+        :type error_rate: float
+        """
+        # Each generation gets half of the error rate, so that looking a key up in both stays within the error rate.
+        self._current = BloomFilter(capacity=capacity, error_rate=error_rate / 2)
+        self._previous = BloomFilter(capacity=capacity, error_rate=error_rate / 2)
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+    def _add(self, user_code, message_code, now):
+        # Both generations have the same size and number of hashes, so the bits of the key are only computed once.
+        positions = self._current._positions(_key(user_code=user_code, message_code=message_code))
+        if self._previous._test(positions) or not self._current._set(positions):
+            return False
+        if len(self._current) >= self.capacity:
+            self._previous = self._current
+            self._current = BloomFilter(capacity=self.capacity, error_rate=self.error_rate / 2)
+        return True
+
+    @property
+    def expected_error_rate(self):
+        """
+        Getter method for the expected false positive rate with the deliveries currently recorded.
+        :return: Chance (0-1) that a new delivery is reported as repeated.
+        :rtype: float
+        """
+        return 1 - (1 - self._current.error_rate) * (1 - self._previous.error_rate)
+
+    @property
+    def nbytes(self):
+        return self._current.nbytes + self._previous.nbytes
@@ -1,38 +1,94 @@
 import logging
-import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, repeat
 
 from user import User
 from message import Message
-from names import get_random_name
-from text import get_random_text
-from decorators import sort_by_code
+from names import get_random_name, get_random_names
+from text import LazyText, get_random_lazy_text, get_random_lazy_texts
+from state import Bitmap, DeliveryState, RECEIVED, READ
+from rolls import roll_deliveries, roll_shard, derive_seed, spawn_rng
+from tracing import chain_tracers, get_logging_tracer
+from segments import Segment
+from scheduler import Scheduler, SimulatedClock
+from retries import RetryPolicy
+from dedup import BaseDeduplicator
+from retention import RetentionPolicy, RetentionReport, EVICTION_BATCH_SIZE
+from stats import export_statistics, MessageStatistics, SystemStatistics, TextSink, CHUNK_SIZE
+from snapshot import save_snapshot, load_snapshot
 
 logger = logging.getLogger(__name__)
 
 LOSS_CHANCE = 0.1
 READ_CHANCE = 0.5
+SHARD_SIZE = 65536
+NUM_WORDS = 10
+# Smaller batches of scheduled deliveries are sent one by one, which is faster than updating whole bitmaps.
+MIN_BATCH_SIZE = 64
 
 
 class DeliverySystem(object):
     """
     System of notifications that registers users and sends messages to them.
     """
-    _users = None
-    _messages = None
+    _state = None
+    _seed = None
+    _rng = None
+    _names_rng = None
+    _text_rng = None
+    _tracer = None
+    _segments = None
+    _scheduler = None
+    _clock = None
+    _retry_policy = None
+    _retried = None
+    _deduplicator = None
+    _retention_policy = None
     _user_count = 0
     _message_count = 0
 
-    def __init__(self, loss_chance=LOSS_CHANCE, read_chance=READ_CHANCE):
+    def __init__(self, loss_chance=LOSS_CHANCE, read_chance=READ_CHANCE, seed=None, state=None, clock=None,
+                 retry_policy=None, deduplicator=None, retention_policy=None):
         """
         :param loss_chance: Chance (0-1) that a sent message will not be received.
         :type loss_chance: float
         :param read_chance: Chance (0-1) that a received message will be read.
         :type read_chance: float
+        :param seed: Seed for the random streams of the system. The delivery rolls, the random user names and the
+        random message bodies get independent streams derived from it. If not set, the global state of the "random"
+        module is used for all of them.
+        :type seed: int
+        :param state: Store where users, messages and their delivery state are kept, such as a "database.SQLiteState".
+        A new in-memory store is used if not specified. Codes of new users and messages follow the ones already stored.
+        :type state: BaseDeliveryState
+        :param clock: Function that returns the current time in seconds, which scheduled deliveries are due by, such as
+        "time.time". A simulated clock starting at 0 that only moves when the system ticks is used if not specified.
+        :type clock: function
+        :param retry_policy: Policy to retry lost deliveries with. Lost deliveries are not retried if not specified.
+        :type retry_policy: RetryPolicy
+        :param deduplicator: Layer that drops repeated deliveries of a message to a user before they reach the inboxes,
+        such as a "dedup.BloomDeduplicator". Repeated deliveries are only detected by the inboxes if not specified.
+        :type deduplicator: BaseDeduplicator
+        :param retention_policy: Policy for the messages kept in inboxes, applied by "enforce_retention". Inboxes keep
+        every message if not specified.
+        :type retention_policy: RetentionPolicy
         """
         self.loss_chance = loss_chance
         self.read_chance = read_chance
-        self._users = set()
-        self._messages = set()
+        self._seed = seed
+        self._rng = spawn_rng(seed, 'rolls')
+        self._names_rng = spawn_rng(seed, 'names')
+        self._text_rng = spawn_rng(seed, 'text')
+        self._state = state if state is not None else DeliveryState()
+        self._segments = {}
+        self._scheduler = Scheduler()
+        self._clock = clock if clock is not None else SimulatedClock()
+        self.retry_policy = retry_policy
+        self._retried = Counter()
+        self.deduplicator = deduplicator
+        self.retention_policy = retention_policy
+        self._user_count, self._message_count = self._state.last_codes()
 
     @property
     def loss_chance(self):
@@ -74,24 +130,120 @@ class DeliverySystem(object):
         self._read_chance = read_chance
 
     @property
-    @sort_by_code()
+    def tracer(self):
+        """
+        Getter method for the tracer of the system.
+        :return: Function called with every delivery event, or None if there is no tracer.
+        :rtype: function
+        """
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        """
+        Setter method for the tracer of the system, such as a "tracing.EventStream", called with every delivery event
+        of its users and messages. Debug logging of delivery events is handled separately, according to the logging
+        level.
+        :param tracer: Function called with every delivery event, or None to disable tracing.
+        :type tracer: function
+        """
+        self._tracer = tracer
+
+    @property
+    def retry_policy(self):
+        """
+        Getter method for the policy lost deliveries are retried with.
+        :return: The retry policy, or None if lost deliveries are not retried.
+        :rtype: RetryPolicy
+        """
+        return self._retry_policy
+
+    @retry_policy.setter
+    def retry_policy(self, retry_policy):
+        """
+        Setter method for the policy lost deliveries are retried with.
+        :param retry_policy: The retry policy, or None not to retry lost deliveries.
+        :type retry_policy: RetryPolicy
+        """
+        if retry_policy is not None and not isinstance(retry_policy, RetryPolicy):
+            raise TypeError('Retry policy must be a RetryPolicy object.')
+        self._retry_policy = retry_policy
+
+    @property
+    def deduplicator(self):
+        """
+        Getter method for the layer that drops repeated deliveries.
+        :return: The deduplicator, or None if repeated deliveries are only detected by the inboxes.
+        :rtype: BaseDeduplicator
+        """
+        return self._deduplicator
+
+    @deduplicator.setter
+    def deduplicator(self, deduplicator):
+        """
+        Setter method for the layer that drops repeated deliveries.
+        :param deduplicator: The deduplicator, or None to only detect repeated deliveries by the inboxes.
+        :type deduplicator: BaseDeduplicator
+        """
+        if deduplicator is not None and not isinstance(deduplicator, BaseDeduplicator):
+            raise TypeError('Deduplicator must be a BaseDeduplicator object.')
+        self._deduplicator = deduplicator
+
+    @property
+    def retention_policy(self):
+        """
+        Getter method for the policy for the messages kept in inboxes.
+        :return: The retention policy, or None if inboxes keep every message.
+        :rtype: RetentionPolicy
+        """
+        return self._retention_policy
+
+    @retention_policy.setter
+    def retention_policy(self, retention_policy):
+        """
+        Setter method for the policy for the messages kept in inboxes.
+        :param retention_policy: The retention policy, or None to keep every message.
+        :type retention_policy: RetentionPolicy
+        """
+        if retention_policy is not None and not isinstance(retention_policy, RetentionPolicy):
+            raise TypeError('Retention policy must be a RetentionPolicy object.')
+        self._retention_policy = retention_policy
+
+    def _refresh_tracer(self):
+        """
+        Installs the tracer of the system in its delivery state store, chained with the debug logging tracer if debug
+        logging is currently enabled. This is checked once per operation instead of once per delivery event.
+        """
+        self._state.tracer = chain_tracers(get_logging_tracer(), self._tracer)
+
+    @property
+    def seed(self):
+        """
+        Getter method for the seed of the random streams of the system.
+        :return: Seed, or None if the global state of the "random" module is used.
+        :rtype: int
+        """
+        return self._seed
+
+    @property
     def messages(self):
         """
-        Getter method to retrieve the created messages.
+        Getter method to retrieve the created messages. Message codes are incremental, so the insertion order of the
+        message index is already their code order and no sorting is needed.
         :return: List of messages, ordered by their code.
         :rtype: list
         """
-        return self._messages
+        return self._state.messages()
 
     @property
-    @sort_by_code()
     def users(self):
         """
-        Getter method to retrieve the registered users.
+        Getter method to retrieve the registered users. As with messages, user codes are incremental and the user index
+        is already in code order.
         :return: List of users, ordered by their code.
         :rtype: list
         """
-        return self._users
+        return self._state.users()
 
     def _get_user_code(self):
         """
@@ -120,10 +272,42 @@ class DeliverySystem(object):
         :return: The user that was created and registered.
         :rtype: User
         """
-        user = User(name=name or get_random_name(), code=self._get_user_code())
-        self._users.add(user)
+        name = name or get_random_name(rng=self._names_rng)
+        if not isinstance(name, str):
+            raise TypeError('User name must be string.')
+        user = User._from_trusted(name=name, code=self._get_user_code(), state=self._state)
+        self._state.flush()
         return user
 
+    def register_users(self, n, names=None):
+        """
+        Creates several new users at once and registers them into the delivery system, assigning them a contiguous
+        block of unique numeric codes. Random names are generated in bulk for the users if their names are omitted.
+        :param n: Number of users to register.
+        :type n: int
+        :param names: Full names of the users to be registered, in the order their codes are assigned.
+        :type names: list
+        :return: The users that were created and registered, ordered by their code.
+        :rtype: list
+        """
+        if not isinstance(n, int):
+            raise TypeError('Number of users must be integer.')
+        if n < 0:
+            raise ValueError('Number of users must be a positive integer.')
+        if names is None:
+            names = get_random_names(size=n, rng=self._names_rng)
+        else:
+            names = list(names)
+            if len(names) != n:
+                raise ValueError(f'Expected {n} user names, got {len(names)}.')
+            if not all(isinstance(name, str) for name in names):
+                raise TypeError('User name must be string.')
+        first_code = self._user_count + 1
+        self._user_count += n
+        users = User._create_many(names=names, first_code=first_code, state=self._state)
+        self._state.flush()
+        return users
+
     def is_registered_user(self, user):
         """
         Check if this user is registered.
@@ -132,20 +316,65 @@ class DeliverySystem(object):
         :return: Whether the user is registered or not.
         :rtype: bool
         """
-        return user in self._users
+        return self._state.get_user(code=user.code) is user
 
     def create_message(self, body=None):
         """
         Creates a new message and adds it to the message list.
-        :param body: Text to be used as the body of the message. A random text will be generated if this is not set.
-        :type body: str
+        :param body: Text to be used as the body of the message. A random text will be generated if this is not set,
+        which is kept as word indexes and only built when it is read.
+        :type body: str | LazyText
         :return: The new message.
         :rtype: Message
         """
-        message = Message(body=body or get_random_text(num_words=10), code=self._get_message_code())
-        self._messages.add(message)
+        body = body or get_random_lazy_text(num_words=NUM_WORDS, rng=self._text_rng)
+        if not isinstance(body, (str, LazyText)):
+            raise TypeError('Message body must be string.')
+        self._refresh_tracer()
+        message = Message._from_trusted(body=body, code=self._get_message_code(), state=self._state)
+        self._state.flush()
         return message
 
+    def create_messages(self, n, bodies=None):
+        """
+        Creates several new messages at once, assigning them a contiguous block of unique numeric codes. Random bodies
+        are generated in bulk for the messages if their bodies are omitted.
+        :param n: Number of messages to create.
+        :type n: int
+        :param bodies: Bodies of the messages, in the order their codes are assigned.
+        :type bodies: list
+        :return: The new messages, ordered by their code.
+        :rtype: list
+        """
+        if not isinstance(n, int):
+            raise TypeError('Number of messages must be integer.')
+        if n < 0:
+            raise ValueError('Number of messages must be a positive integer.')
+        if bodies is None:
+            bodies = get_random_lazy_texts(size=n, num_words=NUM_WORDS, rng=self._text_rng)
+        else:
+            bodies = list(bodies)
+            if len(bodies) != n:
+                raise ValueError(f'Expected {n} message bodies, got {len(bodies)}.')
+            if not all(isinstance(body, (str, LazyText)) for body in bodies):
+                raise TypeError('Message body must be string.')
+        self._refresh_tracer()
+        first_code = self._message_count + 1
+        self._message_count += n
+        messages = Message._create_many(bodies=bodies, first_code=first_code, state=self._state)
+        self._state.flush()
+        return messages
+
+    def get_message(self, code):
+        """
+        Retrieves a registered message by its code.
+        :param code: Code of the message to retrieve.
+        :type code: int
+        :return: The message registered with this code, or None if there is no such message.
+        :rtype: Message
+        """
+        return self._state.get_message(code=code)
+
     def is_registered_message(self, message):
         """
         Checks if this message is registered within the system.
@@ -154,7 +383,19 @@ class DeliverySystem(object):
         :return: Whether the message is registered within the system or not.
         :rtype: bool
         """
-        return message in self.messages
+        return self._state.get_message(code=message.code) is message
+
+    def _check_message(self, message):
+        """
+        Checks that this message can be sent: it must be registered within the system and it must not have been
+        released, since its delivery state is gone and sending it again would count its deliveries twice.
+        :param message: Message to check.
+        :type message: Message
+        """
+        if not self.is_registered_message(message=message):
+            raise ValueError(f'Message "{message}" is not registered within the system.')
+        if self._state.is_released(message_code=message.code):
+            raise ValueError(f'Message "{message}" has been released so it cannot be sent again.')
 
     def send_message(self, user, message=None, body=None):
         """
@@ -172,16 +413,68 @@ class DeliverySystem(object):
         if not self.is_registered_user(user=user):
             raise ValueError(f'User {user} is not registered.')
         message = message or self.create_message(body=body)
-        if not self.is_registered_message(message=message):
-            raise ValueError(f'Message "{message}" is not registered within the system.')
+        self._check_message(message=message)
+        self._refresh_tracer()
+        self._deliver(user=user, message=message)
+        self._state.flush()
+        return message
+
+    def _deliver(self, user, message, attempt=1):
+        """
+        Sends this message to this user and marks it as received and read by this user if it passes the respective
+        random rolls. A lost delivery is scheduled to be retried if the retry policy allows it, and a repeated one is
+        dropped if the system has a deduplicator.
+        :param user: The user to whom the message will be sent.
+        :type user: User
+        :param message: The message to send.
+        :type message: Message
+        :param attempt: Number of the delivery attempt, greater than 1 for retries.
+        :type attempt: int
+        """
         message.send(user=user)
-        if random.random() > self._loss_chance:
+        self._stamp(message=message)
+        # Both rolls are always drawn so that every delivery consumes the same amount of random numbers, which allows
+        # batch broadcasts to draw the rolls of a whole audience in one block and still get the same results.
+        loss_roll, read_roll = self._rng.random(), self._rng.random()
+        if attempt > 1:
+            self._retried[message.code] += 1
+        if loss_roll > self._loss_chance:
+            if self._deduplicator is not None and not self._deduplicator.add(
+                    user_code=user.code, message_code=message.code, now=self._clock()):
+                return
             user.receive_message(message=message)
-            if random.random() < self._read_chance:
+            if read_roll < self._read_chance:
                 user.read_message(message=message)
-        return message
+        else:
+            self._retry(message=message, user_codes=(user.code,), attempt=attempt)
 
-    def broadcast_message(self, message=None, body=None):
+    def _stamp(self, message):
+        """
+        Records the time a message is first delivered in the store, which its age is measured from.
+        :param message: The message being delivered.
+        :type message: Message
+        """
+        self._state.stamp(message_code=message.code, now=self._clock())
+
+    def _retry(self, message, user_codes, attempt):
+        """
+        Schedules the next attempt of the lost deliveries of a message, after the delay of the retry policy, unless
+        there is no policy or the maximum number of attempts has been reached.
+        :param message: The message that was lost.
+        :type message: Message
+        :param user_codes: Codes of the users the message was lost for.
+        :type user_codes: iterable
+        :param attempt: Number of the attempt that was lost.
+        :type attempt: int
+        """
+        if self._retry_policy is None or attempt >= self._retry_policy.max_attempts:
+            return
+        self._scheduler.schedule(
+            at=self._clock() + self._retry_policy.delay(attempt=attempt + 1), message_code=message.code,
+            user_codes=user_codes, attempt=attempt + 1
+        )
+
+    def broadcast_message(self, message=None, body=None, batch=False, workers=None):
         """
         Sends this message to every registered user, creating it first if the message is not specified, and marks it
         as received and read by each user if they pass the respective random rolls.
@@ -189,14 +482,505 @@ class DeliverySystem(object):
         :type message: Message
         :param body: The body of the message if a new one is created. IF not specified, a random text will be set.
         :type body: str
+        :param batch: Whether to deliver the message to all users at once instead of one by one. The results are the
+        same for the same random state, but batch mode is much faster for large audiences.
+        :type batch: bool
+        :param workers: Number of worker processes to deliver the message with. If set, users are split into shards by
+        code range and the rolls of every shard are drawn by a process pool. Results are reproducible for the same
+        random state no matter the number of workers, but they differ from the ones of the other modes.
+        :type workers: int
+        :return: The message that was sent.
+        :rtype: Message
+        """
+        message = message or self.create_message(body=body)
+        self._check_message(message=message)
+        self._refresh_tracer()
+        if workers:
+            self._broadcast_sharded(message=message, workers=workers)
+        elif batch:
+            # User codes are incremental, so every registered user is in this range and no user has to be loaded.
+            self._broadcast_batch(message=message, user_codes=range(1, self._user_count + 1))
+        else:
+            for user in self.users:
+                self._deliver(user=user, message=message)
+        self._state.flush()
+        return message
+
+    def _broadcast_batch(self, message, user_codes, attempt=1):
+        """
+        Sends this message to these users at once: the loss and read rolls of the whole audience are drawn in a single
+        step and the sent, received and read status of the message is updated in bulk.
+        :param message: The message to send.
+        :type message: Message
+        :param user_codes: Codes of the registered users to whom the message will be sent.
+        :type user_codes: list | range
+        :param attempt: Number of the delivery attempt, greater than 1 for retries.
+        :type attempt: int
+        :return: The message that was sent.
+        :rtype: Message
+        """
+        received, read = roll_deliveries(
+            size=len(user_codes), loss_chance=self._loss_chance, read_chance=self._read_chance, rng=self._rng
+        )
+        return self._deliver_many(
+            message=message, user_codes=user_codes, received=received, read=read, attempt=attempt
+        )
+
+    def _broadcast_sharded(self, message, workers):
+        """
+        Sends this message to every registered user at once, splitting users into shards of consecutive codes. The
+        rolls of every shard are drawn by a pool of worker processes, each shard with its own random stream derived
+        from a base seed and the shard number, and the results are merged back in bulk. Only the rolls run in the pool:
+        merging them and storing the message in every inbox is serial, and takes most of the time of a broadcast, so
+        this mode does not scale with the number of workers.
+        :param message: The message to send.
+        :type message: Message
+        :param workers: Maximum number of worker processes. No more workers than shards are started, and the rolls are
+        drawn in this process if there is a single worker or a single shard, since a pool would only add its overhead.
+        The results are the same either way.
+        :type workers: int
+        :return: The message that was sent.
+        :rtype: Message
+        """
+        user_codes = range(1, self._user_count + 1)
+        base_seed = self._rng.getrandbits(64)
+        starts = range(0, len(user_codes), SHARD_SIZE)
+        sizes = [min(SHARD_SIZE, len(user_codes) - start) for start in starts]
+        seeds = [derive_seed(base_seed, shard) for shard in range(len(sizes))]
+        arguments = (sizes, repeat(self._loss_chance), repeat(self._read_chance), seeds)
+        workers = min(workers, len(sizes))
+        if workers <= 1:
+            results = list(map(roll_shard, *arguments))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(roll_shard, *arguments))
+        # Every shard returns its own bitsets, so merging them is a shift and an union per shard. User codes are
+        # incremental, so the users of a shard have consecutive codes from the one of its first user.
+        received, read = Bitmap(), Bitmap()
+        for start, (shard_received, shard_read) in zip(starts, results):
+            received |= Bitmap.frombytes(shard_received, start=user_codes[start])
+            read |= Bitmap.frombytes(shard_read, start=user_codes[start])
+        return self._deliver_many(message=message, user_codes=user_codes, received=received, read=read)
+
+    def _deliver_many(self, message, user_codes, received, read, attempt=1):
+        """
+        Applies the outcome of delivering this message to several users at once, marking it as sent to all of them and
+        as received and read by the ones flagged as such. Lost deliveries are scheduled to be retried together, as a
+        wave, if the retry policy allows it, and repeated ones are dropped if the system has a deduplicator.
+        :param message: The message that was sent.
+        :type message: Message
+        :param user_codes: Codes of the registered users the message was sent to. Users are only loaded from the store
+        if there is a tracer.
+        :type user_codes: list | range
+        :param received: Flags stating whether each user received the message, or a bitmap with the codes of the users
+        that received it.
+        :type received: iterable | Bitmap
+        :param read: Flags stating whether each user read the message, or a bitmap with the codes of the users that read
+        it.
+        :type read: iterable | Bitmap
+        :param attempt: Number of the delivery attempt, greater than 1 for retries.
+        :type attempt: int
+        :return: The message that was sent.
+        :rtype: Message
+        """
+        get_user = self._state.get_user
+        if isinstance(user_codes, range):
+            sent = Bitmap.fromrange(user_codes.start, user_codes.stop)
+        else:
+            sent = Bitmap(user_codes)
+        message.send_many(users=map(get_user, user_codes), user_codes=sent)
+        self._stamp(message=message)
+        if not isinstance(received, Bitmap):
+            received = Bitmap(compress(user_codes, received))
+            read = Bitmap(compress(user_codes, read))
+        delivered = received
+        if self._deduplicator is not None:
+            codes = list(received)
+            new = self._deduplicator.add_many(user_codes=codes, message_code=message.code, now=self._clock())
+            if len(new) < len(codes):
+                delivered = Bitmap(new)
+                read = read & delivered
+        # Messages are marked as read before they are stored, so that they are not added to the unread messages of
+        # their readers just to be removed right after.
+        message.mark_many_as_received(users=map(get_user, delivered), user_codes=delivered)
+        message.mark_many_as_read(users=map(get_user, read), user_codes=read)
+        repeated = len(delivered) - self._state.add_to_inboxes(user_codes=delivered, message_code=message.code)
+        if repeated:
+            logger.warning(f'{repeated} users received a repeated message: "{message}".')
+        if attempt > 1:
+            self._retried[message.code] += len(user_codes)
+        if self._retry_policy is not None:
+            # Only lost deliveries are retried, not the ones dropped as repeated.
+            lost = [user_code for user_code in user_codes if user_code not in received]
+            if lost:
+                self._retry(message=message, user_codes=lost, attempt=attempt)
+        return message
+
+    def define_segment(self, name, users=None, start=None, stop=None, predicate=None):
+        """
+        Defines a named segment of users that messages can be sent to, either with an explicit list of users, with a
+        range of user codes or with a predicate that is evaluated once over the registered users. Defining a segment
+        with the name of an existing one replaces it.
+        :param name: Name of the segment.
+        :type name: str
+        :param users: Users of the segment.
+        :type users: list
+        :param start: First user code of the segment, if it is defined by a range. Defaults to the first code.
+        :type start: int
+        :param stop: User code after the last one of the segment, if it is defined by a range. Defaults to the code
+        after the last registered user.
+        :type stop: int
+        :param predicate: Function that receives a registered user and returns whether they belong to the segment.
+        :type predicate: function
+        :return: The segment.
+        :rtype: Segment
+        """
+        if sum((users is not None, start is not None or stop is not None, predicate is not None)) != 1:
+            raise ValueError('A segment must be defined by either a list of users, a code range or a predicate.')
+        if users is not None:
+            segment = Segment.from_users(name=name, users=users)
+        elif predicate is not None:
+            segment = Segment.from_predicate(name=name, users=self.users, predicate=predicate)
+        else:
+            start = 1 if start is None else start
+            stop = self._user_count + 1 if stop is None else stop
+            segment = Segment.from_range(name=name, start=start, stop=stop)
+        return self.add_segment(segment=segment)
+
+    def add_segment(self, segment):
+        """
+        Stores a segment under its name, such as one combined from other segments, so that it can be retrieved later.
+        :param segment: Segment to store.
+        :type segment: Segment
+        :return: The segment.
+        :rtype: Segment
+        """
+        self._segments[segment.name] = segment
+        return segment
+
+    def get_segment(self, name):
+        """
+        Retrieves a segment by its name.
+        :param name: Name of the segment.
+        :type name: str
+        :return: The segment with this name, or None if there is no such segment.
+        :rtype: Segment
+        """
+        return self._segments.get(name)
+
+    def _resolve_segment(self, segment):
+        """
+        Retrieves a segment defined in the system by its name, unless the segment itself is given.
+        :param segment: The segment, or the name of a segment defined in the system.
+        :type segment: Segment | str
+        :return: The segment.
+        :rtype: Segment
+        """
+        if isinstance(segment, str):
+            name, segment = segment, self.get_segment(name=segment)
+            if segment is None:
+                raise ValueError(f'Segment {name} is not defined.')
+        return segment
+
+    def send_to_segment(self, segment, message=None, body=None, batch=False):
+        """
+        Sends this message to every registered user of a segment, creating it first if the message is not specified,
+        and marks it as received and read by each user if they pass the respective random rolls. Only the members of
+        the segment are visited, no matter how many users are registered.
+        :param segment: The segment, or the name of a segment defined in the system.
+        :type segment: Segment | str
+        :param message: The message to send. If not specified, a new one will be created.
+        :type message: Message
+        :param body: The body of the message if a new one is created. IF not specified, a random text will be set.
+        :type body: str
+        :param batch: Whether to deliver the message to all the users of the segment at once instead of one by one.
+        :type batch: bool
         :return: The message that was sent.
         :rtype: Message
         """
+        segment = self._resolve_segment(segment=segment)
         message = message or self.create_message(body=body)
-        for user in self.users:
-            self.send_message(user=user, message=message)
+        self._check_message(message=message)
+        self._refresh_tracer()
+        users = [user for user in map(self._state.get_user, segment) if user is not None]
+        if batch:
+            self._broadcast_batch(message=message, user_codes=[user.code for user in users])
+        else:
+            for user in users:
+                self._deliver(user=user, message=message)
+        self._state.flush()
         return message
 
+    @property
+    def clock(self):
+        """
+        Getter method for the clock that scheduled deliveries are due by.
+        :return: Function that returns the current time in seconds.
+        :rtype: function
+        """
+        return self._clock
+
+    @property
+    def scheduler(self):
+        """
+        Getter method for the queue of scheduled deliveries.
+        :return: The scheduler of the system.
+        :rtype: Scheduler
+        """
+        return self._scheduler
+
+    def schedule_message(self, message=None, at=None, segment=None, user=None, body=None, window=None):
+        """
+        Schedules the delivery of this message for later, creating it first if the message is not specified. The
+        message is sent to a single user, to the users of a segment or, if neither is specified, to every user
+        registered when it is scheduled. Scheduled deliveries are sent when the system runs them once they are due.
+        :param message: The message to send. If not specified, a new one will be created.
+        :type message: Message
+        :param at: Time the message is due, in seconds of the system clock. Defaults to the current time.
+        :type at: float
+        :param segment: The segment, or the name of a segment defined in the system, to send the message to.
+        :type segment: Segment | str
+        :param user: The user to send the message to.
+        :type user: User
+        :param body: The body of the message if a new one is created. IF not specified, a random text will be set.
+        :type body: str
+        :param window: If set, deliveries are spread evenly over this number of seconds after the due time, splitting
+        the users by code into one batch per slot of the scheduler.
+        :type window: float
+        :return: The message that was scheduled.
+        :rtype: Message
+        """
+        at = self._clock() if at is None else at
+        if not isinstance(at, (int, float)):
+            raise TypeError('Schedule time must be a number.')
+        if window is not None and not isinstance(window, (int, float)):
+            raise TypeError('Schedule window must be a number.')
+        if window is not None and window < 0:
+            raise ValueError('Schedule window must be a positive number.')
+        if segment is not None and user is not None:
+            raise ValueError('A message can be scheduled either for a segment or for a user, but not both.')
+        if user is not None:
+            if not self.is_registered_user(user=user):
+                raise ValueError(f'User {user} is not registered.')
+            user_codes = (user.code,)
+        elif segment is not None:
+            user_codes = self._resolve_segment(segment=segment).codes
+        else:
+            user_codes = Bitmap.fromrange(1, self._user_count + 1)
+        message = message or self.create_message(body=body)
+        self._check_message(message=message)
+        if not window:
+            self._scheduler.schedule(at=at, message_code=message.code, user_codes=user_codes)
+            return message
+        user_codes = list(user_codes)
+        slices = max(1, min(len(user_codes), round(window / self._scheduler.resolution)))
+        for index in range(slices):
+            self._scheduler.schedule(
+                at=at + window * index / slices, message_code=message.code,
+                user_codes=user_codes[len(user_codes) * index // slices:len(user_codes) * (index + 1) // slices]
+            )
+        return message
+
+    def run_scheduled(self, until=None, batch=True):
+        """
+        Sends the scheduled deliveries that are due, in order of time, delivering every message due at the same time
+        to all its users at once, unless they are only a few. Users that are no longer registered are skipped.
+        :param until: Time up to which deliveries are due, in seconds of the system clock. Defaults to the current time.
+        :type until: float
+        :param batch: Whether to deliver every message to all its due users at once instead of one by one.
+        :type batch: bool
+        :return: Number of deliveries sent.
+        :rtype: int
+        """
+        until = self._clock() if until is None else until
+        self._refresh_tracer()
+        delivered = 0
+        for _, message_code, attempt, user_codes in self._scheduler.pop_due(until=until):
+            message = self._state.get_message(code=message_code)
+            users = [user for user in map(self._state.get_user, user_codes) if user is not None]
+            if batch and len(users) >= MIN_BATCH_SIZE:
+                self._broadcast_batch(message=message, user_codes=[user.code for user in users], attempt=attempt)
+            else:
+                for user in users:
+                    self._deliver(user=user, message=message, attempt=attempt)
+            delivered += len(users)
+        self._state.flush()
+        return delivered
+
+    def tick(self, seconds=0, batch=True):
+        """
+        Moves the simulated clock of the system forward and sends the scheduled deliveries that became due.
+        :param seconds: Number of seconds to move the clock forward.
+        :type seconds: float
+        :param batch: Whether to deliver every message to all its due users at once instead of one by one.
+        :type batch: bool
+        :return: Number of deliveries sent.
+        :rtype: int
+        """
+        if seconds:
+            if not isinstance(self._clock, SimulatedClock):
+                raise TypeError('Only simulated clocks can be moved forward.')
+            self._clock.advance(seconds)
+        return self.run_scheduled(batch=batch)
+
+    def drain_scheduled(self, batch=True):
+        """
+        Sends every scheduled delivery, including the retries scheduled along the way, moving the simulated clock of
+        the system forward to the time every batch is due.
+        :param batch: Whether to deliver every message to all its due users at once instead of one by one.
+        :type batch: bool
+        :return: Number of deliveries sent.
+        :rtype: int
+        """
+        if not isinstance(self._clock, SimulatedClock):
+            raise TypeError('Only simulated clocks can be moved forward.')
+        delivered = 0
+        while self._scheduler.next_due() is not None:
+            self._clock.advance(max(0.0, self._scheduler.next_due() - self._clock()))
+            delivered += self.run_scheduled(batch=batch)
+        return delivered
+
+    def _pending_messages(self):
+        """
+        Retrieves the codes of the messages with deliveries still to be made, which must not be released.
+        :return: Message codes.
+        :rtype: set
+        """
+        return self._scheduler.message_codes()
+
+    def enforce_retention(self, batch_size=EVICTION_BATCH_SIZE):
+        """
+        Applies the retention policy to every inbox. Messages older than the maximum age and, if they are archived,
+        messages read by every user that received them are evicted from every inbox and released. Then the oldest
+        messages beyond the maximum number of every inbox are evicted, and the ones left in no inbox are released.
+        Messages are evicted and released in batches of messages and of users, and the store is flushed after every
+        batch. Released messages keep their statistics, and messages with pending deliveries are never released.
+        :param batch_size: Number of messages or users of every batch.
+        :type batch_size: int
+        :return: Number of messages evicted from inboxes and number of messages released.
+        :rtype: RetentionReport
+        """
+        policy = self._retention_policy
+        if policy is None:
+            return RetentionReport(evicted=0, released=0)
+        pending = self._pending_messages()
+        retired = []
+        if policy.max_age is not None:
+            # Messages are stamped in the order they are first delivered, so the expired ones come first.
+            limit = self._clock() - policy.max_age
+            for message_code, first_sent in self._state.first_sent().items():
+                if first_sent > limit:
+                    break
+                retired.append(message_code)
+        if policy.archive_read:
+            count, expired = self._state.count, set(retired)
+            for message_code in self._state.first_sent():
+                read = count(status=READ, message_code=message_code)
+                if read and read == count(status=RECEIVED, message_code=message_code) and message_code not in expired:
+                    retired.append(message_code)
+        retired = [message_code for message_code in retired if message_code not in pending]
+        evicted = released = 0
+        for start in range(0, len(retired), batch_size):
+            batch = retired[start:start + batch_size]
+            evicted += self._state.evict_messages(message_codes=batch)
+            released += self._release(message_codes=batch)
+        if policy.max_messages is not None:
+            users = self.users
+            for start in range(0, len(users), batch_size):
+                evictions = {}
+                for user in users[start:start + batch_size]:
+                    codes = policy.overflow(inbox=self._state.inbox(user_code=user.code))
+                    if codes:
+                        evictions[user.code] = codes
+                evicted += self._state.evict(evictions=evictions)
+                orphans = sorted({message_code for codes in evictions.values() for message_code in codes})
+                released += self._release(message_codes=[
+                    message_code for message_code in orphans
+                    if message_code not in pending and self._state.inbox_count(message_code=message_code) == 0
+                ])
+        return RetentionReport(evicted=evicted, released=released)
+
+    def _release(self, message_codes):
+        """
+        Releases the delivery state of several messages, including when they were first delivered.
+        :param message_codes: Codes of the messages, which are in no inbox anymore.
+        :type message_codes: list
+        :return: Number of messages released.
+        :rtype: int
+        """
+        self._state.release(message_codes=message_codes)
+        self._state.flush()
+        return len(message_codes)
+
+    def iter_statistics(self):
+        """
+        Generates the statistics of every message, one at a time, as computed by the store, along with the number of
+        delivery attempts made, which exceeds the number of users the message was sent to when lost deliveries are
+        retried.
+        :return: Statistics of every message: code, body, number of times it has been sent, received and read, and
+        number of delivery attempts.
+        :rtype: generator
+        """
+        for code, body, sent, received, read in self._state.iter_statistics():
+            yield MessageStatistics(code, body, sent, received, read, sent + self._retried[code])
+
+    def export_statistics(self, sinks, chunk_size=CHUNK_SIZE):
+        """
+        Streams the statistics of the delivery system and of every message to several sinks, such as the ones in the
+        "stats" module. Message statistics are generated and exported in chunks.
+        :param sinks: Destinations of the statistics.
+        :type sinks: list
+        :param chunk_size: Number of message statistics per chunk.
+        :type chunk_size: int
+        """
+        system = SystemStatistics(
+            users=self._user_count, loss_chance=self._loss_chance, read_chance=self._read_chance,
+            messages=self._message_count
+        )
+        export_statistics(system=system, records=self.iter_statistics(), sinks=sinks, chunk_size=chunk_size)
+
+    def close(self):
+        """
+        Releases the resources of the store of the system, such as a database connection, after saving any changes.
+        """
+        self._state.close()
+
+    def save(self, path):
+        """
+        Saves the users, messages, counters and delivery state of the system in a compact binary snapshot file, so
+        that the simulation can be resumed or inspected later.
+        :param path: Path of the snapshot file.
+        :type path: str
+        """
+        save_snapshot(system=self, path=path)
+        logger.info(f'Saved delivery system snapshot to {path}.')
+
+    @classmethod
+    def load(cls, path, clock=None, retry_policy=None, deduplicator=None, retention_policy=None):
+        """
+        Opens a snapshot file saved with "save" as a new delivery system. The file is mapped in memory and its contents
+        are only decoded as they are used, so opening a large snapshot is almost instant. Snapshots do not keep the
+        configuration of the system: policies, the deduplicator and the clock must be given again, and segments,
+        deliveries scheduled for retry and channel rate limits are not restored.
+        :param path: Path of the snapshot file.
+        :type path: str
+        :param clock: Function that returns the current time in seconds, such as "time.time". A simulated clock starting
+        at the saved time is used if not specified.
+        :type clock: function
+        :param retry_policy: Policy to retry lost deliveries with. Lost deliveries are not retried if not specified.
+        :type retry_policy: RetryPolicy
+        :param deduplicator: Layer that drops repeated deliveries of a message to a user before they reach the inboxes.
+        :type deduplicator: BaseDeduplicator
+        :param retention_policy: Policy for the messages kept in inboxes. Inboxes keep every message if not specified.
+        :type retention_policy: RetentionPolicy
+        :return: The restored delivery system.
+        :rtype: DeliverySystem
+        """
+        system = load_snapshot(cls=cls, path=path, clock=clock, retry_policy=retry_policy, deduplicator=deduplicator,
+                               retention_policy=retention_policy)
+        logger.info(f'Loaded delivery system snapshot from {path}.')
+        return system
+
     def show_statistics(self, display_func=logger.info):
         """
         Gathers and displays statistics about the current status of the delivery system: number of users registered,
@@ -205,21 +989,4 @@ class DeliverySystem(object):
         :param display_func: function used to display the statistics.
         :type display_func: function
         """
-        display_func('-------------------------------')
-        display_func('DELIVERY SYSTEM STATISTICS')
-        display_func('-------------------------------')
-        display_func(f'USERS: {self._user_count} unique users registered.')
-        display_func('-------------------------------')
-        display_func(f'LOSS CHANCE: chance that a message will be lost is set to {self._loss_chance}')
-        display_func('-------------------------------')
-        display_func(f'READ CHANCE: chance that a message will be read is set to {self._read_chance}')
-        display_func('-------------------------------')
-        display_func(f'MESSAGES: {self._message_count} unique messages created.')
-        display_func('-------------------------------')
-        for message in self.messages:
-            times_sent, times_received, times_read  = message.get_statistics()
-            display_func(f'Message {message.code}: {message.body}')
-            display_func(f'Sent to {times_sent} users.')
-            display_func(f'Received by {times_received} users.')
-            display_func(f'Read by {times_read} users.')
-            display_func('-------------------------------')
+        self.export_statistics(sinks=(TextSink(display_func=display_func),))
@@ -1,3 +1,5 @@
+import atexit
+import queue
 import logging.handlers
 
 LOG_LEVELS = {
@@ -14,6 +16,10 @@ MAX_BYTES = 10000000
 BACKUP_COUNT = 1
 LOG_LEVEL = logging.INFO
 LOGFILE = 'notifications.log'
+QUEUE_SIZE = 10000
+QUEUE_POLICIES = ('block', 'drop')
+QUEUE_POLICY = 'block'
+FLUSH_SIZE = 1 << 20
 
 
 def configure_root_logger(filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, level=LOG_LEVEL):
@@ -26,3 +32,178 @@ def configure_root_logger(filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COU
     formatter = logging.Formatter(fmt=LOG_FORMAT, datefmt=DATETIME_FORMAT)
     handler.setFormatter(formatter)
     return logger
+
+
+class BatchingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotating file handler that keeps formatted records in a buffer and writes them in large batches, checking whether
+    the file must be rotated once per batch instead of once per record.
+    """
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, flush_size=FLUSH_SIZE):
+        """
+        :param filename: Path to the log file.
+        :type filename: str
+        :param max_bytes: Max log size in bytes before rotation.
+        :type max_bytes: int
+        :param backup_count: Max number of backup logs.
+        :type backup_count: int
+        :param flush_size: Number of buffered characters that triggers a write to the file.
+        :type flush_size: int
+        """
+        super().__init__(filename=filename, mode='a', maxBytes=max_bytes, backupCount=backup_count)
+        self.flush_size = flush_size
+        self._buffer = []
+        self._buffered = 0
+
+    def emit(self, record):
+        """
+        Formats a record and adds it to the buffer, writing the buffer to the file if it is full.
+        :param record: Record to log.
+        :type record: logging.LogRecord
+        """
+        try:
+            text = self.format(record) + self.terminator
+        except Exception:
+            self.handleError(record)
+            return
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered record to the file, rotating it first if the batch would exceed the max log size.
+        """
+        self.acquire()
+        try:
+            if self._buffer and self.stream is not None:
+                position = self.stream.tell()
+                if self.maxBytes > 0 and position and position + self._buffered >= self.maxBytes:
+                    self.doRollover()
+                self.stream.write(''.join(self._buffer))
+                self._buffer.clear()
+                self._buffered = 0
+            super().flush()
+        finally:
+            self.release()
+
+    def close(self):
+        """
+        Writes every buffered record to the file and closes it.
+        """
+        self.flush()
+        super().close()
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler for a bounded queue that either blocks the logging thread or drops records when the queue is full.
+    Records are not formatted by this handler, so formatting also happens in the background thread that writes them.
+    """
+
+    def __init__(self, queue, policy=QUEUE_POLICY):
+        """
+        :param queue: Bounded queue where records are put.
+        :type queue: queue.Queue
+        :param policy: What to do when the queue is full: "block" until there is room or "drop" the record.
+        :type policy: str
+        """
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'Queue policy must be one of {QUEUE_POLICIES}.')
+        super().__init__(queue)
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Prepares a record to be put in the queue. Only exception information is rendered here, since tracebacks cannot
+        be formatted once the exception is gone, and the message is left to be merged with its arguments later on.
+        :param record: Record to prepare.
+        :type record: logging.LogRecord
+        :return: The prepared record.
+        :rtype: logging.LogRecord
+        """
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        """
+        Puts a record in the queue according to the policy of the handler.
+        :param record: Record to put in the queue.
+        :type record: logging.LogRecord
+        """
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    Queue listener that flushes its handlers every time it has emptied the queue, so that records are written in
+    batches while the queue is busy and without delay when it is idle.
+    """
+
+    def dequeue(self, block):
+        """
+        Takes a record from the queue, flushing the handlers first if the queue is empty.
+        :param block: Whether to wait for a record.
+        :type block: bool
+        :return: The record.
+        :rtype: logging.LogRecord
+        """
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+        return super().dequeue(block)
+
+    def enqueue_sentinel(self):
+        """
+        Puts the sentinel that stops the listener in the queue, waiting for room if the queue is full instead of
+        failing, so that the listener always stops after writing every pending record.
+        """
+        self.queue.put(self._sentinel)
+
+
+def configure_queue_logger(filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, level=LOG_LEVEL,
+                           queue_size=QUEUE_SIZE, policy=QUEUE_POLICY, flush_size=FLUSH_SIZE):
+    """
+    Configures the root logger to put records in a bounded queue, from which a background thread formats them and writes
+    them to a rotating log file in large batches. The background thread is stopped, and every pending record written,
+    when the program exits.
+    :param filename: Path to the log file.
+    :type filename: str
+    :param max_bytes: Max log size in bytes before rotation.
+    :type max_bytes: int
+    :param backup_count: Max number of backup logs.
+    :type backup_count: int
+    :param level: Logging level.
+    :type level: int
+    :param queue_size: Max number of records waiting in the queue.
+    :type queue_size: int
+    :param policy: What to do when the queue is full: "block" until there is room or "drop" the record.
+    :type policy: str
+    :param flush_size: Number of buffered characters that triggers a write to the file.
+    :type flush_size: int
+    :return: The root logger and the listener of the queue.
+    :rtype: tuple
+    """
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    record_queue = queue.Queue(maxsize=queue_size)
+    logger.addHandler(BoundedQueueHandler(queue=record_queue, policy=policy))
+    handler = BatchingRotatingFileHandler(
+        filename=filename, max_bytes=max_bytes, backup_count=backup_count, flush_size=flush_size
+    )
+    handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT, datefmt=DATETIME_FORMAT))
+    listener = BatchingQueueListener(record_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger, listener
@@ -3,9 +3,39 @@ import argparse
 
 import log
 from delivery import DeliverySystem, LOSS_CHANCE, READ_CHANCE
+from database import SQLiteState
+from throttling import ThrottledDeliverySystem
+from retries import RetryPolicy
+from retention import RetentionPolicy
+from stats import CSVSink, JSONLinesSink, SummarySink
 
 NUM_USERS = 1000
 NUM_MESSAGES = 10
+STATS_FORMATS = ('text', 'summary', 'csv', 'jsonl')
+STATS_FILE_SINKS = {'csv': CSVSink, 'jsonl': JSONLinesSink}
+STATS_BUFFER_SIZE = 1 << 20
+
+
+def export_statistics(ds, stats_format, filename=None):
+    """
+    Exports the statistics of the delivery system in this format: a text report or a summary displayed through the
+    logging package, or a CSV or JSON Lines file with the statistics of every message.
+    :param ds: Delivery system whose statistics are exported.
+    :type ds: DeliverySystem
+    :param stats_format: Format of the statistics.
+    :type stats_format: str
+    :param filename: Path to the statistics file. Defaults to "statistics" with the format as extension.
+    :type filename: str
+    """
+    if stats_format == 'text':
+        ds.show_statistics()
+    elif stats_format == 'summary':
+        ds.export_statistics(sinks=(SummarySink(),))
+    else:
+        filename = filename or f'statistics.{stats_format}'
+        with open(filename, 'w', newline='', buffering=STATS_BUFFER_SIZE, encoding='utf-8') as stats_file:
+            ds.export_statistics(sinks=(STATS_FILE_SINKS[stats_format](stats_file),))
+        logging.info(f'Statistics written to "{filename}".')
 
 
 def main():
@@ -22,6 +52,34 @@ def main():
                         help=f'Message loss chance. Defaults to {LOSS_CHANCE}.')
     parser.add_argument('-rc', '--readchance', type=float, default=READ_CHANCE, metavar='[0-1]',
                         help=f'Message read chance. Defaults to {READ_CHANCE}.')
+    parser.add_argument('-s', '--seed', type=int, default=None,
+                        help='Seed for the random streams of the simulation, to make it reproducible.')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Deliver every broadcast to all users at once instead of one by one.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes to draw the rolls of every broadcast with, splitting users '
+                             'into shards. Storing the deliveries is serial, so this does not scale with the number '
+                             'of workers. Not allowed with a rate limit.')
+    parser.add_argument('-r', '--rate', type=float, default=None,
+                        help='Maximum number of deliveries per second. Deliveries over the limit are queued and the '
+                             'time every broadcast takes is reported on a simulated clock.')
+    parser.add_argument('-ma', '--maxattempts', type=int, default=None,
+                        help='Retry lost deliveries with exponential backoff, up to this number of attempts each.')
+    parser.add_argument('-mi', '--maxinbox', type=int, default=None,
+                        help='Keep at most this number of messages in every inbox, evicting the oldest ones.')
+    parser.add_argument('-ar', '--archiveread', action='store_true',
+                        help='Archive the messages read by every user that received them, releasing their state.')
+    parser.add_argument('-db', '--database', type=str, default=None,
+                        help='Path to a SQLite database to keep users, messages and receipts in, instead of memory.')
+    parser.add_argument('-ss', '--snapshot', type=str, default=None,
+                        help='Path to save a snapshot of the delivery system to when the simulation ends.')
+    parser.add_argument('-rs', '--resume', type=str, default=None,
+                        help='Path to a snapshot to resume the simulation from, instead of registering new users.')
+    parser.add_argument('-sf', '--statsformat', choices=STATS_FORMATS, default='text',
+                        help='Format of the statistics. Defaults to "text".')
+    parser.add_argument('-sp', '--statsfile', type=str, default=None,
+                        help='Path to the statistics file for the csv and jsonl formats. Defaults to "statistics" with '
+                             'the format as extension.')
     parser.add_argument('-o', '--output', choices=('console', 'logfile'), default='console',
                         help='Set program output. Defaults to "console".')
     parser.add_argument('-f', '--logfile', type=str, default=log.LOGFILE,
@@ -32,8 +90,17 @@ def main():
                         help=f'Max log size in bytes before rotation. Defaults to {log.MAX_BYTES}.')
     parser.add_argument('-lb', '--logbackup', type=int, default=log.BACKUP_COUNT,
                         help=f'Max number of backup logs. Defaults to {log.BACKUP_COUNT}.')
+    parser.add_argument('-q', '--logqueue', action='store_true',
+                        help='Write the log file from a background thread, through a bounded queue, in large batches.')
+    parser.add_argument('-qs', '--queuesize', type=int, default=log.QUEUE_SIZE,
+                        help=f'Max number of log records waiting in the queue. Defaults to {log.QUEUE_SIZE}.')
+    parser.add_argument('-qp', '--queuepolicy', choices=log.QUEUE_POLICIES, default=log.QUEUE_POLICY,
+                        help=f'What to do with log records when the queue is full. Defaults to "{log.QUEUE_POLICY}".')
 
     args = parser.parse_args()
+    if args.workers and args.rate:
+        # Throttled deliveries are rolled as they leave the queues, so they cannot be split into shards.
+        parser.error('argument -w/--workers: not allowed with argument -r/--rate')
 
     if args.output.lower() == 'console' or not args.logfile:
         logging.basicConfig(
@@ -41,6 +108,15 @@ def main():
             format=log.LOG_FORMAT,
             datefmt=log.DATETIME_FORMAT
         )
+    elif args.logqueue:
+        log.configure_queue_logger(
+            filename=args.logfile,
+            level=log.LOG_LEVELS[args.loglevel.lower()],
+            max_bytes=args.logsize,
+            backup_count=args.logbackup,
+            queue_size=args.queuesize,
+            policy=args.queuepolicy
+        )
     else:
         log.configure_root_logger(
             filename=args.logfile,
@@ -50,17 +126,36 @@ def main():
         )
 
     logging.info('Launching Notification Simulator.')
-    ds = DeliverySystem(loss_chance=args.losschance, read_chance=args.readchance)
-    logging.info('Registering users...')
-    for _ in range(args.numusers):
-        ds.register_user()
-    logging.info(f'Registered {args.numusers} users.')
+    system_class = ThrottledDeliverySystem if args.rate else DeliverySystem
+    retry_policy = RetryPolicy(max_attempts=args.maxattempts) if args.maxattempts else None
+    retention_policy = None
+    if args.maxinbox is not None or args.archiveread:
+        retention_policy = RetentionPolicy(max_messages=args.maxinbox, archive_read=args.archiveread)
+    if args.resume:
+        ds = system_class.load(path=args.resume, retry_policy=retry_policy, retention_policy=retention_policy)
+    else:
+        state = SQLiteState(path=args.database) if args.database else None
+        ds = system_class(loss_chance=args.losschance, read_chance=args.readchance, seed=args.seed, state=state,
+                          retry_policy=retry_policy, retention_policy=retention_policy)
+        logging.info('Registering users...')
+        ds.register_users(n=args.numusers)
+        logging.info(f'Registered {args.numusers} users.')
     logging.info(f'Creating and sending messages to all registered users....')
+    if args.rate:
+        ds.limit(rate=args.rate)
     for _ in range(args.nummessages):
-        ds.broadcast_message()
+        ds.broadcast_message(batch=args.batch, workers=args.workers)
+        if args.rate:
+            ds.drain()
+        elif args.maxattempts:
+            ds.drain_scheduled()
+        ds.enforce_retention()
     logging.info(f'Created and sent {args.nummessages} messages.')
     logging.info('Displaying system statistics...')
-    ds.show_statistics()
+    export_statistics(ds=ds, stats_format=args.statsformat, filename=args.statsfile)
+    if args.snapshot:
+        ds.save(path=args.snapshot)
+    ds.close()
 
 
 if __name__ == '__main__':
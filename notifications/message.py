@@ -1,6 +1,9 @@
 import logging
 
 from decorators import sort_by_code
+from state import Bitmap, DeliveryState, SENT, RECEIVED, READ
+from tracing import CREATED, get_logging_tracer
+from text import LazyText
 
 logger = logging.getLogger(__name__)
 
@@ -8,45 +11,100 @@ logger = logging.getLogger(__name__)
 class Message(object):
     """
     Message class. Each message has a text string as a body, a numeric code, a list of users to whom it has been sent,
-    a list of users who received the message and a list of users that have opened and read it.
+    a list of users who received the message and a list of users that have opened and read it. These lists are views
+    over a delivery state store, shared with the delivery system that created the message.
     """
-    _body = ''
-    _code = None
-    _sent = None
-    _received = None
-    _read = None
+    __slots__ = ('_body', '_code', '_state', '_views', '__weakref__')
 
-    def __init__(self, body, code):
+    def __init__(self, body, code, state=None):
         """
-        :param body: Text body of the message.
-        :type body: str
+        :param body: Text body of the message, either a string or a lazily built text.
+        :type body: str | LazyText
         :param code: Numeric ID of the message.
         :type code: int
+        :param state: Store where the delivery state of this message is kept. A new one is created if not specified.
+        :type state: DeliveryState
         """
         self.body = body
         self.code = code
-        self._sent = set()
-        self._received = set()
-        self._read = set()
-        logger.debug(f'Created new message with code {self.code} and body "{self.body}".')
+        self._views = None
+        self._state = state if state is not None else DeliveryState(tracer=get_logging_tracer())
+        self._state.add_message(message=self)
+        self._trace(event=CREATED, users=(None,))
+
+    @classmethod
+    def _from_trusted(cls, body, code, state, register=True):
+        """
+        Creates a message in a delivery state store without validating its body and code, for callers such as the
+        delivery system that already know them to be valid.
+        :param body: Body of the message.
+        :type body: str | LazyText
+        :param code: Code of the message, new in the store.
+        :type code: int
+        :param state: Store where the delivery state of the message is kept.
+        :type state: DeliveryState
+        :param register: Whether to add the message to the store. Stores restoring their own messages do not need it.
+        :type register: bool
+        :return: The created message.
+        :rtype: Message
+        """
+        message = cls.__new__(cls)
+        message._body = body
+        message._code = code
+        message._state = state
+        message._views = None
+        if register:
+            state.add_message(message=message)
+            message._trace(event=CREATED, users=(None,))
+        return message
+
+    @classmethod
+    def _create_many(cls, bodies, first_code, state):
+        """
+        Creates several messages with consecutive codes in a delivery state store at once. Bodies and codes are trusted
+        to be valid and the codes to be new in the store, so they are assigned without going through the setters.
+        :param bodies: Bodies of the messages.
+        :type bodies: list
+        :param first_code: Code of the first message. The rest of them get the following codes.
+        :type first_code: int
+        :param state: Store where the delivery state of the messages is kept.
+        :type state: DeliveryState
+        :return: The created messages, ordered by their code.
+        :rtype: list
+        """
+        new = cls.__new__
+        messages = []
+        append = messages.append
+        for code, body in enumerate(bodies, start=first_code):
+            message = new(cls)
+            message._body = body
+            message._code = code
+            message._state = state
+            message._views = None
+            append(message)
+        state.add_messages(messages=messages)
+        if state.tracer is not None:
+            for message in messages:
+                message._trace(event=CREATED, users=(None,))
+        return messages
 
     @property
     def body(self):
         """
-        Getter method for the body of the message.
+        Getter method for the body of the message. Lazily built bodies are built every time they are read.
         :return: the text body of this message.
         :rtype: str
         """
-        return self._body
+        return str(self._body)
 
     @body.setter
     def body(self, body):
         """
         Setter method for the message's body that validates it before assignation.
-        :param body: New text body for this message.
-        :type body: str
+        :param body: New text body for this message, either a string or a lazily built text.
+        :type body: str | LazyText
         """
-        if not isinstance(body, str):
+        if not isinstance(body, (str, LazyText)):
             raise TypeError('Message body must be string.')
         self._body = body
 
@@ -73,34 +131,34 @@ class Message(object):
         self._code = code
 
     @property
-    @sort_by_code()
+    @sort_by_code(version=lambda self: self._state.count(status=SENT, message_code=self._code))
     def users_sent(self):
         """
         Getter method for the set of users that this message was sent to.
         :return: Users to whom this message was sent.
         :rtype: list
         """
-        return self._sent
+        return map(self._state.get_user, self._state.user_codes(status=SENT, message_code=self._code))
 
     @property
-    @sort_by_code()
+    @sort_by_code(version=lambda self: self._state.count(status=RECEIVED, message_code=self._code))
     def users_received(self):
         """
         Getter method for the set of users that received this message.
         :return: Users who received this message.
         :rtype: list
         """
-        return self._received
+        return map(self._state.get_user, self._state.user_codes(status=RECEIVED, message_code=self._code))
 
     @property
-    @sort_by_code()
+    @sort_by_code(version=lambda self: self._state.count(status=READ, message_code=self._code))
     def users_read(self):
         """
         Getter method for the set of users that read this message.
         :return: Users who read this message.
         :rtype: list
         """
-        return self._read
+        return map(self._state.get_user, self._state.user_codes(status=READ, message_code=self._code))
 
     def send(self, user):
         """
@@ -108,8 +166,27 @@ class Message(object):
         :param user: User object to send the message to.
         :type user: User
         """
-        self._sent.add(user)
-        logger.debug(f'Message "{self}" sent to user {user}.')
+        self._state.add_user(user=user)
+        self._state.mark(status=SENT, message_code=self._code, user_codes=(user.code,))
+        self._trace(event=SENT, users=(user,))
+
+    def send_many(self, users, user_codes=None):
+        """
+        Sets the message as sent to all of these users at once.
+        :param users: User objects to send the message to.
+        :type users: iterable
+        :param user_codes: Codes of the users, if they are already gathered in a bitmap. The users must then be in the
+        store already, and they are only iterated to trace the event.
+        :type user_codes: Bitmap
+        """
+        if user_codes is None:
+            users = list(users)
+            for user in users:
+                self._state.add_user(user=user)
+            user_codes = Bitmap(user.code for user in users)
+        self._state.mark(status=SENT, message_code=self._code, user_codes=user_codes)
+        self._trace(event=SENT, users=users)
+        logger.debug('Message "%s" sent to %s users.', self, len(user_codes))
 
     def is_sent(self, user):
         """
@@ -119,7 +196,7 @@ class Message(object):
         :return: True if the message was sent to the user, False otherwise.
         :rtype: bool
         """
-        return user in self._sent
+        return self._state.has(status=SENT, message_code=self._code, user_code=user.code)
 
     def mark_as_received(self, user):
         """
@@ -129,8 +206,26 @@ class Message(object):
         """
         if not self.is_sent(user=user):
             raise ValueError(f'Message "{self}" has not been sent to user {user} so it cannot be marked as received.')
-        self._received.add(user)
-        logger.debug(f'Message "{self}" marked as received by user {user}.')
+        self._state.mark(status=RECEIVED, message_code=self._code, user_codes=(user.code,))
+        self._trace(event=RECEIVED, users=(user,))
+
+    def mark_many_as_received(self, users, user_codes=None):
+        """
+        Sets the message as received by all of these users at once.
+        :param users: User objects that received the message.
+        :type users: iterable
+        :param user_codes: Codes of the users, if they are already gathered in a bitmap. The users are then only
+        iterated to trace the event.
+        :type user_codes: Bitmap
+        """
+        if user_codes is None:
+            users = list(users)
+            user_codes = Bitmap(user.code for user in users)
+        if not self._state.has_all(status=SENT, message_code=self._code, user_codes=user_codes):
+            raise ValueError(f'Message "{self}" has not been sent to every user so it cannot be marked as received.')
+        self._state.mark(status=RECEIVED, message_code=self._code, user_codes=user_codes)
+        self._trace(event=RECEIVED, users=users)
+        logger.debug('Message "%s" marked as received by %s users.', self, len(user_codes))
 
     def is_received(self, user):
         """
@@ -140,7 +235,7 @@ class Message(object):
         :return: True if the user received the message, False otherwise.
         :rtype: bool
         """
-        return user in self._received
+        return self._state.has(status=RECEIVED, message_code=self._code, user_code=user.code)
 
     def mark_as_read(self, user):
         """
@@ -150,8 +245,26 @@ class Message(object):
         """
         if not self.is_received(user=user):
             raise ValueError(f'Message "{self}" has not been received by user {user} so it cannot be marked as read.')
-        self._read.add(user)
-        logger.debug(f'Message "{self}" marked as read by user {user}.')
+        self._state.mark(status=READ, message_code=self._code, user_codes=(user.code,))
+        self._trace(event=READ, users=(user,))
+
+    def mark_many_as_read(self, users, user_codes=None):
+        """
+        Sets the message as opened and read by all of these users at once.
+        :param users: User objects that read the message.
+        :type users: iterable
+        :param user_codes: Codes of the users, if they are already gathered in a bitmap. The users are then only
+        iterated to trace the event.
+        :type user_codes: Bitmap
+        """
+        if user_codes is None:
+            users = list(users)
+            user_codes = Bitmap(user.code for user in users)
+        if not self._state.has_all(status=RECEIVED, message_code=self._code, user_codes=user_codes):
+            raise ValueError(f'Message "{self}" has not been received by every user so it cannot be marked as read.')
+        self._state.mark(status=READ, message_code=self._code, user_codes=user_codes)
+        self._trace(event=READ, users=users)
+        logger.debug('Message "%s" marked as read by %s users.', self, len(user_codes))
 
     def is_read(self, user):
         """
@@ -161,7 +274,21 @@ class Message(object):
         :return: True if the user read the message, False otherwise.
         :rtype: bool
         """
-        return user in self._read
+        return self._state.has(status=READ, message_code=self._code, user_code=user.code)
+
+    def _trace(self, event, users):
+        """
+        Reports a delivery event of this message to the tracer of its store, if there is one. Nothing is formatted or
+        built when there is no tracer, so this is almost free in the delivery hot path.
+        :param event: Delivery event: created, sent, received or read.
+        :type event: str
+        :param users: Users of the event.
+        :type users: iterable
+        """
+        tracer = self._state.tracer
+        if tracer is not None:
+            for user in users:
+                tracer(event, self, user)
 
     def get_statistics(self):
         """
@@ -169,7 +296,7 @@ class Message(object):
         :return: Number of times this message has been sent, received and read.
         :rtype: tuple
         """
-        return len(self.users_sent), len(self.users_received), len(self.users_read)
+        return tuple(self._state.count(status=status, message_code=self._code) for status in (SENT, RECEIVED, READ))
 
     def __repr__(self):
         """
@@ -177,4 +304,4 @@ class Message(object):
         :return: The body of this message.
         :rtype: str
         """
-        return self._body
+        return str(self._body)
@@ -1,4 +1,5 @@
 import random
+from functools import lru_cache
 
 NAMES = (
     'Ana', 'Alicia', 'Amalia', 'Adela', 'Alba', 'Alejandro', 'Alberto', 'Alfonso', 'Aaron', 'Alfredo',
@@ -38,11 +39,37 @@ SURNAMES = (
 )
 
 
-def get_random_name():
+def get_random_name(rng=random):
     """
     Generates a random name from the above name and surname pools.
+    :param rng: Random number generator to draw from, either the "random" module or a "random.Random" instance.
+    :type rng: random.Random
     :return: a randomly generated name.
     :rtype: str
     """
-    fullname = f'{random.choice(NAMES)} {random.choice(SURNAMES)}'
+    fullname = f'{rng.choice(NAMES)} {rng.choice(SURNAMES)}'
     return fullname
+
+
+@lru_cache(maxsize=1)
+def get_full_names():
+    """
+    Builds every combination of a name and a surname from the above pools, once.
+    :return: Every possible full name.
+    :rtype: tuple
+    """
+    return tuple(f'{name} {surname}' for name in NAMES for surname in SURNAMES)
+
+
+def get_random_names(size, rng=random):
+    """
+    Generates several random names at once, drawing them from every possible full name with a single call, so that
+    names are neither formatted one by one nor duplicated in memory.
+    :param size: Number of names to generate.
+    :type size: int
+    :param rng: Random number generator to draw from, either the "random" module or a "random.Random" instance.
+    :type rng: random.Random
+    :return: Randomly generated names.
+    :rtype: list
+    """
+    return rng.choices(get_full_names(), k=size)
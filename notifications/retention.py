@@ -0,0 +1,84 @@
+from collections import namedtuple
+
+EVICTION_BATCH_SIZE = 10000
+
+RetentionReport = namedtuple('RetentionReport', ('evicted', 'released'))
+
+
+class RetentionPolicy(object):
+    """
+    Policy for the messages kept in the inboxes of users: at most a number of messages per inbox, keeping the newest
+    ones, no messages older than a maximum age, and optionally no messages read by every user that received them, which
+    are archived. Messages that leave every inbox release their delivery state for every user, while their statistics
+    are kept.
+    """
+    __slots__ = ('_max_messages', '_max_age', '_archive_read')
+
+    def __init__(self, max_messages=None, max_age=None, archive_read=False):
+        """
+        :param max_messages: Maximum number of messages of every inbox. Unlimited if not specified.
+        :type max_messages: int
+        :param max_age: Maximum time in seconds since a message was first delivered. Unlimited if not specified.
+        :type max_age: float
+        :param archive_read: Whether to archive the messages read by every user that received them.
+        :type archive_read: bool
+        """
+        if max_messages is not None and not isinstance(max_messages, int):
+            raise TypeError('Maximum number of messages must be an integer.')
+        if max_messages is not None and max_messages < 0:
+            raise ValueError('Maximum number of messages must be a positive integer.')
+        if max_age is not None and not isinstance(max_age, (int, float)):
+            raise TypeError('Maximum message age must be a number.')
+        if max_age is not None and max_age < 0:
+            raise ValueError('Maximum message age must be a positive number.')
+        self._max_messages = max_messages
+        self._max_age = max_age
+        self._archive_read = bool(archive_read)
+
+    @property
+    def max_messages(self):
+        """
+        Getter method for the maximum number of messages of every inbox.
+        :return: Maximum number of messages, or None if inboxes are unlimited.
+        :rtype: int
+        """
+        return self._max_messages
+
+    @property
+    def max_age(self):
+        """
+        Getter method for the maximum age of messages.
+        :return: Maximum time in seconds since a message was first delivered, or None if messages never expire.
+        :rtype: float
+        """
+        return self._max_age
+
+    @property
+    def archive_read(self):
+        """
+        Getter method for whether messages read by every user that received them are archived.
+        :return: Whether fully read messages are archived.
+        :rtype: bool
+        """
+        return self._archive_read
+
+    def overflow(self, inbox):
+        """
+        Selects the messages of an inbox beyond the maximum number of messages, which are the oldest ones.
+        :param inbox: Message codes of the inbox, in ascending order.
+        :type inbox: array.array
+        :return: Codes of the messages to evict.
+        :rtype: array.array
+        """
+        if self._max_messages is None or len(inbox) <= self._max_messages:
+            return inbox[:0]
+        return inbox[:len(inbox) - self._max_messages]
+
+    def __repr__(self):
+        """
+        Representation method.
+        :return: Summary of the policy.
+        :rtype: str
+        """
+        return (f'RetentionPolicy(max_messages={self._max_messages}, max_age={self._max_age}, '
+                f'archive_read={self._archive_read})')
@@ -0,0 +1,64 @@
+MAX_ATTEMPTS = 5
+BASE_DELAY = 1.0
+BACKOFF_FACTOR = 2.0
+
+
+class RetryPolicy(object):
+    """
+    Policy for the redelivery of lost messages: every lost delivery is retried after a delay that grows exponentially
+    with the number of attempts made, until the maximum number of attempts is reached.
+    """
+    __slots__ = ('_max_attempts', '_base_delay', '_factor', '_max_delay')
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, factor=BACKOFF_FACTOR, max_delay=None):
+        """
+        :param max_attempts: Maximum number of attempts of every delivery, including the first one.
+        :type max_attempts: int
+        :param base_delay: Time in seconds to wait before the first retry.
+        :type base_delay: float
+        :param factor: Factor the delay is multiplied by for every following retry.
+        :type factor: float
+        :param max_delay: Maximum time in seconds to wait before a retry. Unlimited if not specified.
+        :type max_delay: float
+        """
+        if not isinstance(max_attempts, int):
+            raise TypeError('Maximum number of attempts must be an integer.')
+        if max_attempts < 1:
+            raise ValueError('Maximum number of attempts must be at least 1.')
+        if not all(isinstance(value, (int, float)) for value in (base_delay, factor, max_delay or 0)):
+            raise TypeError('Retry delays and backoff factor must be numbers.')
+        if base_delay < 0 or factor < 1 or (max_delay is not None and max_delay < 0):
+            raise ValueError('Retry delays must be positive and the backoff factor must be at least 1.')
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._factor = factor
+        self._max_delay = max_delay
+
+    @property
+    def max_attempts(self):
+        """
+        Getter method for the maximum number of attempts of every delivery.
+        :return: Maximum number of attempts, including the first one.
+        :rtype: int
+        """
+        return self._max_attempts
+
+    def delay(self, attempt):
+        """
+        Computes the time to wait before an attempt, after the previous one was lost.
+        :param attempt: Number of the attempt, starting at 2 for the first retry.
+        :type attempt: int
+        :return: Time to wait in seconds.
+        :rtype: float
+        """
+        delay = self._base_delay * self._factor ** (attempt - 2)
+        return delay if self._max_delay is None else min(delay, self._max_delay)
+
+    def __repr__(self):
+        """
+        Representation method.
+        :return: Summary of the policy.
+        :rtype: str
+        """
+        return (f'RetryPolicy(max_attempts={self._max_attempts}, base_delay={self._base_delay}, '
+                f'factor={self._factor}, max_delay={self._max_delay})')
@@ -0,0 +1,122 @@
+import random
+import hashlib
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def draw_rolls(size, rng=random):
+    """
+    Draws a block of random rolls in the range [0-1) from this random number generator. When NumPy is available the
+    rolls are drawn in a single vectorized step by a Mersenne Twister that takes over the generator state, so the drawn
+    values and the state the generator is left in are exactly the same as calling "rng.random()" once per roll.
+    :param size: Number of rolls to draw.
+    :type size: int
+    :param rng: Random number generator to draw from, either the "random" module or a "random.Random" instance.
+    :type rng: random.Random
+    :return: The drawn rolls.
+    :rtype: numpy.ndarray | array.array
+    """
+    if numpy is None:
+        return array('d', (rng.random() for _ in range(size)))
+    version, internal_state, gauss_next = rng.getstate()
+    generator = numpy.random.RandomState()
+    generator.set_state(('MT19937', numpy.array(internal_state[:-1], dtype=numpy.uint32), internal_state[-1], 0, 0.0))
+    rolls = generator.random_sample(size)
+    _, keys, position, _, _ = generator.get_state()
+    rng.setstate((version, tuple(keys.tolist()) + (int(position),), gauss_next))
+    return rolls
+
+
+def roll_deliveries(size, loss_chance, read_chance, rng=random):
+    """
+    Simulates the outcome of delivering a message to a number of users at once. Every delivery consumes two rolls, the
+    first one deciding whether the message is received and the second one whether it is read, in the same order as
+    consecutive calls to "DeliverySystem.send_message".
+    :param size: Number of deliveries to simulate.
+    :type size: int
+    :param loss_chance: Chance (0-1) that a sent message will not be received.
+    :type loss_chance: float
+    :param read_chance: Chance (0-1) that a received message will be read.
+    :type read_chance: float
+    :param rng: Random number generator to draw from.
+    :type rng: random.Random
+    :return: Two lists of booleans, stating whether each delivery was received and whether it was read.
+    :rtype: tuple
+    """
+    rolls = draw_rolls(size=2 * size, rng=rng)
+    if numpy is None:
+        received = [roll > loss_chance for roll in rolls[0::2]]
+        read = [is_received and roll < read_chance for is_received, roll in zip(received, rolls[1::2])]
+        return received, read
+    received = rolls[0::2] > loss_chance
+    read = received & (rolls[1::2] < read_chance)
+    return received.tolist(), read.tolist()
+
+
+def derive_seed(*keys):
+    """
+    Derives a 64-bit seed from several keys, so that independent and reproducible random streams can be created for
+    different parts of a simulation, such as the shards of a broadcast.
+    :param keys: Values identifying the random stream, such as a base seed and a shard number.
+    :type keys: int
+    :return: Seed for the random stream.
+    :rtype: int
+    """
+    digest = hashlib.blake2b(repr(keys).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def spawn_rng(seed, *keys):
+    """
+    Creates an independent random number generator for a component of a simulation, seeded from a base seed and the
+    keys identifying the component. Without a base seed, the global state of the "random" module is used instead.
+    :param seed: Base seed of the simulation.
+    :type seed: int
+    :param keys: Values identifying the component, such as its name.
+    :type keys: str
+    :return: Random number generator for the component.
+    :rtype: random.Random
+    """
+    if seed is None:
+        return random
+    return random.Random(derive_seed(seed, *keys))
+
+
+def roll_shard(size, loss_chance, read_chance, seed):
+    """
+    Simulates the outcome of delivering a message to a shard of users with its own random stream. This function is
+    meant to be run in a worker process, so its results are returned as compact byte strings.
+    :param size: Number of users in the shard.
+    :type size: int
+    :param loss_chance: Chance (0-1) that a sent message will not be received.
+    :type loss_chance: float
+    :param read_chance: Chance (0-1) that a received message will be read.
+    :type read_chance: float
+    :param seed: Seed of the random stream of the shard.
+    :type seed: int
+    :return: Two bitsets with a bit per user in shard order, set for the users that received and read the message, so
+    that the process that merges the shards only has to combine them.
+    :rtype: tuple
+    """
+    received, read = roll_deliveries(
+        size=size, loss_chance=loss_chance, read_chance=read_chance, rng=random.Random(seed)
+    )
+    return pack_flags(received), pack_flags(read)
+
+
+def pack_flags(flags):
+    """
+    Packs a sequence of flags into a bitset, where the bit of every position whose flag is set is set too.
+    :param flags: Flags to pack.
+    :type flags: list
+    :return: Bytes of the bitset, least significant bit first.
+    :rtype: bytes
+    """
+    if numpy is not None:
+        return numpy.packbits(numpy.asarray(flags, dtype=bool), bitorder='little').tobytes()
+    value = int(''.join('1' if flag else '0' for flag in reversed(flags)) or '0', 2)
+    return value.to_bytes((len(flags) + 7) // 8, 'little')
@@ -0,0 +1,164 @@
+import heapq
+from array import array
+from math import ceil, floor
+
+from state import Bitmap
+
+RESOLUTION = 1.0
+# Digits kept when converting times to slots, so that float errors do not move a time to the next slot.
+PRECISION = 9
+
+
+class SimulatedClock(object):
+    """
+    Clock whose time only moves forward when it is advanced, so that scheduled deliveries can be simulated without
+    waiting for them. It is called like "time.time" to read the current time.
+    """
+    __slots__ = ('_now',)
+
+    def __init__(self, start=0.0):
+        """
+        :param start: Initial time of the clock, in seconds.
+        :type start: float
+        """
+        if not isinstance(start, (int, float)):
+            raise TypeError('Clock time must be a number.')
+        self._now = start
+
+    def __call__(self):
+        """
+        Reads the current time of the clock.
+        :return: Current time, in seconds.
+        :rtype: float
+        """
+        return self._now
+
+    def advance(self, seconds):
+        """
+        Moves the clock forward.
+        :param seconds: Number of seconds to move forward.
+        :type seconds: float
+        :return: The new time of the clock.
+        :rtype: float
+        """
+        if not isinstance(seconds, (int, float)):
+            raise TypeError('Clock increments must be numbers.')
+        if seconds < 0:
+            raise ValueError('Clocks can only be moved forward.')
+        self._now += seconds
+        return self._now
+
+
+class Scheduler(object):
+    """
+    Queue of pending deliveries ordered by the time they are due. Time is split into slots of a fixed resolution, as in
+    a timing wheel: every slot holds the codes of the users every message is due to, and a heap holds the slots with
+    pending deliveries. Scheduling and popping a slot cost O(log n) on the number of pending slots, and every delivery
+    scheduled to an existing slot only costs appending its user code to an array, so millions of pending deliveries
+    take a few bytes each. Deliveries are never due before their time, but they may be delayed up to the resolution.
+    """
+    __slots__ = ('_resolution', '_heap', '_slots', '_pending')
+
+    def __init__(self, resolution=RESOLUTION):
+        """
+        :param resolution: Length of every slot, in seconds.
+        :type resolution: float
+        """
+        if not isinstance(resolution, (int, float)):
+            raise TypeError('Scheduler resolution must be a number.')
+        if resolution <= 0:
+            raise ValueError('Scheduler resolution must be a positive number.')
+        self._resolution = resolution
+        self._heap = []
+        self._slots = {}
+        self._pending = 0
+
+    @property
+    def resolution(self):
+        """
+        Getter method for the length of every slot.
+        :return: Length of every slot, in seconds.
+        :rtype: float
+        """
+        return self._resolution
+
+    def schedule(self, at, message_code, user_codes, attempt=1):
+        """
+        Schedules the delivery of a message to several users.
+        :param at: Time the deliveries are due, in seconds.
+        :type at: float
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_codes: Codes of the users. Bitmaps are kept as they are, without listing their codes.
+        :type user_codes: iterable | Bitmap
+        :param attempt: Number of the delivery attempt, greater than 1 for the retries of lost deliveries. Every attempt
+        is kept apart, so that due deliveries are batched by message and attempt.
+        :type attempt: int
+        :return: Number of deliveries scheduled.
+        :rtype: int
+        """
+        slot = ceil(round(at / self._resolution, PRECISION))
+        deliveries = self._slots.get(slot)
+        if deliveries is None:
+            deliveries = self._slots[slot] = {}
+            heapq.heappush(self._heap, slot)
+        key = (message_code, attempt)
+        entry = deliveries.get(key)
+        if entry is None:
+            entry = deliveries[key] = [array('q'), None]
+        if isinstance(user_codes, Bitmap):
+            # Bitmaps may belong to segments, so they are merged into new ones instead of being updated in place.
+            entry[1] = user_codes if entry[1] is None else entry[1] | user_codes
+            scheduled = len(user_codes)
+        else:
+            scheduled = len(entry[0])
+            entry[0].extend(user_codes)
+            scheduled = len(entry[0]) - scheduled
+        self._pending += scheduled
+        return scheduled
+
+    def next_due(self):
+        """
+        Retrieves the time the next pending deliveries are due.
+        :return: Time of the first slot with pending deliveries, or None if there are none.
+        :rtype: float
+        """
+        return self._heap[0] * self._resolution if self._heap else None
+
+    def pop_due(self, until):
+        """
+        Removes the deliveries due up to a time, one batch per slot, message and attempt. Deliveries scheduled while
+        the batches are consumed are also removed if they are due.
+        :param until: Time up to which deliveries are due, in seconds.
+        :type until: float
+        :return: Time, message code, attempt and sorted user codes of every batch, in order of time, message code and
+        attempt.
+        :rtype: generator
+        """
+        last = floor(round(until / self._resolution, PRECISION))
+        while self._heap and self._heap[0] <= last:
+            slot = heapq.heappop(self._heap)
+            deliveries = self._slots.pop(slot)
+            for message_code, attempt in sorted(deliveries):
+                codes, bitmap = deliveries.pop((message_code, attempt))
+                self._pending -= len(codes) + (len(bitmap) if bitmap is not None else 0)
+                user_codes = set(codes)
+                if bitmap is not None:
+                    user_codes.update(bitmap)
+                yield slot * self._resolution, message_code, attempt, sorted(user_codes)
+
+    def message_codes(self):
+        """
+        Retrieves the codes of the messages with pending deliveries.
+        :return: Message codes.
+        :rtype: set
+        """
+        return {message_code for deliveries in self._slots.values() for message_code, _ in deliveries}
+
+    def __len__(self):
+        """
+        Retrieves the number of pending deliveries.
+        :return: Number of deliveries scheduled and not popped yet.
+        :rtype: int
+        """
+        return self._pending
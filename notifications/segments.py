@@ -0,0 +1,118 @@
+from state import Bitmap
+
+
+class Segment(object):
+    """
+    Named set of user codes that messages can be sent to, such as the users matching a predicate, an explicit list of
+    users or a range of codes. Members are precomputed into a bitmap when the segment is defined, so sending to a
+    segment only visits its members, and segments can be combined with the "|", "&" and "-" operators, which work on
+    whole bitsets at once instead of on users.
+    """
+    __slots__ = ('_name', '_codes')
+
+    def __init__(self, name, codes=()):
+        """
+        :param name: Name of the segment.
+        :type name: str
+        :param codes: Codes of the users of the segment.
+        :type codes: iterable | Bitmap
+        """
+        if not isinstance(name, str):
+            raise TypeError('Segment name must be string.')
+        self._name = name
+        self._codes = codes if isinstance(codes, Bitmap) else Bitmap(codes)
+
+    @classmethod
+    def from_users(cls, name, users):
+        """
+        Defines a segment with an explicit list of users.
+        :param name: Name of the segment.
+        :type name: str
+        :param users: Users of the segment.
+        :type users: iterable
+        :return: The segment.
+        :rtype: Segment
+        """
+        return cls(name=name, codes=(user.code for user in users))
+
+    @classmethod
+    def from_range(cls, name, start, stop):
+        """
+        Defines a segment with every user code in a range.
+        :param name: Name of the segment.
+        :type name: str
+        :param start: First code of the range.
+        :type start: int
+        :param stop: Code after the last one of the range.
+        :type stop: int
+        :return: The segment.
+        :rtype: Segment
+        """
+        if not isinstance(start, int) or not isinstance(stop, int):
+            raise TypeError('Segment range limits must be integers.')
+        if start < 0 or stop < 0:
+            raise ValueError('Segment range limits must be positive integers.')
+        return cls(name=name, codes=Bitmap.fromrange(start, stop))
+
+    @classmethod
+    def from_predicate(cls, name, users, predicate):
+        """
+        Defines a segment with the users matching a predicate. The predicate is evaluated once, when the segment is
+        defined, so users registered afterwards are not included.
+        :param name: Name of the segment.
+        :type name: str
+        :param users: Users to evaluate.
+        :type users: iterable
+        :param predicate: Function that receives a user and returns whether they belong to the segment.
+        :type predicate: function
+        :return: The segment.
+        :rtype: Segment
+        """
+        return cls(name=name, codes=(user.code for user in users if predicate(user)))
+
+    @property
+    def name(self):
+        """
+        Getter method for the name of the segment.
+        :return: Name of the segment.
+        :rtype: str
+        """
+        return self._name
+
+    @property
+    def codes(self):
+        """
+        Getter method for the user codes of the segment.
+        :return: Bitmap with the codes of the users of the segment.
+        :rtype: Bitmap
+        """
+        return self._codes
+
+    def __or__(self, other):
+        return Segment(name=f'({self._name} | {other._name})', codes=self._codes | other._codes)
+
+    def __and__(self, other):
+        return Segment(name=f'({self._name} & {other._name})', codes=self._codes & other._codes)
+
+    def __sub__(self, other):
+        return Segment(name=f'({self._name} - {other._name})', codes=self._codes - other._codes)
+
+    def __contains__(self, user):
+        return user.code in self._codes
+
+    def __iter__(self):
+        """
+        Iterates over the user codes of the segment in ascending order.
+        """
+        return iter(self._codes)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __repr__(self):
+        """
+        Representation method.
+        :return: Name of the segment.
+        :rtype: str
+        """
+        return self._name
@@ -0,0 +1,369 @@
+import os
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from user import User
+from message import Message
+from state import Bitmap, DeliveryState, STATUSES
+from scheduler import SimulatedClock
+from text import LazyText
+
+MAGIC = b'NOTIFSNP'
+VERSION = 3
+HEADER = struct.Struct('<8sQQ')
+ALIGNMENT = 8
+INBOX = 'inbox'
+STR_BODY = 0
+LAZY_BODY = 1
+
+
+class SnapshotMapping(dict):
+    """
+    Dictionary of a delivery state store restored from a snapshot. Its keys are known from the start, but every value
+    is only decoded from the snapshot the first time it is read, so that opening a snapshot does not depend on its size.
+    Iterating over the mapping decodes every pending value first, keeping the order of the keys.
+    """
+
+    def __init__(self, keys, load):
+        """
+        :param keys: Keys stored in the snapshot, in ascending order.
+        :type keys: memoryview
+        :param load: Function that decodes the value at a position of the keys.
+        :type load: function
+        """
+        super().__init__()
+        self._keys = keys
+        self._load = load
+        self._deleted = set()
+        self._complete = not keys
+
+    def _position(self, key):
+        """
+        Finds the position of a key among the keys stored in the snapshot.
+        :param key: Key to find.
+        :type key: int
+        :return: Position of the key, or None if it is not stored in the snapshot or it was deleted.
+        :rtype: int
+        """
+        if self._complete or key in self._deleted:
+            return None
+        position = bisect_left(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            return position
+        return None
+
+    def __missing__(self, key):
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        value = self[key] = self._load(position)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        value = self.get(key)
+        if value is None:
+            value = self[key] = default
+        return value
+
+    def pop(self, key, *default):
+        self.get(key)
+        self._deleted.add(key)
+        return super().pop(key, *default)
+
+    def __delitem__(self, key):
+        self.get(key)
+        self._deleted.add(key)
+        super().__delitem__(key)
+
+    def __contains__(self, key):
+        return super().__contains__(key) or self._position(key) is not None
+
+    def load_all(self):
+        """
+        Decodes every pending value, placing the values stored in the snapshot first, in key order, followed by the
+        ones added afterwards.
+        """
+        if self._complete:
+            return
+        added = {key: value for key, value in super().items() if self._position(key) is None}
+        values = [self[key] for key in self._keys if key not in self._deleted]
+        super().clear()
+        super().update(zip((key for key in self._keys if key not in self._deleted), values))
+        super().update(added)
+        self._complete = True
+
+    def keys(self):
+        self.load_all()
+        return super().keys()
+
+    def values(self):
+        self.load_all()
+        return super().values()
+
+    def items(self):
+        self.load_all()
+        return super().items()
+
+    def __iter__(self):
+        self.load_all()
+        return super().__iter__()
+
+    def __len__(self):
+        self.load_all()
+        return super().__len__()
+
+
+class SnapshotWriter(object):
+    """
+    Writer of the sections of a snapshot file. Every section is a block of bytes aligned to 8 bytes, so that integer
+    arrays can be read in place from a memory map.
+    """
+
+    def __init__(self, file):
+        """
+        :param file: Binary file where sections are written, positioned right after the header.
+        :type file: io.BufferedWriter
+        """
+        self.file = file
+        self.sections = {}
+        self.offset = 0
+
+    def write(self, name, data):
+        """
+        Writes a section.
+        :param name: Name of the section.
+        :type name: str
+        :param data: Contents of the section.
+        :type data: bytes | array.array
+        """
+        data = memoryview(data).cast('B')
+        self.file.write(data)
+        self.sections[name] = (self.offset, len(data))
+        padding = -len(data) % ALIGNMENT
+        self.file.write(bytes(padding))
+        self.offset += len(data) + padding
+
+    def write_blobs(self, name, blobs):
+        """
+        Writes a series of byte strings as a section of concatenated data and a section of offsets, with the start of
+        every byte string and the end of the last one.
+        :param name: Name of the sections.
+        :type name: str
+        :param blobs: Byte strings to write.
+        :type blobs: iterable
+        """
+        offsets = array('q', [0])
+        data = bytearray()
+        for blob in blobs:
+            data += blob
+            offsets.append(len(data))
+        self.write(name=name, data=data)
+        self.write(name=f'{name}_offsets', data=offsets)
+
+
+def _get_rng_states(system):
+    """
+    Retrieves the state of the random streams of a delivery system, if they do not use the global "random" module.
+    :param system: Delivery system.
+    :type system: DeliverySystem
+    :return: State of every random stream by name, or None if the system is not seeded.
+    :rtype: dict
+    """
+    if system.seed is None:
+        return None
+    return {name: getattr(system, name).getstate() for name in ('_rng', '_names_rng', '_text_rng')}
+
+
+def save_snapshot(system, path):
+    """
+    Saves the users, messages, counters and delivery state of a delivery system in a snapshot file. The file starts
+    with a header and a JSON block with the settings of the system and the position of every section, followed by
+    binary sections: arrays of codes, tables of names and bodies, the bitmaps of every message, the inboxes, unread
+    and evicted messages of every user and the time every retained message was first delivered. The file is written
+    aside and then moved into place, so that a snapshot that is mapped in memory can be safely overwritten.
+    :param system: Delivery system to save.
+    :type system: DeliverySystem
+    :param path: Path of the snapshot file.
+    :type path: str
+    """
+    state = system._state
+    if not isinstance(state, DeliveryState):
+        raise TypeError('Only delivery systems kept in memory can be saved as snapshots.')
+    users = sorted(state._users.items())
+    messages = sorted(state._messages.items())
+    message_codes = array('q', (code for code, _ in messages))
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(bytes(HEADER.size))
+        writer = SnapshotWriter(file=file)
+
+        writer.write(name='user_codes', data=array('q', (code for code, _ in users)))
+        names = {}
+        name_indexes = array('q', (names.setdefault(user.name, len(names)) for _, user in users))
+        writer.write(name='user_names', data=name_indexes)
+        writer.write_blobs(name='names', blobs=(name.encode() for name in names))
+        del names, name_indexes, users
+
+        writer.write(name='message_codes', data=message_codes)
+        bodies = [message._body for _, message in messages]
+        writer.write(name='body_kinds', data=bytes(LAZY_BODY if isinstance(body, LazyText) else STR_BODY
+                                                   for body in bodies))
+        writer.write_blobs(name='bodies', blobs=(body if isinstance(body, LazyText) else body.encode()
+                                                 for body in bodies))
+        del bodies, messages
+
+        for status in STATUSES:
+            column = state._columns[status]
+            writer.write_blobs(name=status, blobs=(
+                column[code].tobytes() if code in column else b'' for code in message_codes
+            ))
+            writer.write(name=f'{status}_counts', data=array('q', (
+                state._counts[status][code] for code in message_codes
+            )))
+        writer.write_blobs(name=INBOX, blobs=(
+            state._inbox_index[code].tobytes() if code in state._inbox_index else b'' for code in message_codes
+        ))
+
+        inboxes = sorted(state._inboxes.items())
+        writer.write(name='inbox_users', data=array('q', (code for code, _ in inboxes)))
+        writer.write_blobs(name='inboxes', blobs=(inbox.tobytes() for _, inbox in inboxes))
+        del inboxes
+
+        unread = sorted(state._unread.items())
+        writer.write(name='unread_users', data=array('q', (code for code, _ in unread)))
+        writer.write_blobs(name='unread', blobs=(inbox.tobytes() for _, inbox in unread))
+        del unread
+
+        evicted = sorted(state._evicted.items())
+        writer.write(name='evicted_users', data=array('q', (code for code, _ in evicted)))
+        writer.write(name='evicted_counts', data=array('q', (count for _, count in evicted)))
+        del evicted
+        # First delivery times are kept in the order they were recorded, which retention relies on.
+        writer.write(name='first_sent_codes', data=array('q', state._first_sent.keys()))
+        writer.write(name='first_sent_times', data=array('d', state._first_sent.values()))
+        writer.write(name='released', data=state._released.tobytes())
+
+        metadata = json.dumps({
+            'loss_chance': system.loss_chance,
+            'read_chance': system.read_chance,
+            'seed': system.seed,
+            'user_count': system._user_count,
+            'message_count': system._message_count,
+            'rng_states': _get_rng_states(system),
+            'retried': list(system._retried.items()),
+            'clock': system._clock(),
+            'sections': writer.sections,
+        }).encode()
+        file.write(metadata)
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, len(metadata)))
+    os.replace(temporary, path)
+
+
+def load_snapshot(cls, path, clock=None, retry_policy=None, deduplicator=None, retention_policy=None):
+    """
+    Opens a snapshot file as a new delivery system. The file is mapped in memory and only its header and counters are
+    read up front: users, messages, bitmaps and inboxes are decoded from the mapped pages the first time they are used,
+    so opening a large snapshot is almost instant. Changes made to the restored system are kept in memory and never
+    written back to the file.
+    Snapshots hold the delivery state, the counters, the random streams and the simulated time, but not the
+    configuration of the system: policies, the deduplicator, segments, deliveries scheduled for retry and channel rate
+    limits are not restored, and the system comes back with a simulated clock stopped at the saved time unless another
+    clock is given.
+    :param cls: Class of the delivery system to create.
+    :type cls: type
+    :param path: Path of the snapshot file.
+    :type path: str
+    :param clock: Function that returns the current time in seconds, such as "time.time". Defaults to a simulated
+    clock starting at the saved time.
+    :type clock: function
+    :param retry_policy: Policy to retry lost deliveries of the restored system with.
+    :type retry_policy: RetryPolicy
+    :param deduplicator: Layer that drops repeated deliveries of the restored system.
+    :type deduplicator: BaseDeduplicator
+    :param retention_policy: Policy for the messages kept in inboxes of the restored system.
+    :type retention_policy: RetentionPolicy
+    :return: The restored delivery system.
+    :rtype: DeliverySystem
+    """
+    with open(path, 'rb') as file:
+        data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, version, metadata_size = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC:
+        raise ValueError(f'File {path} is not a delivery system snapshot.')
+    if version != VERSION:
+        raise ValueError(f'Unsupported snapshot version {version}.')
+    metadata = json.loads(bytes(data[len(data) - metadata_size:]))
+    sections = data[HEADER.size:len(data) - metadata_size]
+
+    def section(name, fmt='B'):
+        offset, size = metadata['sections'][name]
+        return sections[offset:offset + size].cast(fmt)
+
+    def blob(name, position):
+        offsets = section(f'{name}_offsets', 'q')
+        return section(name)[offsets[position]:offsets[position + 1]]
+
+    if clock is None:
+        clock = SimulatedClock(start=metadata['clock'])
+    system = cls(loss_chance=metadata['loss_chance'], read_chance=metadata['read_chance'], seed=metadata['seed'],
+                 clock=clock, retry_policy=retry_policy, deduplicator=deduplicator, retention_policy=retention_policy)
+    system._user_count = metadata['user_count']
+    system._message_count = metadata['message_count']
+    system._retried.update(dict(metadata['retried']))
+    for name, rng_state in (metadata['rng_states'] or {}).items():
+        version, internal_state, gauss_next = rng_state
+        getattr(system, name).setstate((version, tuple(internal_state), gauss_next))
+
+    state = system._state
+    user_codes, user_names = section('user_codes', 'q'), section('user_names', 'q')
+    message_codes, body_kinds = section('message_codes', 'q'), section('body_kinds')
+
+    names = {}
+
+    def load_user(position):
+        index = user_names[position]
+        name = names.get(index)
+        if name is None:
+            name = names[index] = str(blob('names', index), 'utf-8')
+        return User._from_trusted(name=name, code=user_codes[position], state=state, register=False)
+
+    def load_message(position):
+        body = blob('bodies', position)
+        body = LazyText(body) if body_kinds[position] == LAZY_BODY else str(body, 'utf-8')
+        return Message._from_trusted(body=body, code=message_codes[position], state=state, register=False)
+
+    def load_bitmaps(name):
+        return lambda position: Bitmap.frombytes(blob(name, position))
+
+    def load_inbox(name):
+        def load(position):
+            inbox = array('q')
+            inbox.frombytes(blob(name, position))
+            return inbox
+        return load
+
+    state._users = SnapshotMapping(keys=user_codes, load=load_user)
+    state._messages = SnapshotMapping(keys=message_codes, load=load_message)
+    for status in STATUSES:
+        state._columns[status] = SnapshotMapping(keys=message_codes, load=load_bitmaps(status))
+        state._counts[status] = Counter({
+            code: count for code, count in zip(message_codes, section(f'{status}_counts', 'q')) if count
+        })
+    state._inbox_index = SnapshotMapping(keys=message_codes, load=load_bitmaps(INBOX))
+    state._inboxes = SnapshotMapping(keys=section('inbox_users', 'q'), load=load_inbox('inboxes'))
+    state._unread = SnapshotMapping(keys=section('unread_users', 'q'), load=load_inbox('unread'))
+    state._evicted = Counter(dict(zip(section('evicted_users', 'q'), section('evicted_counts', 'q'))))
+    state._first_sent = dict(zip(section('first_sent_codes', 'q'), section('first_sent_times', 'd')))
+    state._released = Bitmap.frombytes(section('released'))
+    return system
@@ -0,0 +1,1045 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+SENT = 'sent'
+RECEIVED = 'received'
+READ = 'read'
+STATUSES = (SENT, RECEIVED, READ)
+# Bytes of a bitmap checked at once when looking for codes, so that empty stretches are skipped in bulk.
+SCAN_CHUNK = 512
+# Positions of the set bits of every byte.
+BYTE_BITS = tuple(tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256))
+
+
+class Bitmap(object):
+    """
+    Growable set of non-negative integer codes stored as a bitset, using a single bit per code.
+    """
+    __slots__ = ('_bits',)
+
+    def __init__(self, codes=()):
+        """
+        :param codes: Initial codes of the bitmap.
+        :type codes: iterable
+        """
+        self._bits = bytearray()
+        self.update(codes)
+
+    @classmethod
+    def frombytes(cls, data, start=0):
+        """
+        Creates a bitmap from the bytes of a bitset, as returned by "tobytes".
+        :param data: Bytes of the bitset.
+        :type data: bytes | memoryview
+        :param start: Code of the first bit of the bitset, if it does not start at zero.
+        :type start: int
+        :return: The bitmap.
+        :rtype: Bitmap
+        """
+        if start:
+            return cls._fromint(int.from_bytes(data, 'little') << start)
+        bitmap = cls()
+        bitmap._bits = bytearray(data)
+        return bitmap
+
+    def tobytes(self):
+        """
+        Retrieves the bytes of the bitset, where the bit of every code is set.
+        :return: Bytes of the bitset.
+        :rtype: bytes
+        """
+        return bytes(self._bits)
+
+    @classmethod
+    def fromrange(cls, start, stop):
+        """
+        Creates a bitmap with every code in a range, setting all of their bits at once.
+        :param start: First code of the range.
+        :type start: int
+        :param stop: Code after the last one of the range.
+        :type stop: int
+        :return: The bitmap.
+        :rtype: Bitmap
+        """
+        return cls._fromint(((1 << stop) - (1 << start)) if stop > start else 0)
+
+    @classmethod
+    def _fromint(cls, value):
+        """
+        Creates a bitmap from an integer whose set bits are its codes.
+        :param value: Integer with the bit of every code set.
+        :type value: int
+        :return: The bitmap.
+        :rtype: Bitmap
+        """
+        bitmap = cls()
+        bitmap._bits = bytearray(value.to_bytes((value.bit_length() + 7) // 8, 'little'))
+        return bitmap
+
+    def _toint(self):
+        return int.from_bytes(self._bits, 'little')
+
+    @property
+    def nbytes(self):
+        """
+        Getter method for the size of the bitset.
+        :return: Number of bytes used to store the bitset.
+        :rtype: int
+        """
+        return len(self._bits)
+
+    def add(self, code):
+        """
+        Adds a code to the bitmap.
+        :param code: Code to add.
+        :type code: int
+        :return: False if the code was already in the bitmap, True otherwise.
+        :rtype: bool
+        """
+        index, mask = code >> 3, 1 << (code & 7)
+        if index >= len(self._bits):
+            self._bits.extend(bytes(index - len(self._bits) + 1))
+        elif self._bits[index] & mask:
+            return False
+        self._bits[index] |= mask
+        return True
+
+    def discard(self, code):
+        """
+        Removes a code from the bitmap.
+        :param code: Code to remove.
+        :type code: int
+        :return: False if the code was not in the bitmap, True otherwise.
+        :rtype: bool
+        """
+        index, mask = code >> 3, 1 << (code & 7)
+        if index >= len(self._bits) or not self._bits[index] & mask:
+            return False
+        self._bits[index] &= ~mask
+        return True
+
+    def update(self, codes):
+        """
+        Adds several codes to the bitmap.
+        :param codes: Codes to add.
+        :type codes: iterable
+        :return: Number of codes that were not in the bitmap yet.
+        :rtype: int
+        """
+        if isinstance(codes, Bitmap):
+            added = bin(int.from_bytes(codes._bits, 'little') & ~int.from_bytes(self._bits, 'little')).count('1')
+            self |= codes
+            return added
+        added = 0
+        bits = self._bits
+        for code in codes:
+            index, mask = code >> 3, 1 << (code & 7)
+            if index >= len(bits):
+                bits.extend(bytes(index - len(bits) + 1))
+            elif bits[index] & mask:
+                continue
+            bits[index] |= mask
+            added += 1
+        return added
+
+    def issuperset(self, other):
+        """
+        Checks if every code of another bitmap is in this bitmap.
+        :param other: Bitmap to compare with.
+        :type other: Bitmap
+        :return: Whether this bitmap contains the other one.
+        :rtype: bool
+        """
+        return int.from_bytes(other._bits, 'little') & ~int.from_bytes(self._bits, 'little') == 0
+
+    def __ior__(self, other):
+        size = max(len(self._bits), len(other._bits))
+        bits = int.from_bytes(self._bits, 'little') | int.from_bytes(other._bits, 'little')
+        self._bits = bytearray(bits.to_bytes(size, 'little'))
+        return self
+
+    def __or__(self, other):
+        return Bitmap._fromint(self._toint() | other._toint())
+
+    def __and__(self, other):
+        return Bitmap._fromint(self._toint() & other._toint())
+
+    def __sub__(self, other):
+        return Bitmap._fromint(self._toint() & ~other._toint())
+
+    def __contains__(self, code):
+        index = code >> 3
+        return index < len(self._bits) and bool(self._bits[index] & (1 << (code & 7)))
+
+    def __iter__(self):
+        """
+        Iterates over the codes of the bitmap in ascending order. Chunks of bytes without codes are skipped with a
+        single count, so sparse bitmaps with high codes are iterated without visiting every byte.
+        """
+        bits = self._bits
+        for start in range(0, len(bits), SCAN_CHUNK):
+            stop = min(start + SCAN_CHUNK, len(bits))
+            if bits.count(0, start, stop) == stop - start:
+                continue
+            for index in range(start, stop):
+                byte = bits[index]
+                if byte:
+                    code = index << 3
+                    for bit in BYTE_BITS[byte]:
+                        yield code | bit
+
+    def __len__(self):
+        return bin(int.from_bytes(self._bits, 'little')).count('1')
+
+
+def _insert_sorted(codes, code):
+    """
+    Inserts a code into a sorted array of codes, keeping it sorted.
+    :param codes: Sorted array of codes.
+    :type codes: array.array
+    :param code: Code to insert.
+    :type code: int
+    """
+    # Messages are usually received in code order, so appending is the common case.
+    if not codes or codes[-1] < code:
+        codes.append(code)
+    else:
+        codes.insert(bisect_left(codes, code), code)
+
+
+def _remove_sorted(codes, code):
+    """
+    Removes a code from a sorted array of codes, if it is there.
+    :param codes: Sorted array of codes.
+    :type codes: array.array
+    :param code: Code to remove.
+    :type code: int
+    """
+    index = bisect_left(codes, code)
+    if index < len(codes) and codes[index] == code:
+        del codes[index]
+
+
+class BaseDeliveryState(object):
+    """
+    Interface of the stores with the delivery state of a set of users and messages, which the delivery system, its
+    users and its messages are backed by. Users and messages are identified by their codes, and every message has a
+    set of user codes for each delivery status (sent, received and read), while every user has an inbox with message
+    codes. Stores also map codes to the user and message objects themselves, and hold the tracer that users and
+    messages report their delivery events to, if any.
+    """
+    tracer = None
+
+    def add_user(self, user):
+        """
+        Adds a user to the store, unless there is already a user with the same code.
+        :param user: User to add.
+        :type user: User
+        """
+        raise NotImplementedError
+
+    def add_users(self, users):
+        """
+        Adds several users to the store at once. Their codes must not be in the store yet.
+        :param users: Users to add.
+        :type users: list
+        """
+        raise NotImplementedError
+
+    def get_user(self, code):
+        """
+        Retrieves a user of the store by its code.
+        :param code: Code of the user.
+        :type code: int
+        :return: The user with this code, or None if there is no such user.
+        :rtype: User
+        """
+        raise NotImplementedError
+
+    def users(self):
+        """
+        Retrieves every user of the store.
+        :return: Users of the store, ordered by their code.
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def add_message(self, message):
+        """
+        Adds a message to the store, unless there is already a message with the same code.
+        :param message: Message to add.
+        :type message: Message
+        """
+        raise NotImplementedError
+
+    def add_messages(self, messages):
+        """
+        Adds several messages to the store at once. Their codes must not be in the store yet.
+        :param messages: Messages to add.
+        :type messages: list
+        """
+        raise NotImplementedError
+
+    def get_message(self, code):
+        """
+        Retrieves a message of the store by its code.
+        :param code: Code of the message.
+        :type code: int
+        :return: The message with this code, or None if there is no such message.
+        :rtype: Message
+        """
+        raise NotImplementedError
+
+    def messages(self):
+        """
+        Retrieves every message of the store.
+        :return: Messages of the store, ordered by their code.
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def iter_messages(self):
+        """
+        Iterates over every message of the store without building a list.
+        :return: Messages of the store, ordered by their code.
+        :rtype: iterator
+        """
+        raise NotImplementedError
+
+    def last_codes(self):
+        """
+        Retrieves the highest codes in the store, so that a delivery system can go on assigning codes after them.
+        :return: Highest user code and highest message code, or zero if there are none.
+        :rtype: tuple
+        """
+        raise NotImplementedError
+
+    def mark(self, status, message_code, user_codes):
+        """
+        Sets this delivery status of a message for several users.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_codes: Codes of the users.
+        :type user_codes: iterable | Bitmap
+        """
+        raise NotImplementedError
+
+    def mark_read(self, user_code, message_codes):
+        """
+        Sets several messages as read by a user at once.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_codes: Codes of the messages.
+        :type message_codes: iterable
+        """
+        for message_code in message_codes:
+            self.mark(status=READ, message_code=message_code, user_codes=(user_code,))
+
+    def count(self, status, message_code):
+        """
+        Retrieves the number of users for whom a message has this delivery status.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def has_all(self, status, message_code, user_codes):
+        """
+        Checks this delivery status of a message for several users.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_codes: Codes of the users.
+        :type user_codes: Bitmap
+        :return: Whether the message has this status for all of the users.
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def has(self, status, message_code, user_code):
+        """
+        Checks this delivery status of a message for a user.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Whether the message has this status for the user.
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def user_codes(self, status, message_code):
+        """
+        Retrieves the codes of the users for whom a message has this delivery status.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: User codes, in ascending order.
+        :rtype: iterator
+        """
+        raise NotImplementedError
+
+    def add_to_inbox(self, user_code, message_code):
+        """
+        Stores a message code in the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: False if the message was already in the inbox, True otherwise.
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def add_to_inboxes(self, user_codes, message_code):
+        """
+        Stores a message code in the inbox of several users.
+        :param user_codes: Codes of the users.
+        :type user_codes: iterable
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users that did not have the message in their inbox yet.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def in_inbox(self, user_code, message_code):
+        """
+        Checks if a message code is stored in the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Whether the message is in the inbox.
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def inbox(self, user_code):
+        """
+        Retrieves the message codes stored in the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Message codes, in ascending order.
+        :rtype: array.array
+        """
+        raise NotImplementedError
+
+    def unread_inbox(self, user_code):
+        """
+        Retrieves the codes of the messages in the inbox of a user that the user has not read yet.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Message codes, in ascending order.
+        :rtype: array.array
+        """
+        raise NotImplementedError
+
+    def unread_count(self, user_code):
+        """
+        Retrieves the number of messages in the inbox of a user that the user has not read yet.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Number of unread messages.
+        :rtype: int
+        """
+        return len(self.unread_inbox(user_code=user_code))
+
+    def iter_inbox(self, user_code, before_code=None, unread=False):
+        """
+        Iterates over the message codes stored in the inbox of a user from newest to oldest. The first one is found with
+        a binary search, since inboxes are sorted, and the rest are retrieved lazily.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param before_code: If set, only message codes lower than this one are retrieved.
+        :type before_code: int
+        :param unread: Whether to only retrieve the messages that the user has not read yet.
+        :type unread: bool
+        :return: Message codes, in descending order.
+        :rtype: generator
+        """
+        codes = self.unread_inbox(user_code=user_code) if unread else self.inbox(user_code=user_code)
+        end = len(codes) if before_code is None else bisect_left(codes, before_code)
+        for index in range(end - 1, -1, -1):
+            yield codes[index]
+
+    def evict(self, evictions):
+        """
+        Removes messages from the inboxes of several users at once, together with their unread status. The delivery
+        status of the messages is kept.
+        :param evictions: Codes of the messages to remove from the inbox of every user, by user code.
+        :type evictions: dict
+        :return: Number of messages removed from the inboxes.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def evict_messages(self, message_codes):
+        """
+        Removes messages from the inboxes of every user that has them.
+        :param message_codes: Codes of the messages.
+        :type message_codes: iterable
+        :return: Number of messages removed from the inboxes.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def evicted(self, user_code):
+        """
+        Retrieves the number of messages ever removed from the inbox of a user, so that inbox views can tell an inbox
+        that lost some messages and received others apart from an unchanged one.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Number of messages removed.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def inbox_count(self, message_code):
+        """
+        Retrieves the number of inboxes a message is stored in.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users with the message in their inbox.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def release(self, message_codes):
+        """
+        Releases the delivery state of several messages for every user, keeping the number of users with each status,
+        so that statistics do not change, and drops their cached views and the time they were first delivered.
+        Messages should not be in any inbox anymore, and they are recorded as released so that they are not sent again.
+        :param message_codes: Codes of the messages.
+        :type message_codes: iterable
+        """
+        raise NotImplementedError
+
+    def is_released(self, message_code):
+        """
+        Checks if a message has been released.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Whether the message was released.
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def stamp(self, message_code, now):
+        """
+        Records the time a message is first delivered, which its age is measured from, unless it is already recorded.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param now: Current time in seconds.
+        :type now: float
+        """
+        raise NotImplementedError
+
+    def first_sent(self):
+        """
+        Retrieves the time every message that was not released was first delivered.
+        :return: Times in seconds by message code, in the order they were recorded.
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def read_inbox(self, user_code):
+        """
+        Retrieves the codes of the messages in the inbox of a user that the user has read, walking the inbox and the
+        unread messages side by side since both are sorted.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Message codes, in ascending order.
+        :rtype: array.array
+        """
+        unread = self.unread_inbox(user_code=user_code)
+        read = array('q')
+        position = 0
+        for message_code in self.inbox(user_code=user_code):
+            if position < len(unread) and unread[position] == message_code:
+                position += 1
+            else:
+                read.append(message_code)
+        return read
+
+    def iter_statistics(self):
+        """
+        Iterates over the delivery statistics of every message of the store.
+        :return: Code, body and number of users the message has been sent to, received by and read by, for every
+        message ordered by code.
+        :rtype: iterator
+        """
+        for message in self.iter_messages():
+            yield (message.code, message.body, *(self.count(status=status, message_code=message.code)
+                                                  for status in STATUSES))
+
+    def flush(self):
+        """
+        Makes the changes made to the store so far durable. Stores kept in memory have nothing to do.
+        """
+
+    def close(self):
+        """
+        Releases the resources of the store.
+        """
+
+
+class DeliveryState(BaseDeliveryState):
+    """
+    Columnar store in memory with the delivery state of a set of users and messages. Every message has a bitmap for
+    each delivery status (sent, received and read) indexed by user code, and every user has an inbox stored as a sorted
+    array of message codes. Inbox membership is indexed by message code with one more bitmap per message, and the
+    number of users with each status is counted as statuses are set, so statistics do not need to scan any bitmap.
+    The messages every user has not read yet are kept in one more sorted array per user, updated as messages are
+    received and read, so unread messages are neither filtered nor sorted when they are retrieved. Messages evicted
+    from inboxes are removed from all of these structures, and released messages drop their bitmaps but keep their
+    counts, so memory follows retained deliveries rather than every delivery ever made. Users and messages
+    are thin views over this store, which also maps their codes to the objects themselves so that views can be
+    materialized. This is the default store of delivery systems.
+    """
+    _users = None
+    _messages = None
+    _columns = None
+    _counts = None
+    _inboxes = None
+    _inbox_index = None
+    _unread = None
+    _evicted = None
+    _first_sent = None
+    _released = None
+
+    def __init__(self, tracer=None):
+        """
+        :param tracer: Function called with every delivery event of the users and messages of the store.
+        :type tracer: function
+        """
+        self.tracer = tracer
+        self._users = {}
+        self._messages = {}
+        self._columns = {status: {} for status in STATUSES}
+        self._counts = {status: Counter() for status in STATUSES}
+        self._inboxes = {}
+        self._inbox_index = {}
+        self._unread = {}
+        self._evicted = Counter()
+        self._first_sent = {}
+        self._released = Bitmap()
+
+    def add_user(self, user):
+        """
+        Adds a user to the store, unless there is already a user with the same code.
+        :param user: User to add.
+        :type user: User
+        """
+        self._users.setdefault(user.code, user)
+
+    def add_users(self, users):
+        """
+        Adds several users to the store at once. Their codes must not be in the store yet.
+        :param users: Users to add.
+        :type users: list
+        """
+        self._users.update((user.code, user) for user in users)
+
+    def get_user(self, code):
+        """
+        Retrieves a user of the store by its code.
+        :param code: Code of the user.
+        :type code: int
+        :return: The user with this code, or None if there is no such user.
+        :rtype: User
+        """
+        return self._users.get(code)
+
+    def users(self):
+        """
+        Retrieves every user of the store.
+        :return: Users of the store, in the order they were added.
+        :rtype: list
+        """
+        return list(self._users.values())
+
+    def add_message(self, message):
+        """
+        Adds a message to the store, unless there is already a message with the same code.
+        :param message: Message to add.
+        :type message: Message
+        """
+        self._messages.setdefault(message.code, message)
+
+    def add_messages(self, messages):
+        """
+        Adds several messages to the store at once. Their codes must not be in the store yet.
+        :param messages: Messages to add.
+        :type messages: list
+        """
+        self._messages.update((message.code, message) for message in messages)
+
+    def get_message(self, code):
+        """
+        Retrieves a message of the store by its code.
+        :param code: Code of the message.
+        :type code: int
+        :return: The message with this code, or None if there is no such message.
+        :rtype: Message
+        """
+        return self._messages.get(code)
+
+    def messages(self):
+        """
+        Retrieves every message of the store.
+        :return: Messages of the store, in the order they were added.
+        :rtype: list
+        """
+        return list(self._messages.values())
+
+    def iter_messages(self):
+        """
+        Iterates over every message of the store without building a list.
+        :return: Messages of the store, in the order they were added.
+        :rtype: iterator
+        """
+        return iter(self._messages.values())
+
+    def last_codes(self):
+        """
+        Retrieves the highest codes in the store, so that a delivery system can go on assigning codes after them.
+        :return: Highest user code and highest message code, or zero if there are none.
+        :rtype: tuple
+        """
+        return max(self._users, default=0), max(self._messages, default=0)
+
+    def _bitmap(self, status, message_code):
+        """
+        Retrieves the bitmap of users with this delivery status for this message, creating it if it does not exist.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Bitmap of user codes.
+        :rtype: Bitmap
+        """
+        column = self._columns[status]
+        bitmap = column.get(message_code)
+        if bitmap is None:
+            bitmap = column[message_code] = Bitmap()
+        return bitmap
+
+    def mark(self, status, message_code, user_codes):
+        """
+        Sets this delivery status of a message for several users.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_codes: Codes of the users.
+        :type user_codes: iterable | Bitmap
+        """
+        bitmap = self._bitmap(status=status, message_code=message_code)
+        if status != READ:
+            self._counts[status][message_code] += bitmap.update(user_codes)
+            return
+        # Only the users that had not read the message yet have it removed from their unread messages.
+        if isinstance(user_codes, Bitmap):
+            user_codes = user_codes - bitmap
+        else:
+            user_codes = [user_code for user_code in dict.fromkeys(user_codes) if user_code not in bitmap]
+        self._counts[status][message_code] += bitmap.update(user_codes)
+        for user_code in user_codes:
+            unread = self._unread.get(user_code)
+            if unread:
+                _remove_sorted(codes=unread, code=message_code)
+
+    def mark_read(self, user_code, message_codes):
+        """
+        Sets several messages as read by a user at once. The unread messages of the user are filtered in a single pass
+        instead of removing every message from them one by one.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_codes: Codes of the messages.
+        :type message_codes: iterable
+        """
+        read = set()
+        counts = self._counts[READ]
+        for message_code in message_codes:
+            if self._bitmap(status=READ, message_code=message_code).add(user_code):
+                counts[message_code] += 1
+                read.add(message_code)
+        unread = self._unread.get(user_code)
+        if unread and read:
+            self._unread[user_code] = array('q', (code for code in unread if code not in read))
+
+    def count(self, status, message_code):
+        """
+        Retrieves the number of users for whom a message has this delivery status.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users.
+        :rtype: int
+        """
+        return self._counts[status][message_code]
+
+    def has_all(self, status, message_code, user_codes):
+        """
+        Checks this delivery status of a message for several users.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_codes: Codes of the users.
+        :type user_codes: Bitmap
+        :return: Whether the message has this status for all of the users.
+        :rtype: bool
+        """
+        return self._columns[status].get(message_code, Bitmap()).issuperset(user_codes)
+
+    def has(self, status, message_code, user_code):
+        """
+        Checks this delivery status of a message for a user.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Whether the message has this status for the user.
+        :rtype: bool
+        """
+        bitmap = self._columns[status].get(message_code)
+        return bitmap is not None and user_code in bitmap
+
+    def user_codes(self, status, message_code):
+        """
+        Retrieves the codes of the users for whom a message has this delivery status.
+        :param status: Delivery status: sent, received or read.
+        :type status: str
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: User codes, in ascending order.
+        :rtype: iterator
+        """
+        return iter(self._columns[status].get(message_code, ()))
+
+    def add_to_inbox(self, user_code, message_code):
+        """
+        Stores a message code in the inbox of a user, keeping the inbox sorted.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: False if the message was already in the inbox, True otherwise.
+        :rtype: bool
+        """
+        index = self._inbox_index.get(message_code)
+        if index is None:
+            index = self._inbox_index[message_code] = Bitmap()
+        if not index.add(user_code):
+            return False
+        inbox = self._inboxes.get(user_code)
+        if inbox is None:
+            inbox = self._inboxes[user_code] = array('q')
+        _insert_sorted(codes=inbox, code=message_code)
+        if not self.has(status=READ, message_code=message_code, user_code=user_code):
+            unread = self._unread.get(user_code)
+            if unread is None:
+                unread = self._unread[user_code] = array('q')
+            _insert_sorted(codes=unread, code=message_code)
+        return True
+
+    def add_to_inboxes(self, user_codes, message_code):
+        """
+        Stores a message code in the inbox of several users.
+        :param user_codes: Codes of the users.
+        :type user_codes: iterable
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users that did not have the message in their inbox yet.
+        :rtype: int
+        """
+        index = self._inbox_index.get(message_code)
+        if index is None:
+            index = self._inbox_index[message_code] = Bitmap()
+        new = (user_codes if isinstance(user_codes, Bitmap) else Bitmap(user_codes)) - index
+        index |= new
+        read = self._columns[READ].get(message_code, ())
+        for user_code in new:
+            inbox = self._inboxes.get(user_code)
+            if inbox is None:
+                inbox = self._inboxes[user_code] = array('q')
+            _insert_sorted(codes=inbox, code=message_code)
+            if user_code not in read:
+                unread = self._unread.get(user_code)
+                if unread is None:
+                    unread = self._unread[user_code] = array('q')
+                _insert_sorted(codes=unread, code=message_code)
+        return len(new)
+
+    def in_inbox(self, user_code, message_code):
+        """
+        Checks if a message code is stored in the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Whether the message is in the inbox.
+        :rtype: bool
+        """
+        index = self._inbox_index.get(message_code)
+        return index is not None and user_code in index
+
+    def inbox(self, user_code):
+        """
+        Retrieves the message codes stored in the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Message codes, in ascending order.
+        :rtype: array.array
+        """
+        return self._inboxes.get(user_code, array('q'))
+
+    def unread_inbox(self, user_code):
+        """
+        Retrieves the codes of the messages in the inbox of a user that the user has not read yet.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Message codes, in ascending order.
+        :rtype: array.array
+        """
+        return self._unread.get(user_code, array('q'))
+
+    def unread_count(self, user_code):
+        """
+        Retrieves the number of messages in the inbox of a user that the user has not read yet, in constant time.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Number of unread messages.
+        :rtype: int
+        """
+        unread = self._unread.get(user_code)
+        return len(unread) if unread is not None else 0
+
+    def evict(self, evictions):
+        """
+        Removes messages from the inboxes of several users at once. Every inbox and its unread messages are filtered in
+        a single pass, and cached views of the users are dropped.
+        :param evictions: Codes of the messages to remove from the inbox of every user, by user code.
+        :type evictions: dict
+        :return: Number of messages removed from the inboxes.
+        :rtype: int
+        """
+        evicted = 0
+        for user_code, message_codes in evictions.items():
+            removed = set()
+            for message_code in message_codes:
+                index = self._inbox_index.get(message_code)
+                if index is not None and index.discard(user_code):
+                    removed.add(message_code)
+            if not removed:
+                continue
+            self._inboxes[user_code] = array('q', (code for code in self._inboxes[user_code] if code not in removed))
+            unread = self._unread.get(user_code)
+            if unread:
+                self._unread[user_code] = array('q', (code for code in unread if code not in removed))
+            self._evicted[user_code] += len(removed)
+            evicted += len(removed)
+            user = self._users.get(user_code)
+            if user is not None:
+                user._views = None
+        return evicted
+
+    def evict_messages(self, message_codes):
+        """
+        Removes messages from the inboxes of every user that has them, found with the inbox index of every message.
+        :param message_codes: Codes of the messages.
+        :type message_codes: iterable
+        :return: Number of messages removed from the inboxes.
+        :rtype: int
+        """
+        evictions = {}
+        for message_code in message_codes:
+            for user_code in self._inbox_index.get(message_code, ()):
+                codes = evictions.get(user_code)
+                if codes is None:
+                    codes = evictions[user_code] = []
+                codes.append(message_code)
+        return self.evict(evictions=evictions)
+
+    def evicted(self, user_code):
+        """
+        Retrieves the number of messages ever removed from the inbox of a user.
+        :param user_code: Code of the user.
+        :type user_code: int
+        :return: Number of messages removed.
+        :rtype: int
+        """
+        return self._evicted[user_code]
+
+    def inbox_count(self, message_code):
+        """
+        Retrieves the number of inboxes a message is stored in, from the size of its inbox index.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Number of users with the message in their inbox.
+        :rtype: int
+        """
+        index = self._inbox_index.get(message_code)
+        return len(index) if index is not None else 0
+
+    def release(self, message_codes):
+        """
+        Releases the bitmaps and the first delivery time of several messages, keeping their counts, and sets their bits
+        in the bitmap of released messages.
+        :param message_codes: Codes of the messages.
+        :type message_codes: iterable
+        """
+        for message_code in message_codes:
+            self._released.add(message_code)
+            for status in STATUSES:
+                self._columns[status].pop(message_code, None)
+            self._inbox_index.pop(message_code, None)
+            self._first_sent.pop(message_code, None)
+            message = self._messages.get(message_code)
+            if message is not None:
+                message._views = None
+
+    def stamp(self, message_code, now):
+        """
+        Records the time a message is first delivered, unless it is already recorded.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :param now: Current time in seconds.
+        :type now: float
+        """
+        if message_code not in self._first_sent:
+            self._first_sent[message_code] = now
+
+    def first_sent(self):
+        """
+        Retrieves the time every message that was not released was first delivered.
+        :return: Times in seconds by message code, in the order they were recorded.
+        :rtype: dict
+        """
+        return self._first_sent
+
+    def is_released(self, message_code):
+        """
+        Checks if a message has been released.
+        :param message_code: Code of the message.
+        :type message_code: int
+        :return: Whether the message was released.
+        :rtype: bool
+        """
+        return message_code in self._released
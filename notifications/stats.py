@@ -0,0 +1,177 @@
+import csv
+import json
+import logging
+from collections import namedtuple
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+SEPARATOR = '-------------------------------'
+
+SystemStatistics = namedtuple('SystemStatistics', ('users', 'loss_chance', 'read_chance', 'messages'))
+MessageStatistics = namedtuple('MessageStatistics', ('code', 'body', 'sent', 'received', 'read', 'attempts'))
+
+
+class StatisticsSink(object):
+    """
+    Base class of the destinations of exported statistics. A sink receives the statistics of the delivery system first,
+    then the statistics of its messages in chunks, and it is closed at the end.
+    """
+
+    def open(self, system):
+        """
+        Receives the statistics of the delivery system.
+        :param system: Statistics of the delivery system.
+        :type system: SystemStatistics
+        """
+
+    def write(self, records):
+        """
+        Receives a chunk of message statistics.
+        :param records: Statistics of some messages, ordered by message code.
+        :type records: list
+        """
+
+    def close(self):
+        """
+        Finishes the export.
+        """
+
+
+class TextSink(StatisticsSink):
+    """
+    Sink that displays statistics as a human readable text report, one line at a time.
+    """
+
+    def __init__(self, display_func=logger.info):
+        """
+        :param display_func: function used to display the statistics.
+        :type display_func: function
+        """
+        self.display_func = display_func
+
+    def open(self, system):
+        display_func = self.display_func
+        display_func(SEPARATOR)
+        display_func('DELIVERY SYSTEM STATISTICS')
+        display_func(SEPARATOR)
+        display_func(f'USERS: {system.users} unique users registered.')
+        display_func(SEPARATOR)
+        display_func(f'LOSS CHANCE: chance that a message will be lost is set to {system.loss_chance}')
+        display_func(SEPARATOR)
+        display_func(f'READ CHANCE: chance that a message will be read is set to {system.read_chance}')
+        display_func(SEPARATOR)
+        display_func(f'MESSAGES: {system.messages} unique messages created.')
+        display_func(SEPARATOR)
+
+    def write(self, records):
+        display_func = self.display_func
+        for record in records:
+            display_func(f'Message {record.code}: {record.body}')
+            display_func(f'Sent to {record.sent} users.')
+            if record.attempts != record.sent:
+                display_func(f'Delivered in {record.attempts} attempts.')
+            display_func(f'Received by {record.received} users.')
+            display_func(f'Read by {record.read} users.')
+            display_func(SEPARATOR)
+
+
+class CSVSink(StatisticsSink):
+    """
+    Sink that writes the statistics of every message as a row of a CSV file, a whole chunk at a time.
+    """
+
+    def __init__(self, file):
+        """
+        :param file: Text file where rows are written. It should be opened with newline=''.
+        :type file: io.TextIOBase
+        """
+        self.file = file
+        self._writer = csv.writer(file)
+
+    def open(self, system):
+        self._writer.writerow(MessageStatistics._fields)
+
+    def write(self, records):
+        self._writer.writerows(records)
+
+
+class JSONLinesSink(StatisticsSink):
+    """
+    Sink that writes the statistics of every message as a JSON object per line, a whole chunk at a time.
+    """
+
+    def __init__(self, file):
+        """
+        :param file: Text file where lines are written.
+        :type file: io.TextIOBase
+        """
+        self.file = file
+
+    def write(self, records):
+        self.file.write(''.join(json.dumps(record._asdict(), ensure_ascii=False) + '\n' for record in records))
+
+
+class SummarySink(StatisticsSink):
+    """
+    Sink that aggregates the statistics of every message into totals, displaying them when the export finishes.
+    """
+
+    def __init__(self, display_func=logger.info):
+        """
+        :param display_func: function used to display the summary. Nothing is displayed if it is None.
+        :type display_func: function
+        """
+        self.display_func = display_func
+        self.system = None
+        self.messages = 0
+        self.sent = 0
+        self.received = 0
+        self.read = 0
+        self.attempts = 0
+
+    def open(self, system):
+        self.system = system
+
+    def write(self, records):
+        self.messages += len(records)
+        self.sent += sum(record.sent for record in records)
+        self.received += sum(record.received for record in records)
+        self.read += sum(record.read for record in records)
+        self.attempts += sum(record.attempts for record in records)
+
+    def close(self):
+        if self.display_func is None:
+            return
+        received_rate = self.received / self.sent if self.sent else 0
+        read_rate = self.read / self.received if self.received else 0
+        self.display_func(
+            f'SUMMARY: {self.system.users} users, {self.messages} messages, {self.sent} sent in {self.attempts} '
+            f'attempts, {self.received} received ({received_rate:.2%}), {self.read} read ({read_rate:.2%} of received).'
+        )
+
+
+def export_statistics(system, records, sinks, chunk_size=CHUNK_SIZE):
+    """
+    Streams statistics to several sinks. Message statistics are consumed in chunks from an iterable, so they do not
+    need to be held in memory all at once, and every sink receives each chunk in a single call.
+    :param system: Statistics of the delivery system.
+    :type system: SystemStatistics
+    :param records: Statistics of the messages, ordered by message code.
+    :type records: iterable
+    :param sinks: Destinations of the statistics.
+    :type sinks: list
+    :param chunk_size: Number of message statistics per chunk.
+    :type chunk_size: int
+    """
+    for sink in sinks:
+        sink.open(system)
+    records = iter(records)
+    chunk = list(islice(records, chunk_size))
+    while chunk:
+        for sink in sinks:
+            sink.write(chunk)
+        chunk = list(islice(records, chunk_size))
+    for sink in sinks:
+        sink.close()
@@ -1,12 +1,37 @@
+import io
+import os
+import json
+import queue
+import asyncio
 import logging
+import random
+import tempfile
+import time
+import threading
+from array import array
 from unittest import TestCase
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, patch
 
 from user import User
 from message import Message
 from delivery import DeliverySystem, LOSS_CHANCE, READ_CHANCE
+from asynchronous import AsyncDeliverySystem, LatencyTransport
+from decorators import sort_by_code, SortedView
+from state import Bitmap, DeliveryState, SENT, RECEIVED, READ
+import log as log_module
+import stats as stats_module
 import names as names_module
 import text as text_module
+import rolls as rolls_module
+import snapshot as snapshot_module
+from database import SQLiteState
+from segments import Segment
+from scheduler import Scheduler, SimulatedClock
+from throttling import ThrottledDeliverySystem, TokenBucket
+from retries import RetryPolicy
+from dedup import BloomFilter, BloomDeduplicator, ExactDeduplicator
+from retention import RetentionPolicy, RetentionReport
+from tracing import EventStream, DeliveryEvent, chain_tracers, CREATED
 
 
 logging.disable(logging.CRITICAL)
@@ -39,6 +64,20 @@ class UserTestCase(TestCase):
         for func in repr, str:
             self.assertEqual(func(user), user.name)
 
+    def test_user_slots(self):
+        user = User(name=self.name, code=self.code)
+        self.assertFalse(hasattr(user, '__dict__'))
+        with self.assertRaises(AttributeError):
+            user.email = 'jose@example.com'
+
+    def test_user_from_trusted(self):
+        state = DeliveryState()
+        user = User._from_trusted(name=self.name, code=self.code, state=state)
+        self.assertEqual(user.name, self.name)
+        self.assertEqual(user.code, self.code)
+        self.assertIs(state.get_user(code=self.code), user)
+        self.assertEqual(user.inbox, [])
+
     def test_user_name_type_validation(self):
         wrong_name = 1234
         with self.assertRaises(TypeError):
@@ -56,7 +95,7 @@ class UserTestCase(TestCase):
 
     def test_recieve_message(self):
         user = User(name=self.name, code=self.code)
-        message = MagicMock()
+        message = MagicMock(code=1)
         self.assertEqual(len(user.inbox), 0)
         user.receive_message(message=message)
         self.assertEqual(len(user.inbox), 1)
@@ -64,7 +103,7 @@ class UserTestCase(TestCase):
 
     def test_recieve_repeated_message(self):
         user = User(name=self.name, code=self.code)
-        message = MagicMock()
+        message = MagicMock(code=1)
         user.receive_message(message=message)
         user.receive_message(message=message)
         self.assertEqual(len(user.inbox), 1)
@@ -72,7 +111,7 @@ class UserTestCase(TestCase):
 
     def test_read_message(self):
         user = User(name=self.name, code=self.code)
-        message = MagicMock()
+        message = MagicMock(code=1)
         user.receive_message(message=message)
         message.mark_as_read.assert_not_called()
         user.read_message(message=message)
@@ -80,22 +119,97 @@ class UserTestCase(TestCase):
 
     def test_read_unreceived_message(self):
         user = User(name=self.name, code=self.code)
-        message = MagicMock()
+        message = MagicMock(code=1)
         with self.assertRaises(ValueError):
             user.read_message(message=message)
         message.mark_as_read.assert_not_called()
 
+    def test_read_messages(self):
+        tracer = Mock()
+        user = User(name=self.name, code=self.code, state=DeliveryState(tracer=tracer))
+        messages = [Message(body='This is a message.', code=code, state=user._state) for code in range(1, 4)]
+        for message in messages:
+            message.send(user=user)
+            user.receive_message(message=message)
+        user.read_messages(codes=(message.code for message in messages[:2]))
+        self.assertEqual([message.is_read(user=user) for message in messages], [True, True, False])
+        self.assertEqual([message.code for message in user.get_unread_messages()], [3])
+        tracer.assert_any_call(READ, messages[1], user)
+        user.mark_all_read()
+        self.assertEqual(user.unread_count(), 0)
+        self.assertEqual([message.get_statistics() for message in messages], [(1, 1, 1)] * 3)
+        user.read_messages(codes=[1])
+        self.assertEqual(messages[0].get_statistics(), (1, 1, 1))
+        other = Message(body='This is a message.', code=4, state=user._state)
+        user.add_to_inbox(message=other)
+        with self.assertRaises(ValueError):
+            user.read_messages(codes=[4])
+
+    def test_read_unreceived_messages(self):
+        messages = get_mocks_with_code()
+        user = User(name=self.name, code=self.code)
+        user.receive_message(message=messages[0])
+        with self.assertRaises(ValueError):
+            user.read_messages(codes=(message.code for message in messages))
+        messages[0].mark_as_read.assert_not_called()
+
     def test_get_read_and_unread_messages(self):
         user = User(name=self.name, code=self.code)
-        message = MagicMock()
-        message.is_read = Mock(return_value=False)
+        message = Message(body='This is a message.', code=1, state=user._state)
+        message.send(user=user)
         user.receive_message(message=message)
         self.assertEqual(len(user.get_read_messages()), 0)
         self.assertEqual(len(user.get_unread_messages()), 1)
-        message.is_read = Mock(return_value=True)
+        user.read_message(message=message)
         self.assertEqual(len(user.get_read_messages()), 1)
         self.assertEqual(len(user.get_unread_messages()), 0)
 
+    def test_unread_index(self):
+        user = User(name=self.name, code=self.code)
+        messages = [Message(body='This is a message.', code=code, state=user._state) for code in (2, 1, 4, 3, 5)]
+        for message in messages:
+            message.send(user=user)
+            user.receive_message(message=message)
+        self.assertEqual(user.unread_count(), 5)
+        user.read_messages(codes=(2, 4))
+        user.read_message(message=messages[0])
+        self.assertEqual(user.unread_count(), 3)
+        self.assertEqual([message.code for message in user.get_unread_messages()], [5, 3, 1])
+        self.assertEqual([message.code for message in user.get_read_messages()], [4, 2])
+        self.assertEqual([message.code for message in user.iter_unread_messages()], [5, 3, 1])
+        self.assertEqual([message.code for message in user.iter_unread_messages(before_code=5)], [3, 1])
+        self.assertEqual([message.code for message in user.iter_unread_messages(before_code=1)], [])
+        user.mark_all_read()
+        self.assertEqual(user.unread_count(), 0)
+        self.assertEqual(len(user.get_read_messages()), 5)
+
+    def test_inbox_page(self):
+        user = User(name=self.name, code=self.code)
+        for code in (3, 1, 5, 2, 4, 7):
+            user.add_to_inbox(message=Message(body='This is a message.', code=code, state=user._state))
+        self.assertEqual([message.code for message in user.inbox_page(limit=4)], [7, 5, 4, 3])
+        self.assertEqual([message.code for message in user.inbox_page(limit=4, before_code=3)], [2, 1])
+        self.assertEqual([message.code for message in user.inbox_page(limit=2, before_code=6)], [5, 4])
+        self.assertEqual(user.inbox_page(limit=0), [])
+        self.assertEqual([message.code for message in user.iter_inbox(before_code=4)], [3, 2, 1])
+        self.assertEqual([message.code for message in user.iter_inbox()], [message.code for message in user.inbox])
+        with self.assertRaises(TypeError):
+            user.inbox_page(limit='10')
+        with self.assertRaises(ValueError):
+            user.inbox_page(limit=-1)
+        with self.assertRaises(TypeError):
+            user.inbox_page(limit=10, before_code='3')
+
+    def test_unread_index_batch(self):
+        ds = DeliverySystem(loss_chance=0, read_chance=0.5, seed=2)
+        users = ds.register_users(n=50)
+        for batch in (True, False, True):
+            ds.broadcast_message(batch=batch)
+        for user in users:
+            unread = [message for message in user.inbox if not message.is_read(user=user)]
+            self.assertEqual(user.unread_count(), len(unread))
+            self.assertEqual(user.get_unread_messages(), unread)
+
     def test_inbox_property(self):
         messages = get_mocks_with_code()
         user = User(name=self.name, code=self.code)
@@ -113,9 +227,8 @@ class MessageTestCase(TestCase):
         message = Message(body=self.body, code=self.code)
         self.assertEqual(message.body, self.body)
         self.assertEqual(message.code, self.code)
-        self.assertEqual(message._sent, set())
-        self.assertEqual(message._received, set())
-        self.assertEqual(message._read, set())
+        self.assertIsInstance(message._state, DeliveryState)
+        self.assertIs(message._state.get_message(code=self.code), message)
         self.assertEqual(message.users_sent, [])
         self.assertEqual(message.users_received, [])
         self.assertEqual(message.users_read, [])
@@ -125,6 +238,28 @@ class MessageTestCase(TestCase):
         for func in repr, str:
             self.assertEqual(func(message), message.body)
 
+    def test_message_slots(self):
+        message = Message(body=self.body, code=self.code)
+        self.assertFalse(hasattr(message, '__dict__'))
+        with self.assertRaises(AttributeError):
+            message.title = 'Title'
+
+    def test_message_from_trusted(self):
+        events = EventStream()
+        state = DeliveryState(tracer=events)
+        message = Message._from_trusted(body=self.body, code=self.code, state=state)
+        self.assertEqual(message.body, self.body)
+        self.assertIs(state.get_message(code=self.code), message)
+        self.assertEqual(list(events.events), [DeliveryEvent(CREATED, self.code, None)])
+        self.assertEqual(message.users_sent, [])
+
+    def test_message_lazy_body(self):
+        body = text_module.LazyText(b'\x00\x01\x02')
+        message = Message(body=body, code=self.code)
+        self.assertIs(message._body, body)
+        self.assertEqual(message.body, 'Lorem ipsum dolor.')
+        self.assertEqual(repr(message), 'Lorem ipsum dolor.')
+
     def test_message_body_type_validation(self):
         wrong_body = 1234
         with self.assertRaises(TypeError):
@@ -142,7 +277,7 @@ class MessageTestCase(TestCase):
 
     def test_send_message(self):
         message = Message(body=self.body, code=self.code)
-        user = MagicMock()
+        user = MagicMock(code=1)
         self.assertEqual(len(message.users_sent), 0)
         self.assertFalse(message.is_sent(user=user))
         message.send(user=user)
@@ -152,8 +287,8 @@ class MessageTestCase(TestCase):
 
     def test_mark_message_as_received(self):
         message = Message(body=self.body, code=self.code)
-        user = MagicMock()
-        message._sent.add(user)
+        user = MagicMock(code=1)
+        message.send(user=user)
         self.assertEqual(len(message.users_received), 0)
         self.assertFalse(message.is_received(user=user))
         message.mark_as_received(user=user)
@@ -163,21 +298,21 @@ class MessageTestCase(TestCase):
 
     def test_mark_unsent_message_as_received(self):
         message = Message(body=self.body, code=self.code)
-        user = MagicMock()
+        user = MagicMock(code=1)
         with self.assertRaises(ValueError):
             message.mark_as_received(user=user)
 
     def test_mark_not_yet_received_message_as_read(self):
         message = Message(body=self.body, code=self.code)
-        user = MagicMock()
+        user = MagicMock(code=1)
         with self.assertRaises(ValueError):
             message.mark_as_read(user=user)
 
     def test_mark_message_as_read(self):
         message = Message(body=self.body, code=self.code)
-        user = MagicMock()
-        message._sent.add(user)
-        message._received.add(user)
+        user = MagicMock(code=1)
+        message.send(user=user)
+        message.mark_as_received(user=user)
         self.assertEqual(len(message.users_read), 0)
         self.assertFalse(message.is_read(user=user))
         message.mark_as_read(user=user)
@@ -187,7 +322,7 @@ class MessageTestCase(TestCase):
 
     def test_repeated_user(self):
         message = Message(body=self.body, code=self.code)
-        user = MagicMock()
+        user = MagicMock(code=1)
         for _ in range(2):
             message.send(user=user)
             self.assertEqual(len(message.users_sent), 1)
@@ -196,6 +331,18 @@ class MessageTestCase(TestCase):
             message.mark_as_read(user=user)
             self.assertEqual(len(message.users_read), 1)
 
+    def test_get_statistics(self):
+        users = get_mocks_with_code()
+        message = Message(body=self.body, code=self.code)
+        self.assertEqual(message.get_statistics(), (0, 0, 0))
+        for user in users:
+            message.send(user=user)
+        message.send(user=users[0])
+        message.mark_as_received(user=users[0])
+        message.mark_as_received(user=users[1])
+        message.mark_as_read(user=users[0])
+        self.assertEqual(message.get_statistics(), (3, 2, 1))
+
     def test_users_properties(self):
         users = get_mocks_with_code()
         message = Message(body=self.body, code=self.code)
@@ -208,8 +355,35 @@ class MessageTestCase(TestCase):
         self.assertEqual(message.users_read, list(users))
 
 
+class DecoratorsTestCase(TestCase):
+
+    def test_sort_by_code(self):
+        items = get_mocks_with_code()
+        sort = sort_by_code(reverse=True)(lambda: items)
+        view = sort()
+        self.assertIsInstance(view, SortedView)
+        self.assertEqual(view, list(reversed(items)))
+        self.assertEqual(view[:2], [items[2], items[1]])
+        self.assertEqual(len(view), len(items))
+        self.assertIsNot(sort(), view)
+
+    def test_sort_by_code_cache(self):
+        users = get_mocks_with_code()
+        message = Message(body='This is a message', code=1)
+        message.send(user=users[1])
+        view = message.users_sent
+        self.assertIs(message.users_sent, view)
+        message.send(user=users[0])
+        self.assertIsNot(message.users_sent, view)
+        self.assertEqual(message.users_sent, [users[0], users[1]])
+
+
 class NamesTestCase(TestCase):
 
+    def test_random_name_generation_seed(self):
+        names = [names_module.get_random_name(rng=random.Random(1234)) for _ in range(2)]
+        self.assertEqual(names[0], names[1])
+
     def test_random_name_generation(self):
         name = names_module.get_random_name()
         self.assertIsInstance(name, str)
@@ -219,9 +393,22 @@ class NamesTestCase(TestCase):
         self.assertIn(first_name, names_module.NAMES)
         self.assertIn(surname, names_module.SURNAMES)
 
+    def test_random_names_generation(self):
+        names = names_module.get_random_names(size=50, rng=random.Random(1234))
+        self.assertEqual(names, names_module.get_random_names(size=50, rng=random.Random(1234)))
+        self.assertEqual(len(names), 50)
+        for name in names:
+            first_name, surname = name.split()
+            self.assertIn(first_name, names_module.NAMES)
+            self.assertIn(surname, names_module.SURNAMES)
+
 
 class TextTestCase(TestCase):
 
+    def test_random_text_generation_seed(self):
+        texts = [text_module.get_random_text(num_words=10, rng=random.Random(1234)) for _ in range(2)]
+        self.assertEqual(texts[0], texts[1])
+
     def test_random_text_generation(self):
         for num_words in (1, 10, 100):
             text = text_module.get_random_text(num_words=num_words)
@@ -231,6 +418,1006 @@ class TextTestCase(TestCase):
             self.assertTrue(text[1:].islower())
             self.assertTrue(text.endswith('.'))
 
+    def test_lazy_text(self):
+        text = text_module.LazyText(range(len(text_module.WORDS)))
+        self.assertEqual(str(text), ' '.join(text_module.WORDS).strip(',').capitalize() + '.')
+        self.assertEqual(len(text), len(text_module.WORDS))
+
+    def test_random_lazy_text_generation(self):
+        texts = [text_module.get_random_lazy_text(num_words=10, rng=random.Random(1234)) for _ in range(2)]
+        self.assertEqual(texts[0], texts[1])
+        self.assertEqual(len(str(texts[0]).split()), 10)
+        self.assertTrue(str(texts[0]).endswith('.'))
+
+    def test_random_lazy_texts_generation(self):
+        texts = text_module.get_random_lazy_texts(size=5, num_words=4, rng=random.Random(1234))
+        self.assertEqual(texts, text_module.get_random_lazy_texts(size=5, num_words=4, rng=random.Random(1234)))
+        self.assertEqual(len(texts), 5)
+        self.assertTrue(all(isinstance(text, text_module.LazyText) and len(text) == 4 for text in texts))
+
+
+class BitmapTestCase(TestCase):
+
+    codes = (0, 7, 8, 1000, 3)
+
+    def test_bitmap_creation(self):
+        bitmap = Bitmap(codes=self.codes)
+        self.assertEqual(len(bitmap), len(self.codes))
+        self.assertEqual(list(bitmap), sorted(self.codes))
+        self.assertEqual(bitmap.nbytes, max(self.codes) // 8 + 1)
+
+    def test_bitmap_add(self):
+        bitmap = Bitmap()
+        self.assertNotIn(5, bitmap)
+        self.assertTrue(bitmap.add(5))
+        self.assertFalse(bitmap.add(5))
+        self.assertIn(5, bitmap)
+        self.assertNotIn(4, bitmap)
+        self.assertEqual(len(bitmap), 1)
+
+    def test_bitmap_union(self):
+        bitmap = Bitmap(codes=self.codes)
+        other = Bitmap(codes=(7, 2000))
+        self.assertFalse(bitmap.issuperset(other))
+        bitmap |= other
+        self.assertTrue(bitmap.issuperset(other))
+        self.assertEqual(list(bitmap), sorted(set(self.codes) | {2000}))
+
+    def test_bitmap_sparse_iteration(self):
+        codes = [4095, 4096, 4103, 10 ** 6, 8 * 10 ** 7 + 1]
+        bitmap = Bitmap(codes=codes)
+        self.assertEqual(list(bitmap), codes)
+        bitmap.discard(10 ** 6)
+        self.assertEqual(list(bitmap), [4095, 4096, 4103, 8 * 10 ** 7 + 1])
+        self.assertEqual(list(Bitmap.fromrange(start=1, stop=5000)), list(range(1, 5000)))
+        self.assertEqual(list(Bitmap()), [])
+
+
+class DeliveryStateTestCase(TestCase):
+
+    def setUp(self):
+        self.state = DeliveryState()
+
+    def test_mark(self):
+        self.assertFalse(self.state.has(status=SENT, message_code=1, user_code=2))
+        self.state.mark(status=SENT, message_code=1, user_codes=(3, 2))
+        self.assertTrue(self.state.has(status=SENT, message_code=1, user_code=2))
+        self.assertFalse(self.state.has(status=SENT, message_code=2, user_code=2))
+        self.assertEqual(list(self.state.user_codes(status=SENT, message_code=1)), [2, 3])
+        self.assertEqual(list(self.state.user_codes(status=SENT, message_code=2)), [])
+
+    def test_count(self):
+        self.assertEqual(self.state.count(status=SENT, message_code=1), 0)
+        self.state.mark(status=SENT, message_code=1, user_codes=(3, 2))
+        self.state.mark(status=SENT, message_code=1, user_codes=(2, 4))
+        self.state.mark(status=SENT, message_code=1, user_codes=Bitmap(codes=(4, 5)))
+        self.assertEqual(self.state.count(status=SENT, message_code=1), 4)
+        self.assertEqual(self.state.count(status=SENT, message_code=2), 0)
+
+    def test_inbox(self):
+        for message_code in (1, 3, 2):
+            self.assertTrue(self.state.add_to_inbox(user_code=1, message_code=message_code))
+        self.assertFalse(self.state.add_to_inbox(user_code=1, message_code=2))
+        self.assertEqual(list(self.state.inbox(user_code=1)), [1, 2, 3])
+        self.assertTrue(self.state.in_inbox(user_code=1, message_code=3))
+        self.assertFalse(self.state.in_inbox(user_code=1, message_code=4))
+        self.assertFalse(self.state.in_inbox(user_code=2, message_code=1))
+
+    def test_shared_state(self):
+        user = User(name='John Doe', code=1, state=self.state)
+        message = Message(body='This is a message', code=1, state=self.state)
+        self.assertIs(self.state.get_user(code=1), user)
+        self.assertIs(self.state.get_message(code=1), message)
+        message.send(user=user)
+        user.receive_message(message=message)
+        self.assertTrue(self.state.has(status=SENT, message_code=1, user_code=1))
+        self.assertEqual(user.inbox, [message])
+        self.assertEqual(message.users_received, [user])
+
+
+class RollsTestCase(TestCase):
+
+    def test_draw_rolls(self):
+        rng = random.Random(1234)
+        control_rng = random.Random(1234)
+        rolls = rolls_module.draw_rolls(size=100, rng=rng)
+        self.assertEqual(list(rolls), [control_rng.random() for _ in range(100)])
+        self.assertEqual(rng.getstate(), control_rng.getstate())
+
+    def test_roll_deliveries(self):
+        for loss_chance, read_chance, expected in ((0, 1, True), (1, 1, False), (0, 0, False)):
+            received, read = rolls_module.roll_deliveries(size=10, loss_chance=loss_chance, read_chance=read_chance)
+            self.assertEqual(len(received), 10)
+            self.assertEqual(set(read), {expected})
+        self.assertEqual(set(received), {True})
+
+
+class TracingTestCase(TestCase):
+
+    def test_chain_tracers(self):
+        self.assertIsNone(chain_tracers(None, None))
+        tracer = EventStream()
+        self.assertIs(chain_tracers(None, tracer), tracer)
+        other_tracer = EventStream()
+        chained = chain_tracers(tracer, other_tracer)
+        chained(CREATED, MagicMock(code=1))
+        self.assertEqual(list(tracer.events), list(other_tracer.events))
+        self.assertEqual(list(tracer.events), [DeliveryEvent(event=CREATED, message_code=1, user_code=None)])
+
+    def test_event_stream(self):
+        listener = Mock()
+        tracer = EventStream(maxlen=2, listener=listener)
+        for code in range(3):
+            tracer(SENT, MagicMock(code=1), MagicMock(code=code))
+        self.assertEqual(listener.call_count, 3)
+        self.assertEqual([event.user_code for event in tracer.events], [1, 2])
+
+    def test_delivery_system_tracer(self):
+        ds = DeliverySystem(loss_chance=0, read_chance=1)
+        user = ds.register_user()
+        ds.send_message(user=user)
+        self.assertIsNone(ds._state.tracer)
+        ds.tracer = EventStream()
+        message = ds.send_message(user=user)
+        ds.broadcast_message(batch=True)
+        self.assertEqual(
+            [tuple(event) for event in ds.tracer.events],
+            [(CREATED, 2, None), (SENT, 2, 1), (RECEIVED, 2, 1), (READ, 2, 1),
+             (CREATED, 3, None), (SENT, 3, 1), (RECEIVED, 3, 1), (READ, 3, 1)]
+        )
+        self.assertEqual(message.code, 2)
+
+
+class LogTestCase(TestCase):
+
+    def get_record(self, msg='Message %s', args=(1,)):
+        return logging.LogRecord(
+            name='test', level=logging.INFO, pathname=__file__, lineno=1, msg=msg, args=args, exc_info=None
+        )
+
+    def test_batching_file_handler(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'test.log')
+            handler = log_module.BatchingRotatingFileHandler(filename=filename, flush_size=30)
+            handler.handle(self.get_record())
+            self.assertEqual(os.path.getsize(filename), 0)
+            handler.handle(self.get_record(args=(2,)))
+            handler.handle(self.get_record(args=(3,)))
+            self.assertGreater(os.path.getsize(filename), 0)
+            handler.close()
+            with open(filename) as log_file:
+                self.assertEqual(log_file.read().splitlines(), ['Message 1', 'Message 2', 'Message 3'])
+
+    def test_batching_file_handler_rotation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'test.log')
+            handler = log_module.BatchingRotatingFileHandler(filename=filename, max_bytes=25, flush_size=1)
+            for index in range(3):
+                handler.handle(self.get_record(args=(index,)))
+            handler.close()
+            self.assertTrue(os.path.exists(f'{filename}.1'))
+
+    def test_bounded_queue_handler(self):
+        record_queue = queue.Queue(maxsize=1)
+        handler = log_module.BoundedQueueHandler(queue=record_queue, policy='drop')
+        for _ in range(3):
+            handler.handle(self.get_record())
+        self.assertEqual(record_queue.qsize(), 1)
+        self.assertEqual(handler.dropped, 2)
+        record = record_queue.get()
+        self.assertEqual(record.args, (1,))
+
+    def test_stop_listener_with_full_queue(self):
+        record_queue = queue.Queue(maxsize=1)
+        release = threading.Event()
+        records = []
+
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                release.wait()
+                records.append(record)
+
+        listener = log_module.BatchingQueueListener(record_queue, SlowHandler())
+        listener.start()
+        record_queue.put(self.get_record(args=(1,)))
+        while not record_queue.empty():
+            time.sleep(0.001)
+        record_queue.put(self.get_record(args=(2,)))
+        timer = threading.Timer(0.05, release.set)
+        timer.start()
+        listener.stop()
+        timer.join()
+        self.assertEqual([record.args for record in records], [(1,), (2,)])
+
+    def test_bounded_queue_handler_policy_validation(self):
+        with self.assertRaises(ValueError):
+            log_module.BoundedQueueHandler(queue=queue.Queue(), policy='wrong')
+
+
+class StatisticsTestCase(TestCase):
+
+    def setUp(self):
+        self.ds = DeliverySystem(loss_chance=0, read_chance=1, seed=1)
+        for _ in range(10):
+            self.ds.register_user()
+        for _ in range(3):
+            self.ds.broadcast_message()
+
+    def test_iter_statistics(self):
+        records = list(self.ds.iter_statistics())
+        self.assertEqual([record.code for record in records], [1, 2, 3])
+        self.assertEqual(records[0], (1, self.ds.get_message(code=1).body, 10, 10, 10, 10))
+
+    def test_export_chunks(self):
+        sink = Mock()
+        self.ds.export_statistics(sinks=(sink,), chunk_size=2)
+        sink.open.assert_called_once()
+        self.assertEqual([len(call.args[0]) for call in sink.write.call_args_list], [2, 1])
+        sink.close.assert_called_once_with()
+
+    def test_text_sink(self):
+        display_func = Mock()
+        self.ds.show_statistics(display_func=display_func)
+        self.assertEqual(display_func.call_count, 11 + 5 * 3)
+        display_func.assert_any_call('USERS: 10 unique users registered.')
+        display_func.assert_any_call('Sent to 10 users.')
+        display_func.assert_any_call('Read by 10 users.')
+
+    def test_text_sink_attempts(self):
+        ds = DeliverySystem(loss_chance=1, retry_policy=RetryPolicy(max_attempts=3))
+        ds.register_users(n=10)
+        ds.broadcast_message(batch=True)
+        ds.drain_scheduled()
+        lines = []
+        ds.show_statistics(display_func=lines.append)
+        self.assertIn('Sent to 10 users.', lines)
+        self.assertIn('Delivered in 30 attempts.', lines)
+
+    def test_csv_sink(self):
+        file = io.StringIO(newline='')
+        self.ds.export_statistics(sinks=(stats_module.CSVSink(file=file),))
+        lines = file.getvalue().splitlines()
+        self.assertEqual(lines[0], 'code,body,sent,received,read,attempts')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith('1,'))
+        self.assertTrue(lines[1].endswith(',10,10,10,10'))
+
+    def test_json_lines_sink(self):
+        file = io.StringIO()
+        self.ds.export_statistics(sinks=(stats_module.JSONLinesSink(file=file),))
+        records = [json.loads(line) for line in file.getvalue().splitlines()]
+        self.assertEqual([record['code'] for record in records], [1, 2, 3])
+        self.assertEqual(records[2]['read'], 10)
+
+    def test_summary_sink(self):
+        display_func = Mock()
+        sink = stats_module.SummarySink(display_func=display_func)
+        self.ds.export_statistics(sinks=(sink,))
+        self.assertEqual((sink.messages, sink.sent, sink.received, sink.read), (3, 30, 30, 30))
+        display_func.assert_called_once()
+
+
+class SegmentTestCase(TestCase):
+
+    def test_segment_creation(self):
+        users = [User(name='John Doe', code=code) for code in (3, 1, 2)]
+        self.assertEqual(list(Segment.from_users(name='users', users=users)), [1, 2, 3])
+        self.assertEqual(list(Segment.from_range(name='range', start=5, stop=8)), [5, 6, 7])
+        self.assertEqual(len(Segment.from_range(name='empty', start=8, stop=5)), 0)
+        segment = Segment.from_predicate(name='odd', users=users, predicate=lambda user: user.code % 2)
+        self.assertEqual(list(segment), [1, 3])
+        self.assertIn(users[0], segment)
+        self.assertNotIn(users[2], segment)
+        self.assertEqual(repr(segment), 'odd')
+
+    def test_segment_validation(self):
+        with self.assertRaises(TypeError):
+            Segment(name=1)
+        with self.assertRaises(TypeError):
+            Segment.from_range(name='range', start='1', stop=5)
+        with self.assertRaises(ValueError):
+            Segment.from_range(name='range', start=-1, stop=5)
+
+    def test_segment_algebra(self):
+        first = Segment.from_range(name='first', start=1, stop=10)
+        second = Segment(name='second', codes=(5, 9, 12, 20))
+        self.assertEqual(list(first | second), list(range(1, 10)) + [12, 20])
+        self.assertEqual(list(first & second), [5, 9])
+        self.assertEqual(list(second - first), [12, 20])
+        self.assertEqual((first - second).name, '(first - second)')
+
+
+class SchedulerTestCase(TestCase):
+
+    def test_simulated_clock(self):
+        clock = SimulatedClock(start=10)
+        self.assertEqual(clock(), 10)
+        self.assertEqual(clock.advance(2.5), 12.5)
+        with self.assertRaises(ValueError):
+            clock.advance(-1)
+        with self.assertRaises(TypeError):
+            clock.advance('1')
+
+    def test_scheduler(self):
+        scheduler = Scheduler(resolution=0.1)
+        scheduler.schedule(at=0.3, message_code=2, user_codes=(4, 1))
+        scheduler.schedule(at=0.3, message_code=1, user_codes=Bitmap((3, 4)))
+        scheduler.schedule(at=0.25, message_code=2, user_codes=(1, 2))
+        scheduler.schedule(at=1, message_code=1, user_codes=(5,))
+        self.assertEqual(len(scheduler), 7)
+        self.assertAlmostEqual(scheduler.next_due(), 0.3)
+        self.assertEqual(list(scheduler.pop_due(until=0.29)), [])
+        self.assertEqual([batch[1:] for batch in scheduler.pop_due(until=0.3)], [(1, 1, [3, 4]), (2, 1, [1, 2, 4])])
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual([batch[1:] for batch in scheduler.pop_due(until=5)], [(1, 1, [5])])
+        self.assertIsNone(scheduler.next_due())
+        with self.assertRaises(ValueError):
+            Scheduler(resolution=0)
+
+    def test_schedule_message(self):
+        ds = DeliverySystem(loss_chance=0, read_chance=0)
+        users = ds.register_users(n=10)
+        single = ds.schedule_message(at=5, user=users[0])
+        segment = ds.define_segment(name='first', start=1, stop=4)
+        targeted = ds.schedule_message(at=10, segment='first')
+        broadcast = ds.schedule_message(at=10, window=5)
+        self.assertEqual(len(ds.scheduler), 14)
+        self.assertEqual(ds.tick(seconds=4), 0)
+        self.assertEqual(ds.tick(seconds=1), 1)
+        self.assertEqual([user.code for user in single.users_received], [1])
+        self.assertEqual(ds.tick(seconds=5), len(segment) + 2)
+        self.assertEqual(len(targeted.users_received), 3)
+        self.assertEqual([user.code for user in broadcast.users_received], [1, 2])
+        self.assertEqual(ds.tick(seconds=10), 8)
+        self.assertEqual(len(broadcast.users_received), 10)
+        self.assertEqual(len(ds.scheduler), 0)
+
+    def test_scheduled_results(self):
+        scheduled, immediate = DeliverySystem(seed=1), DeliverySystem(seed=1)
+        for ds in (scheduled, immediate):
+            ds.register_users(n=20)
+        scheduled.schedule_message(at=1)
+        scheduled.tick(seconds=1)
+        immediate.broadcast_message(batch=True)
+        self.assertEqual([user.code for user in scheduled.messages[0].users_read],
+                         [user.code for user in immediate.messages[0].users_read])
+
+    def test_schedule_validation(self):
+        ds = DeliverySystem(clock=lambda: 100)
+        user = ds.register_user()
+        with self.assertRaises(ValueError):
+            ds.schedule_message(user=user, segment='first')
+        with self.assertRaises(ValueError):
+            ds.schedule_message(segment='undefined')
+        with self.assertRaises(ValueError):
+            ds.schedule_message(user=User(name='John Doe', code=5))
+        with self.assertRaises(TypeError):
+            ds.schedule_message(at='tomorrow')
+        with self.assertRaises(ValueError):
+            ds.schedule_message(window=-1)
+        with self.assertRaises(TypeError):
+            ds.tick(seconds=1)
+        ds.schedule_message(at=99, user=user)
+        self.assertEqual(ds.run_scheduled(), 1)
+
+
+class RetryTestCase(TestCase):
+
+    def test_retry_policy(self):
+        policy = RetryPolicy(max_attempts=6, base_delay=1, factor=2, max_delay=5)
+        self.assertEqual([policy.delay(attempt=attempt) for attempt in range(2, 7)], [1, 2, 4, 5, 5])
+        with self.assertRaises(ValueError):
+            RetryPolicy(max_attempts=0)
+        with self.assertRaises(ValueError):
+            RetryPolicy(factor=0.5)
+        with self.assertRaises(TypeError):
+            RetryPolicy(base_delay='1')
+        with self.assertRaises(TypeError):
+            DeliverySystem(retry_policy=3)
+
+    def test_retry_waves(self):
+        ds = DeliverySystem(loss_chance=1, read_chance=0, retry_policy=RetryPolicy(max_attempts=3))
+        ds.register_users(n=100)
+        message = ds.broadcast_message(batch=True)
+        self.assertEqual(len(ds.scheduler), 100)
+        self.assertEqual(ds.scheduler.next_due(), 1)
+        self.assertEqual(ds.drain_scheduled(), 200)
+        self.assertEqual(ds.clock(), 3)
+        self.assertEqual(len(ds.scheduler), 0)
+        self.assertEqual(next(ds.iter_statistics())[2:], (100, 0, 0, 300))
+        self.assertEqual(message.users_received, [])
+
+    def test_retries_deliver_lost_messages(self):
+        ds = DeliverySystem(loss_chance=0.5, seed=1, retry_policy=RetryPolicy(max_attempts=10))
+        ds.register_users(n=200)
+        ds.broadcast_message(batch=True)
+        received = len(ds.messages[0].users_received)
+        ds.drain_scheduled()
+        record = next(ds.iter_statistics())
+        self.assertGreater(record.received, received)
+        self.assertEqual(record.sent, 200)
+        self.assertGreaterEqual(record.attempts - record.sent, 200 - received)
+        self.assertGreaterEqual(record.received, 195)
+
+    def test_batch_and_single_retries(self):
+        batch, single = (DeliverySystem(loss_chance=0.3, seed=1, retry_policy=RetryPolicy()) for _ in range(2))
+        for ds, batch_mode in ((batch, True), (single, False)):
+            ds.register_users(n=150)
+            ds.broadcast_message(batch=batch_mode)
+            ds.drain_scheduled(batch=batch_mode)
+        self.assertEqual(list(batch.iter_statistics()), list(single.iter_statistics()))
+
+    def test_retries_in_snapshot(self):
+        ds = DeliverySystem(loss_chance=0.5, seed=1, retry_policy=RetryPolicy())
+        ds.register_users(n=20)
+        ds.broadcast_message(batch=True)
+        ds.drain_scheduled()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'delivery.snapshot')
+            ds.save(path=path)
+            loaded = DeliverySystem.load(path=path)
+        self.assertEqual(list(loaded.iter_statistics()), list(ds.iter_statistics()))
+
+
+class DeduplicationTestCase(TestCase):
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        self.assertEqual(bloom.nbytes, 1199)
+        self.assertTrue(all(bloom.add(key) for key in range(0, 2000, 2)))
+        self.assertTrue(all(key in bloom for key in range(0, 2000, 2)))
+        self.assertFalse(bloom.add(0))
+        false_positives = sum(key in bloom for key in range(1, 20000, 2))
+        self.assertLess(false_positives / 10000, 0.02)
+        self.assertAlmostEqual(bloom.error_rate, 0.01, delta=0.005)
+        with self.assertRaises(ValueError):
+            BloomFilter(capacity=0)
+        with self.assertRaises(ValueError):
+            BloomFilter(error_rate=1.0)
+        with self.assertRaises(TypeError):
+            BloomFilter(capacity=1.5)
+
+    def test_exact_window(self):
+        dedup = ExactDeduplicator(window=10)
+        self.assertTrue(dedup.add(user_code=1, message_code=1, now=0))
+        self.assertTrue(dedup.add(user_code=2, message_code=1, now=5))
+        self.assertFalse(dedup.add(user_code=1, message_code=1, now=9))
+        self.assertEqual(dedup.add_many(user_codes=[1, 2, 3], message_code=1, now=12), [1, 3])
+        self.assertEqual(len(dedup), 3)
+        self.assertEqual(dedup.add_many(user_codes=[1, 2, 3], message_code=1, now=30), [1, 2, 3])
+        self.assertEqual((dedup.checked, dedup.duplicates), (9, 2))
+        with self.assertRaises(ValueError):
+            ExactDeduplicator(window=0)
+
+    def test_large_codes(self):
+        for dedup in (ExactDeduplicator(), BloomDeduplicator(capacity=1000, error_rate=0.001)):
+            self.assertTrue(dedup.add(user_code=0, message_code=2 ** 32))
+            self.assertTrue(dedup.add(user_code=1, message_code=0))
+            self.assertTrue(dedup.add(user_code=2 ** 40, message_code=2 ** 40 + 1))
+            self.assertFalse(dedup.add(user_code=0, message_code=2 ** 32))
+
+    def test_rolling_bloom(self):
+        dedup = BloomDeduplicator(capacity=1000, error_rate=0.01)
+        nbytes = dedup.nbytes
+        for message_code in range(20):
+            dedup.add_many(user_codes=range(500), message_code=message_code)
+            self.assertFalse(dedup.add(user_code=0, message_code=message_code))
+        # Memory is fixed, and deliveries are remembered for at least a generation after them.
+        self.assertEqual(dedup.nbytes, nbytes)
+        self.assertEqual(dedup.add_many(user_codes=range(500), message_code=18), [])
+        forgotten = dedup.add_many(user_codes=range(500), message_code=0)
+        self.assertGreater(len(forgotten), 500 * (1 - 0.05))
+        self.assertLess(dedup.duplicates - 20 - 500, 10500 * 0.01)
+
+    def test_measured_error_rate(self):
+        for error_rate in (0.05, 0.01):
+            dedup = BloomDeduplicator(capacity=5000, error_rate=error_rate)
+            for message_code in range(5):
+                dedup.add_many(user_codes=range(1000), message_code=message_code)
+            false_positives = 10000 - len(dedup.add_many(user_codes=range(10000), message_code=100))
+            self.assertLess(false_positives / 10000, error_rate)
+            self.assertLess(dedup.expected_error_rate, error_rate)
+
+    def test_delivery_system(self):
+        for batch in (False, True):
+            ds = DeliverySystem(loss_chance=0, read_chance=1, deduplicator=ExactDeduplicator())
+            ds.register_users(n=100)
+            message = ds.broadcast_message(batch=batch)
+            with self.assertNoLogs(level=logging.WARNING):
+                ds.broadcast_message(message=message, batch=batch)
+            self.assertEqual((ds.deduplicator.checked, ds.deduplicator.duplicates), (200, 100))
+            self.assertEqual(len(message.users_received), 100)
+            self.assertEqual(ds.users[0].unread_count(), 0)
+        with self.assertRaises(TypeError):
+            DeliverySystem(deduplicator=set())
+
+    def test_repeated_deliveries_are_not_retried(self):
+        ds = DeliverySystem(loss_chance=0, read_chance=1, deduplicator=ExactDeduplicator(),
+                            retry_policy=RetryPolicy(max_attempts=3))
+        ds.register_users(n=100)
+        message = ds.broadcast_message(batch=True)
+        ds.broadcast_message(message=message, batch=True)
+        self.assertEqual(ds.deduplicator.duplicates, 100)
+        self.assertEqual(len(ds.scheduler), 0)
+        self.assertIsNone(ds.scheduler.next_due())
+
+    def test_async_delivery_system(self):
+        ds = AsyncDeliverySystem(loss_chance=0, read_chance=1, deduplicator=ExactDeduplicator())
+        ds.register_users(n=100)
+        message = asyncio.run(ds.abroadcast_message())
+        with self.assertNoLogs(level=logging.WARNING):
+            asyncio.run(ds.abroadcast_message(message=message))
+        self.assertEqual((ds.deduplicator.checked, ds.deduplicator.duplicates), (200, 100))
+        self.assertEqual((ds.last_report.received, ds.last_report.read), (0, 0))
+        self.assertEqual(message.get_statistics(), (100, 100, 100))
+
+    def test_false_positives_are_dropped(self):
+        ds = DeliverySystem(loss_chance=0, read_chance=1, deduplicator=BloomDeduplicator(capacity=10, error_rate=0.5))
+        ds.register_users(n=200)
+        message = ds.broadcast_message(batch=True)
+        received = len(message.users_received)
+        self.assertEqual(received, 200 - ds.deduplicator.duplicates)
+        self.assertLess(received, 200)
+        self.assertEqual(len(message.users_read), received)
+        self.assertEqual(sum(len(user.get_read_messages()) for user in ds.users), received)
+
+
+class RetentionTestCase(TestCase):
+
+    @staticmethod
+    def _system(state=None, **kwargs):
+        ds = DeliverySystem(loss_chance=0, read_chance=0, state=state, **kwargs)
+        ds.register_users(n=10)
+        return ds
+
+    def test_retention_policy(self):
+        policy = RetentionPolicy(max_messages=2)
+        self.assertEqual(list(policy.overflow(inbox=array('q', [1, 2, 3, 4]))), [1, 2])
+        self.assertEqual(list(policy.overflow(inbox=array('q', [1, 2]))), [])
+        self.assertEqual(list(RetentionPolicy().overflow(inbox=array('q', [1, 2]))), [])
+        with self.assertRaises(ValueError):
+            RetentionPolicy(max_messages=-1)
+        with self.assertRaises(TypeError):
+            RetentionPolicy(max_age='1')
+        with self.assertRaises(TypeError):
+            DeliverySystem(retention_policy=3)
+        self.assertEqual(self._system().enforce_retention(), RetentionReport(evicted=0, released=0))
+
+    def test_released_messages_are_not_sent_again(self):
+        for state in (None, SQLiteState()):
+            ds = self._system(state=state, retention_policy=RetentionPolicy(max_age=0))
+            message = ds.broadcast_message(batch=True)
+            self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=10, released=1))
+            self.assertTrue(ds._state.is_released(message_code=message.code))
+            statistics = list(ds.iter_statistics())
+            for send in (lambda: ds.send_message(user=ds.users[0], message=message),
+                         lambda: ds.broadcast_message(message=message, batch=True),
+                         lambda: ds.broadcast_message(message=message, workers=1),
+                         lambda: ds.send_to_segment(segment=Segment.from_range(name='all', start=1, stop=11),
+                                                    message=message),
+                         lambda: ds.schedule_message(at=1, message=message),
+                         lambda: asyncio.run(AsyncDeliverySystem.abroadcast_message(ds, message=message))):
+                with self.assertRaises(ValueError):
+                    send()
+            self.assertEqual(list(ds.iter_statistics()), statistics)
+            self.assertEqual(len(ds.scheduler), 0)
+            self.assertFalse(ds._state.is_released(message_code=ds.broadcast_message(batch=True).code))
+
+    def test_async_retention(self):
+        ds = AsyncDeliverySystem(loss_chance=0, read_chance=0, retention_policy=RetentionPolicy(max_messages=1))
+        ds.register_users(n=10)
+        for _ in range(2):
+            asyncio.run(ds.abroadcast_message())
+        self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=10, released=1))
+        self.assertEqual(ds.users[0].inbox, ds.messages[1:])
+
+    def test_max_messages(self):
+        ds = self._system(retention_policy=RetentionPolicy(max_messages=3))
+        messages = [ds.broadcast_message(batch=True) for _ in range(5)]
+        statistics = list(ds.iter_statistics())
+        self.assertEqual(ds.enforce_retention(batch_size=3), RetentionReport(evicted=20, released=2))
+        user = ds.users[0]
+        self.assertEqual(user.inbox, messages[:1:-1])
+        self.assertEqual(user.unread_count(), 3)
+        self.assertEqual(list(ds.iter_statistics()), statistics)
+        self.assertEqual(messages[0].users_sent, [])
+        self.assertEqual(messages[0].get_statistics(), (10, 10, 0))
+        self.assertEqual(messages[2].users_received, ds.users)
+        with self.assertRaises(ValueError):
+            user.read_message(message=messages[0])
+        self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=0, released=0))
+
+    def test_views_after_eviction(self):
+        ds = self._system(retention_policy=RetentionPolicy(max_messages=2))
+        first, second = ds.broadcast_message(), ds.broadcast_message()
+        user = ds.users[0]
+        self.assertEqual(user.inbox, [second, first])
+        self.assertEqual(user.get_unread_messages(), [second, first])
+        user.read_message(message=first)
+        third = ds.broadcast_message()
+        ds.enforce_retention()
+        # The inbox has as many messages as before, but its views must not be the cached ones.
+        self.assertEqual(user.inbox, [third, second])
+        self.assertEqual(user.get_unread_messages(), [third, second])
+        self.assertEqual(user.get_read_messages(), [])
+
+    def test_max_age(self):
+        ds = self._system(retention_policy=RetentionPolicy(max_age=5))
+        old = ds.broadcast_message(batch=True)
+        ds.tick(seconds=10)
+        new = ds.broadcast_message(batch=True)
+        self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=10, released=1))
+        self.assertEqual(ds.users[0].inbox, [new])
+        self.assertEqual(old.users_received, [])
+        ds.tick(seconds=5)
+        self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=10, released=1))
+        self.assertEqual(ds.users[0].inbox, [])
+        self.assertEqual([record[2:5] for record in ds.iter_statistics()], [(10, 10, 0), (10, 10, 0)])
+
+    def test_archive_read(self):
+        ds = self._system(retention_policy=RetentionPolicy(archive_read=True))
+        ds.read_chance = 1
+        read = ds.broadcast_message(batch=True)
+        ds.read_chance = 0
+        unread = ds.broadcast_message(batch=True)
+        ds.users[0].read_message(message=unread)
+        self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=10, released=1))
+        self.assertEqual(ds.users[0].inbox, [unread])
+        self.assertEqual(ds.users[0].get_read_messages(), [unread])
+        self.assertEqual(read.get_statistics(), (10, 10, 10))
+        for user in ds.users[1:]:
+            user.mark_all_read()
+        self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=10, released=1))
+        self.assertEqual(ds.users[0].inbox, [])
+
+    def test_pending_messages_are_kept(self):
+        ds = self._system(retention_policy=RetentionPolicy(max_age=0), retry_policy=RetryPolicy(max_attempts=2))
+        ds.loss_chance = 1
+        lost = ds.broadcast_message(batch=True)
+        self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=0, released=0))
+        self.assertEqual(len(lost.users_sent), 10)
+        ds.drain_scheduled()
+        self.assertEqual(ds.enforce_retention(), RetentionReport(evicted=0, released=1))
+        self.assertEqual(next(ds.iter_statistics())[2:], (10, 0, 0, 20))
+
+    def test_user_retention(self):
+        ds = self._system()
+        messages = [ds.broadcast_message() for _ in range(4)]
+        user = ds.users[0]
+        self.assertEqual(user.apply_retention(policy=RetentionPolicy(max_messages=1)), 3)
+        self.assertEqual(user.inbox, messages[3:])
+        self.assertEqual(user.evict_messages(codes=[messages[3].code, messages[0].code]), 1)
+        self.assertEqual(user.inbox, [])
+        self.assertEqual(len(messages[0].users_received), 10)
+
+    def test_sqlite_retention(self):
+        policy = RetentionPolicy(max_messages=2, max_age=5)
+        memory, database = (self._system(state=state, retention_policy=policy) for state in (None, SQLiteState()))
+        for ds in (memory, database):
+            for _ in range(4):
+                ds.broadcast_message(batch=True)
+            ds.users[0].read_message(message=ds.messages[3])
+            self.assertEqual(ds.enforce_retention(batch_size=4), RetentionReport(evicted=20, released=2))
+            ds.tick(seconds=10)
+            ds.broadcast_message(batch=True)
+            self.assertEqual(ds.enforce_retention(batch_size=4), RetentionReport(evicted=20, released=2))
+        for memory_user, database_user in zip(memory.users, database.users):
+            self.assertEqual([message.code for message in memory_user.inbox],
+                             [message.code for message in database_user.inbox])
+            self.assertEqual(memory_user.unread_count(), database_user.unread_count())
+        self.assertEqual([record[:1] + record[2:] for record in memory.iter_statistics()],
+                         [record[:1] + record[2:] for record in database.iter_statistics()])
+        self.assertEqual(database.messages[0].users_sent, [])
+        database.close()
+
+    def test_snapshot_retention(self):
+        ds = self._system(retention_policy=RetentionPolicy(max_messages=1))
+        ds.broadcast_message(batch=True)
+        ds.tick(seconds=3)
+        ds.broadcast_message(batch=True)
+        ds.enforce_retention()
+        user = ds.users[0]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'delivery.snapshot')
+            ds.save(path=path)
+            loaded = DeliverySystem.load(path=path)
+        loaded_user = loaded.users[0]
+        self.assertEqual(loaded.clock(), 3)
+        self.assertEqual(loaded._state.first_sent(), {2: 3})
+        self.assertTrue(loaded._state.is_released(message_code=1))
+        self.assertFalse(loaded._state.is_released(message_code=2))
+        self.assertEqual(loaded._state.evicted(user_code=loaded_user.code), 1)
+        self.assertEqual(loaded_user._inbox_version(), user._inbox_version())
+        self.assertEqual(list(loaded.iter_statistics()), list(ds.iter_statistics()))
+
+
+class ThrottlingTestCase(TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, capacity=20)
+        self.assertEqual(bucket.take(count=25, now=0), 20)
+        self.assertEqual(bucket.available(now=0), 0)
+        self.assertAlmostEqual(bucket.wait(count=5, now=0), 0.5)
+        self.assertEqual(bucket.take(count=25, now=0.5), 5)
+        self.assertEqual(bucket.available(now=100), 20)
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0)
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=10, capacity=0.5)
+        with self.assertRaises(TypeError):
+            TokenBucket(rate='10')
+
+    def test_drain(self):
+        throttled = ThrottledDeliverySystem(seed=1, rate=100)
+        plain = DeliverySystem(seed=1)
+        for ds in (throttled, plain):
+            ds.register_users(n=1000)
+            ds.broadcast_message(batch=True)
+        self.assertEqual(throttled.queue_depth, 1000)
+        self.assertEqual(throttled.messages[0].users_sent, [])
+        report = throttled.drain()
+        self.assertEqual(throttled.queue_depth, 0)
+        self.assertEqual(report.deliveries, 1000)
+        self.assertAlmostEqual(report.elapsed, 9)
+        self.assertEqual(report.max_queue_depth, 900)
+        self.assertEqual(report.queue_depths[:2], [(0, 900), (1, 800)])
+        self.assertEqual(list(throttled.iter_statistics()), list(plain.iter_statistics()))
+
+    def test_channels(self):
+        ds = ThrottledDeliverySystem(rate=300, channel_rates={'sms': 10},
+                                     channel=lambda user: 'sms' if user.code % 10 == 0 else 'push')
+        ds.register_users(n=100)
+        ds.broadcast_message()
+        self.assertEqual(ds.queue_depths(), {'sms': 10, 'push': 90})
+        self.assertEqual(ds.run_throttled(), 100)
+        ds.broadcast_message()
+        ds.broadcast_message()
+        self.assertEqual(ds.run_throttled(), 100)
+        self.assertEqual(ds.queue_depths(), {'sms': 20, 'push': 80})
+        ds.clock.advance(0.5)
+        self.assertEqual(ds.run_throttled(), 85)
+        self.assertEqual(ds.queue_depths(), {'sms': 15})
+        report = ds.drain()
+        self.assertAlmostEqual(report.elapsed, 1.5)
+        self.assertEqual(len(ds.messages[2].users_sent), 100)
+
+    def test_channels_share_few_tokens(self):
+        ds = ThrottledDeliverySystem(rate=1, channel=lambda user: f'channel{user.code % 3}')
+        ds.register_users(n=30)
+        ds.broadcast_message()
+        for _ in range(6):
+            self.assertEqual(ds.run_throttled(), 1)
+            ds.clock.advance(1)
+        self.assertEqual(ds.queue_depths(), {'channel0': 8, 'channel1': 8, 'channel2': 8})
+        ds.limit(rate=2)
+        for _ in range(3):
+            self.assertEqual(ds.run_throttled(), 2)
+            ds.clock.advance(1)
+        self.assertEqual(ds.queue_depths(), {'channel0': 6, 'channel1': 6, 'channel2': 6})
+
+    def test_slow_rate(self):
+        self.assertEqual(TokenBucket(rate=0.5).capacity, 1)
+        ds = ThrottledDeliverySystem(rate=0.5)
+        ds.register_users(n=3)
+        ds.broadcast_message()
+        report = ds.drain()
+        self.assertEqual(report.deliveries, 3)
+        self.assertAlmostEqual(report.elapsed, 4)
+
+    def test_drain_with_retries(self):
+        ds = ThrottledDeliverySystem(loss_chance=1, rate=50, retry_policy=RetryPolicy(max_attempts=3, base_delay=10))
+        ds.register_users(n=100)
+        ds.broadcast_message(batch=True)
+        report = ds.drain()
+        self.assertEqual(report.deliveries, 300)
+        self.assertEqual(next(ds.iter_statistics()).attempts, 300)
+        self.assertEqual(ds.queue_depth, 0)
+        self.assertIsNone(ds.scheduler.next_due())
+
+    def test_unlimited_and_scheduled(self):
+        ds = ThrottledDeliverySystem()
+        ds.register_users(n=10)
+        ds.broadcast_message()
+        self.assertEqual(ds.run_throttled(), 10)
+        ds.limit(rate=4)
+        ds.schedule_message(at=1)
+        self.assertEqual(ds.tick(seconds=1), 4)
+        self.assertEqual(ds.tick(seconds=1), 4)
+        ds.limit(rate=None)
+        self.assertEqual(ds.run_throttled(), 2)
+
+
+class SnapshotTestCase(TestCase):
+
+    def setUp(self):
+        self.ds = DeliverySystem(loss_chance=0.2, read_chance=0.5, seed=1)
+        self.ds.register_users(n=50)
+        for _ in range(3):
+            self.ds.broadcast_message(batch=True)
+        self.ds.send_message(user=self.ds.users[0], body='Plain body.')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'delivery.snapshot')
+
+    @staticmethod
+    def get_statistics(ds):
+        lines = []
+        ds.show_statistics(display_func=lines.append)
+        return lines
+
+    def test_save_and_load(self):
+        self.ds.save(path=self.path)
+        loaded = DeliverySystem.load(path=self.path)
+        self.assertEqual((loaded.loss_chance, loaded.read_chance, loaded.seed), (0.2, 0.5, 1))
+        self.assertEqual((loaded._user_count, loaded._message_count), (50, 4))
+        self.assertEqual(self.get_statistics(loaded), self.get_statistics(self.ds))
+        for user, loaded_user in zip(self.ds.users, loaded.users):
+            self.assertEqual((loaded_user.code, loaded_user.name), (user.code, user.name))
+            self.assertEqual([message.code for message in loaded_user.inbox], [message.code for message in user.inbox])
+            self.assertEqual([message.code for message in loaded_user.get_unread_messages()],
+                             [message.code for message in user.get_unread_messages()])
+            self.assertTrue(loaded.is_registered_user(user=loaded_user))
+        for message, loaded_message in zip(self.ds.messages, loaded.messages):
+            self.assertEqual(loaded_message.body, message.body)
+            self.assertEqual([user.code for user in loaded_message.users_read],
+                             [user.code for user in message.users_read])
+
+    def test_load_is_lazy(self):
+        self.ds.save(path=self.path)
+        loaded = DeliverySystem.load(path=self.path)
+        state = loaded._state
+        self.assertEqual(dict.__len__(state._users), 0)
+        self.assertEqual(dict.__len__(state._messages), 0)
+        user = state.get_user(code=10)
+        self.assertEqual(user.code, 10)
+        self.assertIs(state.get_user(code=10), user)
+        self.assertEqual(dict.__len__(state._users), 1)
+        self.assertEqual(loaded.get_message(code=4).body, 'Plain body.')
+        self.assertIsNone(state.get_user(code=51))
+
+    def test_resume(self):
+        self.ds.save(path=self.path)
+        loaded = DeliverySystem.load(path=self.path)
+        for ds in (self.ds, loaded):
+            ds.register_user()
+            ds.broadcast_message()
+        self.assertEqual(self.get_statistics(loaded), self.get_statistics(self.ds))
+        self.assertEqual([user.name for user in loaded.users], [user.name for user in self.ds.users])
+
+    def test_load_configuration(self):
+        self.ds.save(path=self.path)
+        loaded = DeliverySystem.load(path=self.path)
+        self.assertIsInstance(loaded.clock, SimulatedClock)
+        self.assertEqual(loaded.clock(), self.ds.clock())
+        retry_policy, retention_policy = RetryPolicy(max_attempts=3), RetentionPolicy(max_messages=2)
+        deduplicator = ExactDeduplicator()
+        loaded = DeliverySystem.load(path=self.path, clock=time.time, retry_policy=retry_policy,
+                                     deduplicator=deduplicator, retention_policy=retention_policy)
+        self.assertIs(loaded.clock, time.time)
+        self.assertIs(loaded.retry_policy, retry_policy)
+        self.assertIs(loaded.retention_policy, retention_policy)
+        self.assertIs(loaded.deduplicator, deduplicator)
+
+    def test_overwrite_loaded_snapshot(self):
+        self.ds.save(path=self.path)
+        loaded = DeliverySystem.load(path=self.path)
+        loaded.broadcast_message(batch=True)
+        loaded.save(path=self.path)
+        self.assertEqual(self.get_statistics(DeliverySystem.load(path=self.path)), self.get_statistics(loaded))
+
+    def test_load_invalid_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'not a snapshot' * 10)
+        with self.assertRaises(ValueError):
+            DeliverySystem.load(path=self.path)
+
+    def test_snapshot_mapping(self):
+        mapping = snapshot_module.SnapshotMapping(keys=array('q', [1, 3, 5]), load=lambda position: position * 10)
+        mapping[4] = 'added'
+        self.assertEqual(mapping.get(3), 10)
+        self.assertIsNone(mapping.get(2))
+        self.assertIn(5, mapping)
+        del mapping[1]
+        self.assertNotIn(1, mapping)
+        self.assertEqual(list(mapping.items()), [(3, 10), (5, 20), (4, 'added')])
+
+
+class SQLiteStateTestCase(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'delivery.db')
+
+    @staticmethod
+    def simulate(ds):
+        ds.register_users(n=30)
+        ds.register_user(name='John Doe')
+        ds.broadcast_message()
+        ds.broadcast_message(batch=True)
+        ds.create_messages(n=2, bodies=['First message.', 'Second message.'])
+        ds.send_message(user=ds.users[3], message=ds.messages[-1])
+        lines = []
+        ds.show_statistics(display_func=lines.append)
+        return lines
+
+    def test_same_results_as_memory(self):
+        memory, database = DeliverySystem(seed=1), DeliverySystem(seed=1, state=SQLiteState())
+        self.assertEqual(self.simulate(database), self.simulate(memory))
+        for user, database_user in zip(memory.users, database.users):
+            self.assertEqual([message.code for message in database_user.inbox],
+                             [message.code for message in user.inbox])
+            self.assertEqual([message.code for message in database_user.get_read_messages()],
+                             [message.code for message in user.get_read_messages()])
+            self.assertEqual([message.code for message in database_user.iter_unread_messages()],
+                             [message.code for message in user.iter_unread_messages()])
+            self.assertEqual(database_user.unread_count(), user.unread_count())
+            self.assertEqual([message.code for message in database_user.inbox_page(limit=1, before_code=2)],
+                             [message.code for message in user.inbox_page(limit=1, before_code=2)])
+        for message, database_message in zip(memory.messages, database.messages):
+            self.assertEqual(database_message.body, message.body)
+            self.assertEqual([user.code for user in database_message.users_received],
+                             [user.code for user in message.users_received])
+
+    def test_registered_objects(self):
+        ds = DeliverySystem(state=SQLiteState())
+        user = ds.register_user(name='John Doe')
+        message = ds.create_message(body='A message.')
+        self.assertTrue(ds.is_registered_user(user=user))
+        self.assertTrue(ds.is_registered_message(message=message))
+        self.assertFalse(ds.is_registered_user(user=User(name='John Doe', code=user.code)))
+        self.assertIs(ds.get_message(code=message.code), message)
+        self.assertIsNone(ds.get_message(code=2))
+
+    def test_reopen_database(self):
+        ds = DeliverySystem(seed=1, state=SQLiteState(path=self.path))
+        statistics = self.simulate(ds)
+        ds.close()
+        reopened = DeliverySystem(state=SQLiteState(path=self.path))
+        self.assertEqual((reopened._user_count, reopened._message_count), (31, 4))
+        lines = []
+        reopened.show_statistics(display_func=lines.append)
+        self.assertEqual(lines, statistics)
+        self.assertEqual(reopened.register_user().code, 32)
+        reopened.close()
+
+    def test_reopen_first_deliveries(self):
+        ds = DeliverySystem(loss_chance=0, read_chance=0, state=SQLiteState(path=self.path))
+        ds.register_users(n=5)
+        ds.broadcast_message(batch=True)
+        ds.tick(seconds=10)
+        ds.broadcast_message(batch=True, workers=1)
+        ds.close()
+        reopened = DeliverySystem(state=SQLiteState(path=self.path), clock=SimulatedClock(start=20),
+                                  retention_policy=RetentionPolicy(max_age=15))
+        self.assertEqual(reopened._state.first_sent(), {1: 0, 2: 10})
+        self.assertEqual(reopened.enforce_retention(), RetentionReport(evicted=5, released=1))
+        self.assertEqual(reopened._state.first_sent(), {2: 10})
+        self.assertEqual([message.code for message in reopened.users[0].inbox], [2])
+        reopened.close()
+        state = SQLiteState(path=self.path)
+        self.assertTrue(state.is_released(message_code=1))
+        self.assertFalse(state.is_released(message_code=2))
+        state.close()
+
+    def test_receipt_tables(self):
+        state = SQLiteState()
+        state.mark(status=SENT, message_code=1, user_codes=Bitmap((1, 2, 3)))
+        state.mark(status=SENT, message_code=1, user_codes=(3, 4))
+        self.assertEqual(state.count(status=SENT, message_code=1), 4)
+        self.assertEqual(list(state.user_codes(status=SENT, message_code=1)), [1, 2, 3, 4])
+        self.assertTrue(state.has_all(status=SENT, message_code=1, user_codes=Bitmap((1, 4))))
+        self.assertFalse(state.has_all(status=SENT, message_code=1, user_codes=Bitmap((1, 5))))
+        self.assertEqual(state.add_to_inboxes(user_codes=(1, 2), message_code=1), 2)
+        self.assertFalse(state.add_to_inbox(user_code=1, message_code=1))
+        self.assertEqual(list(state.inbox(user_code=1)), [1])
+        self.assertTrue(state.in_inbox(user_code=2, message_code=1))
+
+    def test_snapshot_not_supported(self):
+        ds = DeliverySystem(state=SQLiteState())
+        with self.assertRaises(TypeError):
+            ds.save(path=self.path)
+
 
 class DeliverySystemTestCase(TestCase):
 
@@ -244,10 +1431,9 @@ class DeliverySystemTestCase(TestCase):
         ds = DeliverySystem(loss_chance=self.loss_chance, read_chance=self.read_chance)
         self.assertEqual(ds._loss_chance, self.loss_chance)
         self.assertEqual(ds._read_chance, self.read_chance)
-        self.assertIsInstance(ds._users, set)
-        self.assertEqual(len(ds._users), 0)
-        self.assertIsInstance(ds._messages, set)
-        self.assertEqual(len(ds._messages), 0)
+        self.assertIsInstance(ds._state, DeliveryState)
+        self.assertEqual(len(ds.users), 0)
+        self.assertEqual(len(ds.messages), 0)
 
     def test_default_chances(self):
         ds = DeliverySystem()
@@ -286,6 +1472,77 @@ class DeliverySystemTestCase(TestCase):
         self.assertEqual(user.name, username)
         self.assertEqual(user.code, 1)
 
+    def test_register_users(self):
+        first = self.ds.register_user(name='John Doe')
+        users = self.ds.register_users(n=3, names=['Jane Doe', 'John Smith', 'Jane Smith'])
+        self.assertEqual([user.code for user in users], [2, 3, 4])
+        self.assertEqual([user.name for user in users], ['Jane Doe', 'John Smith', 'Jane Smith'])
+        self.assertEqual(self.ds.users, [first] + users)
+        self.assertEqual(self.ds._user_count, 4)
+        self.assertTrue(all(self.ds.is_registered_user(user=user) for user in users))
+        self.assertEqual(self.ds.register_user().code, 5)
+
+    def test_register_user_and_create_message_validation(self):
+        with self.assertRaises(TypeError):
+            self.ds.register_user(name=1234)
+        with self.assertRaises(TypeError):
+            self.ds.create_message(body=1234)
+
+    def test_register_users_random_names(self):
+        users = self.ds.register_users(n=100)
+        self.assertEqual(len(self.ds.users), 100)
+        self.assertTrue(all(user.name in names_module.get_full_names() for user in users))
+        seeded = [[user.name for user in DeliverySystem(seed=7).register_users(n=10)] for _ in range(2)]
+        self.assertEqual(seeded[0], seeded[1])
+
+    def test_register_users_validation(self):
+        for arguments, error in (
+            ({'n': '1'}, TypeError),
+            ({'n': -1}, ValueError),
+            ({'n': 2, 'names': ['John Doe']}, ValueError),
+            ({'n': 1, 'names': [1]}, TypeError),
+        ):
+            with self.assertRaises(error):
+                self.ds.register_users(**arguments)
+        self.assertEqual(self.ds.users, [])
+        self.assertEqual(self.ds._user_count, 0)
+
+    def test_define_segment(self):
+        users = self.ds.register_users(n=10)
+        self.assertEqual(list(self.ds.define_segment(name='all', start=1)), list(range(1, 11)))
+        self.assertEqual(list(self.ds.define_segment(name='some', users=users[:3])), [1, 2, 3])
+        even = self.ds.define_segment(name='even', predicate=lambda user: user.code % 2 == 0)
+        self.assertEqual(list(even), [2, 4, 6, 8, 10])
+        self.assertIs(self.ds.get_segment(name='even'), even)
+        self.assertIsNone(self.ds.get_segment(name='odd'))
+        combined = self.ds.add_segment(segment=self.ds.get_segment(name='all') - even)
+        self.assertIs(self.ds.get_segment(name='(all - even)'), combined)
+        for arguments in ({}, {'users': users, 'start': 1}, {'start': 1, 'predicate': bool}):
+            with self.assertRaises(ValueError):
+                self.ds.define_segment(name='wrong', **arguments)
+
+    def test_send_to_segment(self):
+        ds = DeliverySystem(loss_chance=0, read_chance=1)
+        users = ds.register_users(n=10)
+        ds.define_segment(name='middle', start=4, stop=7)
+        message = ds.send_to_segment(segment='middle')
+        self.assertEqual(message.users_read, users[3:6])
+        segment = Segment(name='unregistered', codes=(1, 100))
+        batch_message = ds.send_to_segment(segment=segment, batch=True)
+        self.assertEqual(batch_message.users_sent, [users[0]])
+        self.assertEqual(users[0].inbox, [batch_message])
+        with self.assertRaises(ValueError):
+            ds.send_to_segment(segment='missing')
+
+    def test_send_to_segment_same_as_per_user(self):
+        results = []
+        for batch in (False, True):
+            ds = DeliverySystem(seed=3)
+            ds.register_users(n=50)
+            message = ds.send_to_segment(segment=ds.define_segment(name='slice', start=10, stop=40), batch=batch)
+            results.append(([user.code for user in message.users_received], [user.code for user in message.users_read]))
+        self.assertEqual(results[0], results[1])
+
     def test_create_message(self):
         message_body = 'This is a message.'
         self.assertEqual(len(self.ds.messages), 0)
@@ -296,6 +1553,28 @@ class DeliverySystemTestCase(TestCase):
         self.assertEqual(message.body, message_body)
         self.assertEqual(message.code, 1)
 
+    def test_create_messages(self):
+        first = self.ds.create_message(body='This is a message.')
+        messages = self.ds.create_messages(n=2, bodies=['Second message.', 'Third message.'])
+        self.assertEqual([message.code for message in messages], [2, 3])
+        self.assertEqual([message.body for message in messages], ['Second message.', 'Third message.'])
+        self.assertEqual(self.ds.messages, [first] + messages)
+        self.assertTrue(all(self.ds.is_registered_message(message=message) for message in messages))
+        random_messages = self.ds.create_messages(n=10)
+        self.assertEqual(self.ds._message_count, 13)
+        self.assertTrue(all(message.body.endswith('.') for message in random_messages))
+
+    def test_create_messages_validation(self):
+        for arguments, error in (
+            ({'n': '1'}, TypeError),
+            ({'n': -1}, ValueError),
+            ({'n': 2, 'bodies': ['A message.']}, ValueError),
+            ({'n': 1, 'bodies': [1]}, TypeError),
+        ):
+            with self.assertRaises(error):
+                self.ds.create_messages(**arguments)
+        self.assertEqual(self.ds.messages, [])
+
     def test_get_user_and_message_code(self):
         control_series = list(range(1, 11))
         for code_generator in (self.ds._get_user_code, self.ds._get_message_code):
@@ -330,6 +1609,11 @@ class DeliverySystemTestCase(TestCase):
         unregistered_message = Message(body='This message is not registered', code=registered_message.code + 1)
         self.assertFalse(self.ds.is_registered_message(message=unregistered_message))
 
+    def test_get_message(self):
+        message = self.ds.create_message(body='This message is registered')
+        self.assertIs(self.ds.get_message(code=message.code), message)
+        self.assertIsNone(self.ds.get_message(code=message.code + 1))
+
     def test_send_message(self):
         user = self.ds.register_user(name='John Doe')
         message = self.ds.create_message(body='This is a message')
@@ -385,6 +1669,86 @@ class DeliverySystemTestCase(TestCase):
         with self.assertRaises(ValueError):
             self.ds.broadcast_message(message=message)
 
+    def test_batch_broadcast_message(self):
+        users = [self.ds.register_user() for _ in range(3)]
+        message = self.ds.broadcast_message(body='This message will be sent to every user.', batch=True)
+        for user in users:
+            self.assertIn(message, user.inbox)
+        self.assertEqual(message.get_statistics(), (len(users), len(users), len(users)))
+
+    def test_batch_broadcast_message_validation(self):
+        self.ds.register_user()
+        message = Message(body='This message is not registered.', code=1)
+        with self.assertRaises(ValueError):
+            self.ds.broadcast_message(message=message, batch=True)
+
+    def test_batch_broadcast_statistics(self):
+        for _ in range(1000):
+            self.ds.register_user()
+        self.ds.loss_chance = 0.1
+        self.ds.read_chance = 0.5
+        random.seed(1234)
+        control_message = self.ds.broadcast_message()
+        random.seed(1234)
+        message = self.ds.broadcast_message(batch=True)
+        self.assertEqual(message.get_statistics(), control_message.get_statistics())
+        self.assertEqual(message.users_read, control_message.users_read)
+
+    def test_seed(self):
+        systems = [DeliverySystem(loss_chance=0.1, read_chance=0.5, seed=seed) for seed in (1, 1, 2)]
+        for ds in systems:
+            for _ in range(100):
+                ds.register_user()
+            ds.broadcast_message()
+            ds.broadcast_message(batch=True)
+            ds.broadcast_message(workers=1)
+        control, same_seed, other_seed = (
+            [(message.body, message.get_statistics(), [user.name for user in message.users_read])
+             for message in ds.messages]
+            for ds in systems
+        )
+        self.assertEqual(same_seed, control)
+        self.assertNotEqual(other_seed, control)
+
+    def test_seed_batch_broadcast_statistics(self):
+        results = []
+        for batch in (False, True):
+            ds = DeliverySystem(loss_chance=0.1, read_chance=0.5, seed=1234)
+            for _ in range(1000):
+                ds.register_user()
+            message = ds.broadcast_message(batch=batch)
+            results.append((message.get_statistics(), [user.code for user in message.users_read]))
+        self.assertEqual(results[0], results[1])
+
+    def test_sharded_broadcast_message(self):
+        users = [self.ds.register_user() for _ in range(3)]
+        message = self.ds.broadcast_message(body='This message will be sent to every user.', workers=1)
+        for user in users:
+            self.assertIn(message, user.inbox)
+        self.assertEqual(message.get_statistics(), (len(users), len(users), len(users)))
+
+    def test_sharded_broadcast_single_shard(self):
+        for _ in range(100):
+            self.ds.register_user()
+        with patch('delivery.ProcessPoolExecutor') as executor:
+            message = self.ds.broadcast_message(workers=8)
+        executor.assert_not_called()
+        self.assertEqual(message.get_statistics(), (100, 100, 100))
+
+    def test_sharded_broadcast_workers(self):
+        for _ in range(1000):
+            self.ds.register_user()
+        self.ds.loss_chance = 0.1
+        self.ds.read_chance = 0.5
+        random.seed(1234)
+        with patch('delivery.SHARD_SIZE', 100):
+            message = self.ds.broadcast_message(workers=2)
+        random.seed(1234)
+        with patch('delivery.SHARD_SIZE', 100):
+            control_message = self.ds.broadcast_message(workers=1)
+        self.assertEqual(message.get_statistics(), control_message.get_statistics())
+        self.assertEqual(message.users_read, control_message.users_read)
+
     def test_loss_chance(self):
         users = [self.ds.register_user() for _ in range(1000)]
         self.assertEqual(len(self.ds.users), len(users))
@@ -408,3 +1772,111 @@ class DeliverySystemTestCase(TestCase):
         self.assertEqual(len(message.users_sent), len(users))
         self.assertEqual(len(message.users_received), len(users))
         self.assertEqual(len(message.users_read), 0)
+
+
+class AsyncDeliverySystemTestCase(TestCase):
+
+    loss_chance = 0
+    read_chance = 1
+
+    def setUp(self):
+        self.ds = AsyncDeliverySystem(loss_chance=self.loss_chance, read_chance=self.read_chance, concurrency=10)
+
+    def test_asend_message(self):
+        user = self.ds.register_user(name='John Doe')
+        message = asyncio.run(self.ds.asend_message(user=user, body='This is a message'))
+        self.assertEqual(message.get_statistics(), (1, 1, 1))
+        self.assertIn(message, user.inbox)
+
+    def test_asend_message_user_validation(self):
+        user = User(name='John Doe', code=1)
+        with self.assertRaises(ValueError):
+            asyncio.run(self.ds.asend_message(user=user, body='This should raise and exception.'))
+
+    def test_abroadcast_message(self):
+        users = [self.ds.register_user() for _ in range(100)]
+        message = asyncio.run(self.ds.abroadcast_message())
+        self.assertEqual(message.get_statistics(), (len(users), len(users), len(users)))
+        self.assertEqual(self.ds.last_report.deliveries, len(users))
+        self.assertEqual(self.ds.last_report.read, len(users))
+
+    def test_abroadcast_message_concurrency(self):
+        in_flight = []
+        max_in_flight = []
+
+        async def transport(user, message):
+            in_flight.append(user)
+            await asyncio.sleep(0)
+            max_in_flight.append(len(in_flight))
+            in_flight.remove(user)
+            return True, False
+
+        self.ds.transport = LatencyTransport(latency=0, transport=transport)
+        for _ in range(100):
+            self.ds.register_user()
+        message = asyncio.run(self.ds.abroadcast_message())
+        self.assertEqual(message.get_statistics(), (100, 100, 0))
+        self.assertEqual(max(max_in_flight), self.ds.concurrency)
+
+    def test_abroadcast_message_retries(self):
+        self.ds = AsyncDeliverySystem(loss_chance=1, read_chance=0, retry_policy=RetryPolicy(max_attempts=3))
+        for _ in range(10):
+            self.ds.register_user()
+        message = asyncio.run(self.ds.abroadcast_message())
+        self.assertEqual(self.ds.last_report.received, 0)
+        self.assertEqual(len(self.ds.scheduler), 10)
+        self.ds.loss_chance = 0
+        self.assertEqual(asyncio.run(self.ds.adrain_scheduled()), 10)
+        self.assertEqual(message.get_statistics(), (10, 10, 0))
+        self.assertEqual(next(self.ds.iter_statistics()).attempts, 20)
+        with self.assertRaises(TypeError):
+            self.ds.run_scheduled()
+
+    def test_retries_through_transport(self):
+        calls = []
+
+        async def transport(user, message):
+            calls.append(user.code)
+            return False, False
+
+        self.ds = AsyncDeliverySystem(transport=transport, retry_policy=RetryPolicy(max_attempts=3), concurrency=2)
+        for _ in range(5):
+            self.ds.register_user()
+        message = asyncio.run(self.ds.abroadcast_message())
+        self.assertEqual(asyncio.run(self.ds.arun_scheduled()), 0)
+        self.assertEqual(asyncio.run(self.ds.adrain_scheduled()), 10)
+        self.assertEqual(sorted(calls), sorted(list(range(1, 6)) * 3))
+        self.assertEqual(message.get_statistics(), (5, 0, 0))
+        self.assertEqual(next(self.ds.iter_statistics()).attempts, 15)
+        self.assertEqual(len(self.ds.scheduler), 0)
+
+    def test_concurrency_validation(self):
+        with self.assertRaises(TypeError):
+            AsyncDeliverySystem(concurrency='10')
+        with self.assertRaises(TypeError):
+            AsyncDeliverySystem(concurrency=2.5)
+        with self.assertRaises(ValueError):
+            AsyncDeliverySystem(concurrency=0)
+
+    def test_abroadcast_message_transport_failure(self):
+        delivered = []
+
+        async def transport(user, message):
+            await asyncio.sleep(0.01 if user.code < 5 else 0.05 if user.code == 5 else 10)
+            if user.code == 5:
+                raise ConnectionError('Transport is down.')
+            delivered.append(user)
+            return True, False
+
+        self.ds.transport = transport
+        for _ in range(100):
+            self.ds.register_user()
+        message = self.ds.create_message()
+
+        async def broadcast():
+            await asyncio.wait_for(self.ds.abroadcast_message(message=message), timeout=5)
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(broadcast())
+        self.assertEqual(len(delivered), 4)
+        self.assertEqual(message.get_statistics(), (14, 4, 0))
@@ -13,6 +13,55 @@ quis ultrices dui.
 WORDS = TEXT.replace('.', '').split()
 
 
-def get_random_text(num_words):
-    words = (''.join(random.choice(WORDS) + ' ' for _ in range(num_words))).strip().strip(',').capitalize() + '.'
+def get_random_text(num_words, rng=random):
+    words = (''.join(rng.choice(WORDS) + ' ' for _ in range(num_words))).strip().strip(',').capitalize() + '.'
     return words
+
+
+class LazyText(bytes):
+    """
+    Random text stored as the indexes of its words in the word pool, one byte per word, so that it takes a fraction of
+    the memory of the text itself and the words are shared by every text. The text is only built when it is read, the
+    same way "get_random_text" builds it.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        """
+        Builds the text from its words.
+        :return: The text.
+        :rtype: str
+        """
+        return ' '.join([WORDS[index] for index in self]).strip(',').capitalize() + '.'
+
+    def __repr__(self):
+        return str(self)
+
+
+def get_random_lazy_text(num_words, rng=random):
+    """
+    Generates a random text that is only built when it is read.
+    :param num_words: Number of words of the text.
+    :type num_words: int
+    :param rng: Random number generator to draw from, either the "random" module or a "random.Random" instance.
+    :type rng: random.Random
+    :return: The random text.
+    :rtype: LazyText
+    """
+    return LazyText(rng.choices(range(len(WORDS)), k=num_words))
+
+
+def get_random_lazy_texts(size, num_words, rng=random):
+    """
+    Generates several random texts that are only built when they are read, drawing the words of all of them at once.
+    :param size: Number of texts to generate.
+    :type size: int
+    :param num_words: Number of words of every text.
+    :type num_words: int
+    :param rng: Random number generator to draw from, either the "random" module or a "random.Random" instance.
+    :type rng: random.Random
+    :return: The random texts.
+    :rtype: list
+    """
+    indexes = bytes(rng.choices(range(len(WORDS)), k=size * num_words))
+    return [LazyText(indexes[start:start + num_words]) for start in range(0, len(indexes), num_words)]
@@ -0,0 +1,438 @@
+import time
+import logging
+from array import array
+from collections import deque
+
+from delivery import DeliverySystem, LOSS_CHANCE, READ_CHANCE, MIN_BATCH_SIZE
+from scheduler import SimulatedClock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = 'default'
+BURST = 1.0
+# Tokens are granted up to a microsecond early, so that the float errors of refills do not leave a bucket waiting for
+# fractions of a token that would take less time to refill than the clock can tell apart.
+TOLERANCE = 1e-6
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter. Tokens are refilled continuously at a fixed rate up to the capacity of the bucket, and
+    every delivery takes one token, so deliveries are limited to the rate on average with bursts up to the capacity.
+    Time is passed in by the caller, so that buckets work with simulated clocks as well as with the wall clock.
+    """
+    __slots__ = ('_rate', '_capacity', '_tokens', '_updated')
+
+    def __init__(self, rate, capacity=None, now=0.0):
+        """
+        :param rate: Number of tokens refilled per second.
+        :type rate: float
+        :param capacity: Maximum number of tokens of the bucket. Defaults to one second of tokens, or a single token if
+        the rate is lower than one per second.
+        :type capacity: float
+        :param now: Current time in seconds. The bucket starts full.
+        :type now: float
+        """
+        if not isinstance(rate, (int, float)) or not isinstance(capacity, (int, float, type(None))):
+            raise TypeError('Token bucket rate and capacity must be numbers.')
+        if rate <= 0:
+            raise ValueError('Token bucket rate must be a positive number.')
+        capacity = max(1, rate) if capacity is None else capacity
+        if capacity < 1:
+            raise ValueError('Token bucket capacity must be at least one token.')
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = now
+
+    @property
+    def rate(self):
+        """
+        Getter method for the refill rate of the bucket.
+        :return: Number of tokens refilled per second.
+        :rtype: float
+        """
+        return self._rate
+
+    @property
+    def capacity(self):
+        """
+        Getter method for the capacity of the bucket.
+        :return: Maximum number of tokens of the bucket.
+        :rtype: float
+        """
+        return self._capacity
+
+    def _refill(self, now):
+        """
+        Adds the tokens refilled since the last update, without exceeding the capacity.
+        :param now: Current time in seconds.
+        :type now: float
+        """
+        if now > self._updated:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+    def available(self, now):
+        """
+        Retrieves the number of whole tokens available.
+        :param now: Current time in seconds.
+        :type now: float
+        :return: Number of tokens that can be taken.
+        :rtype: int
+        """
+        self._refill(now=now)
+        return int(self._tokens + self._rate * TOLERANCE)
+
+    def take(self, count, now):
+        """
+        Takes up to this number of tokens.
+        :param count: Number of tokens wanted.
+        :type count: int
+        :param now: Current time in seconds.
+        :type now: float
+        :return: Number of tokens taken.
+        :rtype: int
+        """
+        taken = min(count, self.available(now=now))
+        self._tokens -= taken
+        return taken
+
+    def wait(self, count, now):
+        """
+        Computes the time until this number of tokens is available, up to the capacity of the bucket.
+        :param count: Number of tokens wanted.
+        :type count: int
+        :param now: Current time in seconds.
+        :type now: float
+        :return: Time to wait in seconds.
+        :rtype: float
+        """
+        self._refill(now=now)
+        return max(0.0, (min(count, int(self._capacity)) - self._tokens) / self._rate)
+
+
+class ThrottleReport(object):
+    """
+    Report of the deliveries sent through a throttled delivery system until its queues were drained: how many were
+    sent, how long they took by the clock of the system and how deep the queues got along the way.
+    """
+
+    def __init__(self):
+        self.deliveries = 0
+        self.elapsed = 0.0
+        self.max_queue_depth = 0
+        self.queue_depths = []
+
+    @property
+    def throughput(self):
+        """
+        Getter method for the achieved delivery throughput.
+        :return: Number of deliveries per second.
+        :rtype: float
+        """
+        return self.deliveries / self.elapsed if self.elapsed else 0.0
+
+    def add(self, elapsed, deliveries, queue_depth):
+        """
+        Adds a step of the drain to the report.
+        :param elapsed: Time in seconds since the drain started.
+        :type elapsed: float
+        :param deliveries: Number of deliveries sent in the step.
+        :type deliveries: int
+        :param queue_depth: Number of deliveries still queued after the step.
+        :type queue_depth: int
+        """
+        self.deliveries += deliveries
+        self.elapsed = elapsed
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        self.queue_depths.append((elapsed, queue_depth))
+
+    def __repr__(self):
+        """
+        Representation method.
+        :return: Summary of the report.
+        :rtype: str
+        """
+        return (f'{self.deliveries} deliveries in {self.elapsed:.3f} s: {self.throughput:.0f} deliveries/s, '
+                f'max queue depth {self.max_queue_depth}')
+
+
+class ThrottledDeliverySystem(DeliverySystem):
+    """
+    Delivery system that limits the rate of deliveries with token buckets, one for all deliveries and one for every
+    channel users are assigned to, as downstream gateways do. Deliveries exceeding the limits are queued by channel
+    instead of being dropped, and they are sent in batches as tokens are refilled. Queues keep user codes in arrays, so
+    a broadcast to millions of users can be queued, and drained on the simulated clock to plan the capacity needed.
+    """
+    last_report = None
+
+    def __init__(self, loss_chance=LOSS_CHANCE, read_chance=READ_CHANCE, seed=None, state=None, clock=None,
+                 retry_policy=None, deduplicator=None, retention_policy=None, rate=None, channel_rates=None,
+                 channel=None, burst=BURST):
+        """
+        :param loss_chance: Chance (0-1) that a sent message will not be received.
+        :type loss_chance: float
+        :param read_chance: Chance (0-1) that a received message will be read.
+        :type read_chance: float
+        :param seed: Seed for the random streams of the system.
+        :type seed: int
+        :param state: Store where users, messages and their delivery state are kept. A new in-memory store is used if
+        not specified.
+        :type state: BaseDeliveryState
+        :param clock: Function that returns the current time in seconds, which rate limits are enforced by. A simulated
+        clock is used if not specified.
+        :type clock: function
+        :param retry_policy: Policy to retry lost deliveries with. Retries are queued like any other delivery.
+        :type retry_policy: RetryPolicy
+        :param deduplicator: Layer that drops repeated deliveries when they leave the queues.
+        :type deduplicator: BaseDeduplicator
+        :param retention_policy: Policy for the messages kept in inboxes. Queued messages are never released.
+        :type retention_policy: RetentionPolicy
+        :param rate: Maximum number of deliveries per second of the whole system. Unlimited if not specified.
+        :type rate: float
+        :param channel_rates: Maximum number of deliveries per second of every channel. Channels without a rate are
+        only limited by the rate of the system.
+        :type channel_rates: dict
+        :param channel: Function that receives a user and returns the name of their channel. Every user is assigned
+        to the default channel if not specified.
+        :type channel: function
+        :param burst: Number of seconds of deliveries that every limit allows at once.
+        :type burst: float
+        """
+        super().__init__(loss_chance=loss_chance, read_chance=read_chance, seed=seed, state=state, clock=clock,
+                         retry_policy=retry_policy, deduplicator=deduplicator, retention_policy=retention_policy)
+        self.channel = channel
+        self.burst = burst
+        self._bucket = None
+        self._buckets = {}
+        self._queues = {}
+        self._queued = 0
+        self._turn = 0
+        if rate is not None:
+            self.limit(rate=rate)
+        for name, channel_rate in (channel_rates or {}).items():
+            self.limit(rate=channel_rate, channel=name)
+
+    def limit(self, rate, channel=None):
+        """
+        Sets the rate limit of the system or of a channel, with a full bucket of tokens.
+        :param rate: Maximum number of deliveries per second, or None to remove the limit.
+        :type rate: float
+        :param channel: Name of the channel to limit. The whole system is limited if not specified.
+        :type channel: str
+        """
+        bucket = None
+        if rate is not None:
+            # Buckets hold at least one token, so that rates lower than one delivery per burst still deliver.
+            bucket = TokenBucket(rate=rate, capacity=max(1, rate * self.burst), now=self._clock())
+        if channel is None:
+            self._bucket = bucket
+        elif bucket is None:
+            self._buckets.pop(channel, None)
+        else:
+            self._buckets[channel] = bucket
+
+    @property
+    def queue_depth(self):
+        """
+        Getter method for the number of queued deliveries.
+        :return: Number of deliveries waiting for tokens.
+        :rtype: int
+        """
+        return self._queued
+
+    def queue_depths(self):
+        """
+        Retrieves the number of queued deliveries of every channel.
+        :return: Number of deliveries waiting for tokens by channel name.
+        :rtype: dict
+        """
+        return {name: sum(len(codes) - position for _, _, codes, position in queue)
+                for name, queue in self._queues.items() if queue}
+
+    def _enqueue(self, message, user_codes, attempt=1):
+        """
+        Queues the delivery of this message to these users, in the queue of the channel of every user. Users are only
+        loaded from the store if there is a channel function.
+        :param message: The message to send.
+        :type message: Message
+        :param user_codes: Codes of the users to whom the message will be sent.
+        :type user_codes: iterable
+        :param attempt: Number of the delivery attempt, greater than 1 for retries.
+        :type attempt: int
+        """
+        if self.channel is None:
+            channels = {DEFAULT_CHANNEL: array('q', user_codes)}
+        else:
+            channels = {}
+            for user_code in user_codes:
+                name = self.channel(self._state.get_user(code=user_code))
+                codes = channels.get(name)
+                if codes is None:
+                    codes = channels[name] = array('q')
+                codes.append(user_code)
+        for name, codes in channels.items():
+            queue = self._queues.get(name)
+            if queue is None:
+                queue = self._queues[name] = deque()
+            # Deliveries queued one by one for the same message are merged into the last batch of the queue.
+            if queue and queue[-1][0] == message.code and queue[-1][1] == attempt:
+                queue[-1][2].extend(codes)
+            else:
+                queue.append([message.code, attempt, codes, 0])
+            self._queued += len(codes)
+
+    def _deliver(self, user, message, attempt=1):
+        self._enqueue(message=message, user_codes=(user.code,), attempt=attempt)
+
+    def _broadcast_batch(self, message, user_codes, attempt=1):
+        self._enqueue(message=message, user_codes=user_codes, attempt=attempt)
+        return message
+
+    def _broadcast_sharded(self, message, workers):
+        # Rolls are drawn as deliveries leave the queues, so sharded broadcasts are queued like batch ones.
+        self._enqueue(message=message, user_codes=range(1, self._user_count + 1))
+        return message
+
+    def _pending_messages(self):
+        codes = super()._pending_messages()
+        codes.update(entry[0] for queue in self._queues.values() for entry in queue)
+        return codes
+
+    def _dequeue(self, name, count):
+        """
+        Sends up to this number of deliveries from the head of the queue of a channel, in batches by message.
+        :param name: Name of the channel.
+        :type name: str
+        :param count: Maximum number of deliveries to send.
+        :type count: int
+        :return: Number of deliveries sent.
+        :rtype: int
+        """
+        queue = self._queues[name]
+        sent = 0
+        while queue and sent < count:
+            entry = queue[0]
+            message_code, attempt, codes, position = entry
+            end = min(len(codes), position + count - sent)
+            message = self._state.get_message(code=message_code)
+            users = [user for user in map(self._state.get_user, codes[position:end]) if user is not None]
+            if len(users) >= MIN_BATCH_SIZE:
+                super()._broadcast_batch(message=message, user_codes=[user.code for user in users], attempt=attempt)
+            else:
+                for user in users:
+                    super()._deliver(user=user, message=message, attempt=attempt)
+            sent += end - position
+            if end == len(codes):
+                queue.popleft()
+            else:
+                entry[3] = end
+        self._queued -= sent
+        return sent
+
+    def _allowance(self, name, now):
+        """
+        Retrieves the number of deliveries the limit of a channel allows right now.
+        :param name: Name of the channel.
+        :type name: str
+        :param now: Current time in seconds.
+        :type now: float
+        :return: Number of deliveries allowed, or None if the channel is not limited.
+        :rtype: int
+        """
+        bucket = self._buckets.get(name)
+        return bucket.available(now=now) if bucket is not None else None
+
+    def run_throttled(self):
+        """
+        Sends as many queued deliveries as the rate limits allow right now. The tokens of the system are shared evenly
+        among the channels with queued deliveries, and every channel sends its deliveries in the order they were queued.
+        Tokens left over from an uneven split go first to a channel that changes on every run, so that all channels get
+        tokens even when there are fewer tokens than channels.
+        :return: Number of deliveries sent.
+        :rtype: int
+        """
+        now = self._clock()
+        names = [name for name, queue in self._queues.items() if queue]
+        if not names:
+            return 0
+        self._refresh_tracer()
+        budget = self._bucket.available(now=now) if self._bucket is not None else self._queued
+        sent = 0
+        start = self._turn % len(names)
+        self._turn += 1
+        for index, name in enumerate(names):
+            # Every channel gets an even share of what is left, so the tokens a channel does not use go to the next.
+            # What is left over goes to the channels from the one at the start of this run on, wrapping around.
+            share, extra = divmod(budget - sent, len(names) - index)
+            if extra > (0 if index >= start else len(names) - start):
+                share += 1
+            allowance = self._allowance(name=name, now=now)
+            count = self._dequeue(name=name, count=share if allowance is None else min(share, allowance))
+            if name in self._buckets:
+                self._buckets[name].take(count=count, now=now)
+            sent += count
+        if self._bucket is not None:
+            self._bucket.take(count=sent, now=now)
+        self._state.flush()
+        return sent
+
+    def _wait(self, now):
+        """
+        Computes the time until the limits allow a full batch of queued deliveries: as many as the buckets can hold or
+        as are queued, whatever is lower.
+        :param now: Current time in seconds.
+        :type now: float
+        :return: Time to wait in seconds.
+        :rtype: float
+        """
+        depths = self.queue_depths()
+        waits = []
+        for name, depth in depths.items():
+            bucket = self._buckets.get(name)
+            waits.append(bucket.wait(count=depth, now=now) if bucket is not None else 0.0)
+        wait = min(waits) if waits else 0.0
+        if self._bucket is not None:
+            wait = max(wait, self._bucket.wait(count=self._queued, now=now))
+        return wait
+
+    def run_scheduled(self, until=None, batch=True):
+        """
+        Queues the scheduled deliveries that are due and sends as many queued deliveries as the rate limits allow.
+        :param until: Time up to which deliveries are due, in seconds of the system clock. Defaults to the current time.
+        :type until: float
+        :param batch: Ignored, since queued deliveries are always sent in batches.
+        :type batch: bool
+        :return: Number of deliveries sent.
+        :rtype: int
+        """
+        super().run_scheduled(until=until, batch=batch)
+        return self.run_throttled()
+
+    def drain(self):
+        """
+        Sends every queued delivery, as well as the scheduled ones and the retries of lost deliveries, waiting for the
+        rate limits between batches: the simulated clock is moved forward, while the wall clock is waited for. A report
+        of the drain is kept in "last_report".
+        :return: Report of the drain.
+        :rtype: ThrottleReport
+        """
+        report = ThrottleReport()
+        start = self._clock()
+        while self._queued or self._scheduler.next_due() is not None:
+            sent = self.run_scheduled()
+            report.add(elapsed=self._clock() - start, deliveries=sent, queue_depth=self._queued)
+            now, next_due = self._clock(), self._scheduler.next_due()
+            if not self._queued and next_due is None:
+                break
+            wait = self._wait(now=now) if self._queued else next_due - now
+            if next_due is not None:
+                wait = min(wait, max(0.0, next_due - now))
+            if isinstance(self._clock, SimulatedClock):
+                self._clock.advance(wait)
+            else:
+                time.sleep(wait)
+        self.last_report = report
+        logger.info(f'Drained the delivery queues: {report}.')
+        return report
@@ -0,0 +1,90 @@
+import logging
+from collections import namedtuple, deque
+
+from state import SENT
+
+logger = logging.getLogger(__name__)
+
+CREATED = 'created'
+
+DeliveryEvent = namedtuple('DeliveryEvent', ('event', 'message_code', 'user_code'))
+
+
+def log_event(event, message, user=None):
+    """
+    Tracer that logs every delivery event at debug level. Messages are formatted lazily by the logging package, so this
+    tracer should only be installed when debug logging is enabled.
+    :param event: Delivery event: created, sent, received or read.
+    :type event: str
+    :param message: The message of the event.
+    :type message: Message
+    :param user: The user of the event, if any.
+    :type user: User
+    """
+    if event == CREATED:
+        logger.debug('Created new message with code %s and body "%s".', message.code, message)
+    elif event == SENT:
+        logger.debug('Message "%s" sent to user %s.', message, user)
+    else:
+        logger.debug('Message "%s" marked as %s by user %s.', message, event, user)
+
+
+class EventStream(object):
+    """
+    Tracer that records every delivery event as a structured "DeliveryEvent" tuple of codes, keeping the latest ones up
+    to a maximum length and passing them to an optional listener.
+    """
+
+    def __init__(self, maxlen=None, listener=None):
+        """
+        :param maxlen: Maximum number of events kept. All of them are kept if not set.
+        :type maxlen: int
+        :param listener: Function called with every event as it happens.
+        :type listener: function
+        """
+        self.events = deque(maxlen=maxlen)
+        self.listener = listener
+
+    def __call__(self, event, message, user=None):
+        """
+        Records a delivery event.
+        :param event: Delivery event: created, sent, received or read.
+        :type event: str
+        :param message: The message of the event.
+        :type message: Message
+        :param user: The user of the event, if any.
+        :type user: User
+        """
+        record = DeliveryEvent(event=event, message_code=message.code, user_code=user.code if user else None)
+        self.events.append(record)
+        if self.listener is not None:
+            self.listener(record)
+
+
+def chain_tracers(*tracers):
+    """
+    Combines several tracers into a single one, leaving out the ones that are not set.
+    :param tracers: Tracers to combine.
+    :type tracers: function
+    :return: A tracer calling every set tracer, or None if none of them is set.
+    :rtype: function
+    """
+    tracers = tuple(tracer for tracer in tracers if tracer is not None)
+    if not tracers:
+        return None
+    if len(tracers) == 1:
+        return tracers[0]
+
+    def chained(event, message, user=None):
+        for tracer in tracers:
+            tracer(event, message, user)
+    return chained
+
+
+def get_logging_tracer():
+    """
+    Retrieves the tracer matching the current logging level, checking it once.
+    :return: The logging tracer if debug logging is enabled, None otherwise.
+    :rtype: function
+    """
+    return log_event if logger.isEnabledFor(logging.DEBUG) else None
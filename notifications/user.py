@@ -1,28 +1,86 @@
 import logging
+from itertools import islice
 
 from decorators import sort_by_code
+from state import DeliveryState, RECEIVED, READ
+from tracing import get_logging_tracer
 
 logger = logging.getLogger(__name__)
 
 
 class User(object):
     """
-    User class. Each user has a name, a numeric code and an inbox with messages they have received.
+    User class. Each user has a name, a numeric code and an inbox with messages they have received. The inbox is a view
+    over a delivery state store, shared with the delivery system that registered the user.
     """
-    _name = None
-    _code = None
-    _inbox = None
+    __slots__ = ('_name', '_code', '_state', '_views', '__weakref__')
 
-    def __init__(self, name, code):
+    def __init__(self, name, code, state=None):
         """
         :param name: Name of this user.
         :type name: str
         :param code: Code of this user.
         :type code: int
+        :param state: Store where the inbox of this user is kept. A new one is created if not specified.
+        :type state: DeliveryState
         """
         self.name = name
         self.code = code
-        self._inbox = set()
+        self._views = None
+        self._state = state if state is not None else DeliveryState(tracer=get_logging_tracer())
+        self._state.add_user(user=self)
+
+    @classmethod
+    def _from_trusted(cls, name, code, state, register=True):
+        """
+        Creates a user in a delivery state store without validating its name and code, for callers such as the
+        delivery system that already know them to be valid.
+        :param name: Name of the user.
+        :type name: str
+        :param code: Code of the user, new in the store.
+        :type code: int
+        :param state: Store where the inbox of the user is kept.
+        :type state: DeliveryState
+        :param register: Whether to add the user to the store. Stores restoring their own users do not need it.
+        :type register: bool
+        :return: The created user.
+        :rtype: User
+        """
+        user = cls.__new__(cls)
+        user._name = name
+        user._code = code
+        user._state = state
+        user._views = None
+        if register:
+            state.add_user(user=user)
+        return user
+
+    @classmethod
+    def _create_many(cls, names, first_code, state):
+        """
+        Creates several users with consecutive codes in a delivery state store at once. Names and codes are trusted to
+        be valid and the codes to be new in the store, so they are assigned without going through the setters.
+        :param names: Names of the users.
+        :type names: list
+        :param first_code: Code of the first user. The rest of them get the following codes.
+        :type first_code: int
+        :param state: Store where the inboxes of the users are kept.
+        :type state: DeliveryState
+        :return: The created users, ordered by their code.
+        :rtype: list
+        """
+        new = cls.__new__
+        users = []
+        append = users.append
+        for code, name in enumerate(names, start=first_code):
+            user = new(cls)
+            user._name = name
+            user._code = code
+            user._state = state
+            user._views = None
+            append(user)
+        state.add_users(users=users)
+        return users
 
     @property
     def name(self):
@@ -67,14 +125,26 @@ class User(object):
         self._code = code
 
     @property
-    @sort_by_code(reverse=True)
+    @sort_by_code(reverse=True, version=lambda self: (len(self._state.inbox(user_code=self._code)),
+                                                      self._state.evicted(user_code=self._code)))
     def inbox(self):
         """
         Getter method for the user's inbox.
         :return: This user's inbox ordered by message code in descending order.
         :rtype: list
         """
-        return self._inbox
+        return map(self._state.get_message, self._state.inbox(user_code=self._code))
+
+    def add_to_inbox(self, message):
+        """
+        Store a message in the inbox without marking it as received, so that it can be marked in bulk afterwards.
+        :param message: Message object received by this user.
+        :type: Message
+        :return: False if the message was already in the inbox, True otherwise.
+        :rtype: bool
+        """
+        self._state.add_message(message=message)
+        return self._state.add_to_inbox(user_code=self._code, message_code=message.code)
 
     def receive_message(self, message):
         """
@@ -82,12 +152,10 @@ class User(object):
         :param message: Message object received by this user.
         :type: Message
         """
-        if message not in self._inbox:
-            self._inbox.add(message)
+        if self.add_to_inbox(message=message):
             message.mark_as_received(user=self)
-            logger.debug(f'User {self} received a new message: "{message}"')
         else:
-            logger.warning(f'User {self} received a repeated message: "{message}".')
+            logger.warning('User %s received a repeated message: "%s".', self, message)
 
     def read_message(self, message):
         """
@@ -95,31 +163,136 @@ class User(object):
         :param message: The message to mark as read.
         :type message: Message
         """
-        try:
-            inbox_message = next(msg for msg in self._inbox if msg == message)
-            inbox_message.mark_as_read(user=self)
-        except StopIteration:
+        if not self._state.in_inbox(user_code=self._code, message_code=message.code):
             raise ValueError(f'User {self} cannot read this message because it is not in their inbox.')
+        self._state.get_message(code=message.code).mark_as_read(user=self)
+
+    def read_messages(self, codes):
+        """
+        Mark several messages as read by this user at once. Their read status is set in bulk and the unread messages of
+        the user are updated in a single pass.
+        :param codes: Codes of the messages to mark as read.
+        :type codes: iterable
+        """
+        codes = list(codes)
+        missing = [code for code in codes if not self._state.in_inbox(user_code=self._code, message_code=code)]
+        if missing:
+            raise ValueError(f'User {self} cannot read messages {missing} because they are not in their inbox.')
+        unreceived = [code for code in codes
+                      if not self._state.has(status=RECEIVED, message_code=code, user_code=self._code)]
+        if unreceived:
+            raise ValueError(f'Messages {unreceived} have not been received by user {self} so they cannot be read.')
+        self._state.mark_read(user_code=self._code, message_codes=codes)
+        if self._state.tracer is not None:
+            for code in codes:
+                self._state.get_message(code=code)._trace(event=READ, users=(self,))
 
-    @sort_by_code(reverse=True)
+    def mark_all_read(self):
+        """
+        Mark every unread message in this user's inbox as read.
+        """
+        self.read_messages(codes=list(self._state.unread_inbox(user_code=self._code)))
+
+    def evict_messages(self, codes):
+        """
+        Remove several messages from this user's inbox at once, whether they were read or not. They can no longer be
+        read by this user, but their delivery status is kept in the statistics.
+        :param codes: Codes of the messages to evict.
+        :type codes: iterable
+        :return: Number of messages evicted.
+        :rtype: int
+        """
+        return self._state.evict(evictions={self._code: list(codes)})
+
+    def apply_retention(self, policy):
+        """
+        Evict the oldest messages of this user's inbox beyond the limit of a retention policy.
+        :param policy: Retention policy to apply.
+        :type policy: RetentionPolicy
+        :return: Number of messages evicted.
+        :rtype: int
+        """
+        return self.evict_messages(codes=policy.overflow(inbox=self._state.inbox(user_code=self._code)))
+
+    def unread_count(self):
+        """
+        Retrieve the number of unread messages in the user's inbox, which is kept up to date as messages are received
+        and read, so it takes constant time.
+        :return: Number of messages this user has not read yet.
+        :rtype: int
+        """
+        return self._state.unread_count(user_code=self._code)
+
+    def _inbox_version(self):
+        """
+        Retrieves a stamp that changes whenever a message is received, read or evicted by this user, to cache inbox
+        views. The number of messages ever evicted tells apart an inbox that lost some messages and received as many.
+        :return: Number of messages in the inbox, number of unread messages and number of messages evicted.
+        :rtype: tuple
+        """
+        return (len(self._state.inbox(user_code=self._code)), self._state.unread_count(user_code=self._code),
+                self._state.evicted(user_code=self._code))
+
+    @sort_by_code(reverse=True, version=_inbox_version)
     def get_read_messages(self):
         """
         Retrieve all read messages from the user's inbox.
         :return: All messages this user has read ordered by their code in descending order.
         :rtype: list
         """
-        read_messages = filter(lambda x: x.is_read(user=self), self._inbox)
-        return read_messages
+        return map(self._state.get_message, reversed(self._state.read_inbox(user_code=self._code)))
 
-    @sort_by_code(reverse=True)
+    @sort_by_code(reverse=True, version=_inbox_version)
     def get_unread_messages(self):
         """
-        Retrieve all unread messages from the user's inbox.
+        Retrieve all unread messages from the user's inbox. They are kept sorted by the delivery state store, so they
+        are neither filtered nor sorted again.
         :return: All messages this user has not read yet, ordered by their code in descending order.
         :rtype: list
         """
-        unread_messages = filter(lambda x: not x.is_read(user=self), self._inbox)
-        return unread_messages
+        return map(self._state.get_message, reversed(self._state.unread_inbox(user_code=self._code)))
+
+    def iter_unread_messages(self, before_code=None):
+        """
+        Iterate over the unread messages of the user's inbox from newest to oldest, finding the first one with a binary
+        search and retrieving the rest lazily, so that they can be paginated.
+        :param before_code: If set, only unread messages with a lower code than this one are retrieved.
+        :type before_code: int
+        :return: Unread messages ordered by their code in descending order.
+        :rtype: iterator
+        """
+        codes = self._state.iter_inbox(user_code=self._code, before_code=before_code, unread=True)
+        return map(self._state.get_message, codes)
+
+    def iter_inbox(self, before_code=None):
+        """
+        Iterate over the messages of the user's inbox from newest to oldest, finding the first one with a binary search
+        and retrieving the rest lazily, so that the inbox can be walked backwards without building the whole list.
+        :param before_code: If set, only messages with a lower code than this one are retrieved.
+        :type before_code: int
+        :return: Messages ordered by their code in descending order.
+        :rtype: iterator
+        """
+        return map(self._state.get_message, self._state.iter_inbox(user_code=self._code, before_code=before_code))
+
+    def inbox_page(self, limit, before_code=None):
+        """
+        Retrieve a page of the user's inbox, with the newest messages first. The code of the last message of a page can
+        be passed as the cursor of the next one, and every page only costs a binary search plus its own messages.
+        :param limit: Maximum number of messages of the page.
+        :type limit: int
+        :param before_code: If set, only messages with a lower code than this one are retrieved.
+        :type before_code: int
+        :return: Messages of the page ordered by their code in descending order.
+        :rtype: list
+        """
+        if not isinstance(limit, int):
+            raise TypeError('Page limit must be an integer.')
+        if limit < 0:
+            raise ValueError('Page limit must be a positive integer.')
+        if before_code is not None and not isinstance(before_code, int):
+            raise TypeError('Page cursor must be an integer.')
+        return list(islice(self.iter_inbox(before_code=before_code), limit))
 
     def __repr__(self):
         """